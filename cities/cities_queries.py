@@ -1,6 +1,8 @@
-from functools import wraps
+from pymongo.errors import BulkWriteError
 
 import data.db_connect as dbc
+from data.batch_loader import BatchLoader
+from data.collection_cache import CollectionCache
 
 CITY_COLLECTION = "cities"
 
@@ -9,7 +11,11 @@ STATE_CODE = "state_code"
 COUNTRY_CODE = "country_code"
 REC_RESTAURANT = "rec_restaurant"
 
-cache = None
+# secondary indexes over the cache
+BY_STATE = "by_state"
+BY_COUNTRY = "by_country"
+BY_NAME = "by_name"
+BY_COUNTRY_STATE = "by_country_state"
 
 SAMPLE_CITY = {
     CITY: "ZZTEST_City",
@@ -19,51 +25,95 @@ SAMPLE_CITY = {
 }
 
 
-def needs_cache(fn):
-    @wraps(fn)
-    def wrapper(*args, **kwargs):
-        if cache is None:
-            load_cache()
-        return fn(*args, **kwargs)
+def city_key(doc: dict) -> tuple:
+    if not doc.get(CITY):
+        return None
+    return (doc.get(CITY), doc.get(STATE_CODE, ''), doc.get(COUNTRY_CODE, ''))
 
-    return wrapper
+
+KEY_FLDS = [CITY, STATE_CODE, COUNTRY_CODE]
+REQUIRED_FLDS = [CITY, STATE_CODE, COUNTRY_CODE, REC_RESTAURANT]
+# default CSV export columns
+EXPORT_FLDS = REQUIRED_FLDS
+
+# the unique identity index also serves filters on the city alone;
+# exports filter on the country, or the country and state
+INDEXES = [
+    dbc.Index(KEY_FLDS, unique=True),
+    dbc.Index([COUNTRY_CODE, STATE_CODE]),
+]
+QUERY_SHAPES = [KEY_FLDS, [CITY], [COUNTRY_CODE], [COUNTRY_CODE, STATE_CODE]]
+dbc.register_indexes(CITY_COLLECTION, INDEXES, QUERY_SHAPES)
+
+
+def city_filter(key: tuple) -> dict:
+    city_name, state_code, country_code = key
+    return {CITY: city_name, STATE_CODE: state_code, COUNTRY_CODE: country_code}
+
+
+cache = CollectionCache(
+    CITY_COLLECTION,
+    city_key,
+    indexes={
+        BY_STATE: lambda doc: doc.get(STATE_CODE, ''),
+        BY_COUNTRY: lambda doc: doc.get(COUNTRY_CODE, ''),
+        BY_NAME: lambda doc: doc.get(CITY),
+        BY_COUNTRY_STATE: lambda doc: (doc.get(COUNTRY_CODE, ''), doc.get(STATE_CODE, '')),
+    },
+)
 
 
-@needs_cache
 def count() -> int:
     return len(cache)
 
 
-@needs_cache
 def read() -> dict:
-    return {city_name: doc for (city_name, _st, _cc), doc in cache.items()}
+    return cache.derived(
+        'by_city_name',
+        lambda docs: {city_name: doc for (city_name, _st, _cc), doc in docs.items()},
+    )
 
 
-def load_cache():
-    """Load the in-memory cache from the DB.
+def read_page(limit: int, after: tuple = None) -> tuple:
+    """
+    Return (docs, next) for one page of cities in key order.
+    See Snapshot.page().
+    """
+    return cache.snapshot().page(limit, after)
 
-    Unit tests should not require a running MongoDB instance, so if the DB is
-    unavailable we fall back to an empty cache.
+
+def iter_export(country_code: str = None, state_code: str = None):
+    """
+    Yield city docs, optionally only those of one country and/or state.
+    They come from the cache when it is loaded and otherwise straight
+    from a DB cursor, so an export never loads the whole collection.
     """
-    global cache
-    cache = {}
+    cc = country_code.strip().upper() if country_code else None
+    sc = state_code.strip().upper() if state_code else None
+    if not cache.is_loaded():
+        filt = {}
+        if cc:
+            filt[COUNTRY_CODE] = cc
+        if sc:
+            filt[STATE_CODE] = sc
+        return dbc.iter_docs(CITY_COLLECTION, filt=filt, no_id=True)
+    snap = cache.snapshot()
+    if cc and sc:
+        docs = snap.lookup(BY_COUNTRY_STATE, (cc, sc))
+    elif cc:
+        docs = snap.lookup(BY_COUNTRY, cc)
+    elif sc:
+        docs = snap.lookup(BY_STATE, sc)
+    else:
+        docs = snap.docs
+    return iter(docs.values())
 
-    try:
-        cities = dbc.read(CITY_COLLECTION)
-    except Exception:
-        print(f"Error loading cities from DB: {Exception}")
-        cities = []
 
-    for city_doc in cities:
-        city_name = city_doc.get(CITY)
-        state_code = city_doc.get(STATE_CODE, '')
-        country_code = city_doc.get(COUNTRY_CODE, '')
-        if city_name:
-            key = (city_name, state_code, country_code)
-            cache[key] = city_doc
+def load_cache():
+    """Reload the in-memory cache from the DB."""
+    cache.load()
 
 
-@needs_cache
 def add_city(
     country_code: str,
     state_code: str,
@@ -79,44 +129,125 @@ def add_city(
         **extra_fields,
     }
 
-    result = dbc.update(
-        CITY_COLLECTION,
-        {CITY: city_name, STATE_CODE: state_code, COUNTRY_CODE: country_code},
-        doc,
-    )
-    if result.matched_count == 0:
-        dbc.create(CITY_COLLECTION, doc)
+    # one atomic upsert; the doc it returns has every field, so it can
+    # go straight into the cache
+    cache.put(dbc.upsert(CITY_COLLECTION, city_filter(city_key(doc)), doc, no_id=True))
+
+
+def city_doc(row: dict) -> dict:
+    """
+    Check an uploaded row and turn it into a city doc.
+    """
+    if not isinstance(row, dict):
+        raise ValueError("Row must be a JSON object")
+    missing = [fld for fld in REQUIRED_FLDS if not row.get(fld)]
+    if missing:
+        raise ValueError(f"Missing required fields: {', '.join(missing)}")
+    return {fld: val for fld, val in row.items() if fld != dbc.MONGO_ID}
 
-    load_cache()
+
+def add_cities(docs: list) -> list:
+    """
+    Upsert a batch of city docs, as add_city() does one, in one round
+    trip per chunk. Later docs for the same city win.
+    If a doc fails, the ones written before it are still cached, and
+    the BulkWriteError is raised.
+    """
+    try:
+        results = dbc.upsert_many(CITY_COLLECTION, docs, KEY_FLDS, ordered=True)
+    except BulkWriteError as e:
+        cache.merge(dbc.written(docs, e, ordered=True))
+        raise
+    cache.merge(docs)
+    return results
 
 
-@needs_cache
-def get_city(city_name: str, state_code: str, country_code: str) -> dict:
-    """Retrieve a city record by ID."""
+def get_city(city_name: str, state_code: str, country_code: str, fields=None) -> dict:
+    """
+    Retrieve a city record by ID, optionally trimmed to fields.
+    Misses are read through miss_loader, batched with concurrent ones;
+    a trimmed miss is projected in Mongo instead and not cached.
+    Keys the cache's Bloom filter rules out, or that the DB recently
+    didn't have, aren't asked for.
+    """
     key = (city_name, state_code, country_code)
     doc = cache.get(key)
+    if doc is not None:
+        return dbc.trim_doc(doc, fields)
+    if cache.might_contain(key) and not cache.is_known_missing(key):
+        if fields is None:
+            doc = miss_loader.load(key)
+        else:
+            doc = dbc.read_one(CITY_COLLECTION, city_filter(key), projection=fields, no_id=True)
+            if doc is None:
+                cache.remember_missing(key)
     if doc is None:
-        query = {CITY: city_name, STATE_CODE: state_code, COUNTRY_CODE: country_code}
-        doc = dbc.read_one(CITY_COLLECTION, query)
-        if doc is None:
-            raise ValueError(
-                f"City not found: {city_name}, {state_code}, {country_code}"
-            )
-        cache[key] = doc
+        raise ValueError(
+            f"City not found: {city_name}, {state_code}, {country_code}"
+        )
     return doc
 
 
-@needs_cache
+def fetch_cities(keys: list) -> dict:
+    """
+    Read cities missing from the cache with one query per chunk of keys
+    and write them through to the cache, remembering the keys it
+    doesn't have. Returns {key: doc}.
+    """
+    docs = list(dbc.read_by_keys(CITY_COLLECTION, KEY_FLDS, keys))
+    cache.write(puts=docs)
+    found = {city_key(doc): doc for doc in docs}
+    for key in keys:
+        if key not in found:
+            cache.remember_missing(key)
+    return found
+
+
+miss_loader = BatchLoader(fetch_cities)
+
+
+def get_cities(keys: list) -> dict:
+    """
+    Look up many cities by (city, state_code, country_code) key at once:
+    hits come from one pass over the cache, misses from a single DB query.
+    Returns {key: doc} for the keys that exist.
+    """
+    found, missing = cache.get_many(dict.fromkeys(keys))
+    if missing:
+        found.update(fetch_cities(missing))
+    return found
+
+
 def get_cities_by_state(state_code: str) -> dict:
     sc = state_code.strip().upper()
-    return {city_name: doc for (city_name, st, _cc), doc in cache.items() if st == sc}
+    return {city_name: doc for (city_name, _st, _cc), doc in cache.lookup(BY_STATE, sc).items()}
+
+
+def get_cities_by_state_page(state_code: str, limit: int, after: tuple = None) -> tuple:
+    sc = state_code.strip().upper()
+    return cache.snapshot().page(limit, after, BY_STATE, sc)
+
+
+def get_cities_by_country(country_code: str) -> dict:
+    cc = country_code.strip().upper()
+    return {city_name: doc for (city_name, _st, _cc), doc in cache.lookup(BY_COUNTRY, cc).items()}
+
+
+def get_cities_by_country_state(country_code: str, state_code: str) -> dict:
+    key = (country_code.strip().upper(), state_code.strip().upper())
+    return {city_name: doc for (city_name, _st, _cc), doc in cache.lookup(BY_COUNTRY_STATE, key).items()}
+
+
+def find_by_name(city_name: str):
+    """
+    Return the city named city_name, or None. Where several cities share
+    the name, the last one cached wins, as it does in read().
+    """
+    return next(reversed(cache.lookup(BY_NAME, city_name).values()), None)
 
 
-@needs_cache
 def get_city_by_name(city_name: str) -> dict:
-    if cache is None:
-        load_cache()
-    matches = [doc for (nm, _, _), doc in cache.items() if nm == city_name]
+    matches = list(cache.lookup(BY_NAME, city_name).values())
     if not matches:
         raise ValueError(f"City not found: {city_name}")
     if len(matches) > 1:
@@ -148,7 +279,7 @@ def delete_city(city_name: str, state_code: str, country_code: str) -> bool:
     )
     if ret < 1:
         raise ValueError(f"City not found: {city_name}, {state_code}, {country_code}")
-    load_cache()
+    cache.evict((city_name, state_code, country_code))
     return True
 
 
@@ -156,7 +287,13 @@ def delete_city_by_name(city_name: str) -> bool:
     ret = dbc.delete(CITY_COLLECTION, {CITY: city_name})
     if ret < 1:
         raise ValueError(f"City not found: {city_name}")
-    load_cache()
+    if cache.is_loaded():
+        keys = list(cache.lookup(BY_NAME, city_name))
+        if len(keys) == 1:
+            cache.evict(keys[0])
+        else:
+            # we can't tell which of the cities the DB deleted
+            cache.load()
     return True
 
 
@@ -174,7 +311,15 @@ def update_city(
     ret = dbc.update(CITY_COLLECTION, query, new_data)
     if ret.modified_count < 1:
         raise ValueError(f"City not found: {city_name}, {state_code}, {country_code}")
-    load_cache()
+    key = (city_name, state_code, country_code)
+    if cache.is_loaded():
+        cached = cache.get(key)
+        if cached is not None:
+            # one snapshot for the whole change
+            cache.write(evicts=[key], puts=[{**cached, **new_data}])
+        else:
+            # someone else wrote this city since we loaded
+            cache.refresh(key, query)
     return ret.modified_count
 
 
@@ -186,16 +331,15 @@ def create_doc(data: dict) -> str:
         raise ValueError(f"Bad type for {data.get(CITY)=}")
     new_id = dbc.create(CITY_COLLECTION, data)
     # print(f"{new_id=}")
-    load_cache()
+    cache.put(data)
     return str(new_id.inserted_id)
 
 
-@needs_cache
 def read_one(city_name: str, state_code: str, country_code: str) -> dict:
-    key = (city_name, state_code, country_code)
-    if key not in cache:
+    doc = cache.get((city_name, state_code, country_code))
+    if doc is None:
         raise ValueError(f"City not found: {city_name}, {state_code}, {country_code}")
-    return cache[key]
+    return doc
 
 
 def main():
@@ -1,6 +1,7 @@
 from copy import deepcopy
 from unittest.mock import patch
 import pytest
+from pymongo.errors import BulkWriteError
 from data.db_connect import is_valid_id
 import cities.cities_queries as qry
 
@@ -30,10 +31,9 @@ def temp_city():
 
 @pytest.fixture
 def reset_cache():
-    original_cache = qry.cache.copy() if qry.cache else {}
-    qry.cache = None
+    qry.cache.clear()
     yield
-    qry.cache = original_cache.copy() if original_cache else None
+    qry.cache.clear()
 
 
 def test_reset_cache(reset_cache):
@@ -138,3 +138,150 @@ def test_is_valid_id_whitespace():
 def test_get_cities_by_state():
     result = qry.get_cities_by_state('NY')
     assert all(city['state_code'] == 'NY' for city in result.values())
+
+
+def load_test_cache(docs):
+    with patch('cities.cities_queries.dbc.iter_docs', return_value=iter(deepcopy(docs))):
+        qry.load_cache()
+
+
+def test_add_city_writes_through(reset_cache):
+    load_test_cache([])
+    stored = {qry.CITY: 'ZZTEST_City', qry.STATE_CODE: 'ZZ', qry.COUNTRY_CODE: 'ZZ',
+              qry.REC_RESTAURANT: 'ZZTEST_Restaurant'}
+    with patch('cities.cities_queries.dbc.upsert', return_value=stored) as mock_upsert, \
+            patch('cities.cities_queries.load_cache') as mock_load:
+        qry.add_city('ZZ', 'ZZ', 'ZZTEST_City', 'ZZTEST_Restaurant')
+        mock_load.assert_not_called()
+    mock_upsert.assert_called_once_with(
+        qry.CITY_COLLECTION, qry.city_filter(('ZZTEST_City', 'ZZ', 'ZZ')), stored, no_id=True)
+    assert qry.read_one('ZZTEST_City', 'ZZ', 'ZZ')[qry.REC_RESTAURANT] == 'ZZTEST_Restaurant'
+
+
+def test_add_writes_even_if_cached(reset_cache):
+    load_test_cache([qry.SAMPLE_CITY])
+    # another worker may have changed it since this cache was loaded
+    with patch('cities.cities_queries.dbc.upsert', return_value=dict(qry.SAMPLE_CITY)) as mock_upsert:
+        qry.add_city(qry.SAMPLE_CITY[qry.COUNTRY_CODE], qry.SAMPLE_CITY[qry.STATE_CODE],
+                     qry.SAMPLE_CITY[qry.CITY], qry.SAMPLE_CITY[qry.REC_RESTAURANT])
+    mock_upsert.assert_called_once()
+    with patch('cities.cities_queries.dbc.upsert_many', return_value=[]) as mock_upsert_many:
+        qry.add_cities([dict(qry.SAMPLE_CITY)])
+    mock_upsert_many.assert_called_once()
+
+
+def test_add_cities_caches_written_docs(reset_cache):
+    load_test_cache([])
+    docs = [{qry.CITY: f'ZZTEST_{n}', qry.STATE_CODE: 'ZZ', qry.COUNTRY_CODE: 'ZZ'} for n in range(3)]
+    error = BulkWriteError({'writeErrors': [{'index': 1, 'errmsg': 'duplicate key'}]})
+    with patch('cities.cities_queries.dbc.upsert_many', side_effect=error):
+        with pytest.raises(BulkWriteError):
+            qry.add_cities(docs)
+    assert ('ZZTEST_0', 'ZZ', 'ZZ') in qry.cache
+    assert ('ZZTEST_1', 'ZZ', 'ZZ') not in qry.cache
+    assert ('ZZTEST_2', 'ZZ', 'ZZ') not in qry.cache
+
+
+def test_find_by_name_last_wins(reset_cache):
+    load_test_cache([
+        {qry.CITY: 'ZZTEST_City', qry.STATE_CODE: 'ZA', qry.COUNTRY_CODE: 'ZZ'},
+        {qry.CITY: 'ZZTEST_City', qry.STATE_CODE: 'ZB', qry.COUNTRY_CODE: 'ZZ'},
+    ])
+    assert qry.find_by_name('ZZTEST_City') == qry.read()['ZZTEST_City']
+    assert qry.find_by_name('ZZTEST_City')[qry.STATE_CODE] == 'ZB'
+    qry.cache.put({qry.CITY: 'ZZTEST_City', qry.STATE_CODE: 'ZA', qry.COUNTRY_CODE: 'ZZ', 'n': 1})
+    assert qry.find_by_name('ZZTEST_City') == qry.read()['ZZTEST_City']
+    assert qry.find_by_name('ZZTEST_Gone') is None
+
+
+def test_update_city_publishes_one_snapshot(reset_cache):
+    load_test_cache([qry.SAMPLE_CITY])
+    generation = qry.cache.current.generation
+    with patch('cities.cities_queries.dbc.update') as mock_update:
+        mock_update.return_value.modified_count = 1
+        qry.update_city(qry.SAMPLE_CITY[qry.CITY], qry.SAMPLE_CITY[qry.STATE_CODE],
+                        qry.SAMPLE_CITY[qry.COUNTRY_CODE], {qry.REC_RESTAURANT: 'ZZTEST_Other'})
+    assert qry.cache.current.generation == generation + 1
+    assert qry.read_one(qry.SAMPLE_CITY[qry.CITY], qry.SAMPLE_CITY[qry.STATE_CODE],
+                        qry.SAMPLE_CITY[qry.COUNTRY_CODE])[qry.REC_RESTAURANT] == 'ZZTEST_Other'
+
+
+def test_delete_city_evicts(reset_cache):
+    temp_rec = get_temp_rec()
+    load_test_cache([temp_rec])
+    with patch('cities.cities_queries.dbc.delete', return_value=1), \
+            patch('cities.cities_queries.load_cache') as mock_load:
+        qry.delete_city(temp_rec[qry.CITY], temp_rec[qry.STATE_CODE], temp_rec[qry.COUNTRY_CODE])
+        mock_load.assert_not_called()
+    assert qry.count() == 0
+
+
+def test_secondary_indexes(reset_cache):
+    load_test_cache([
+        {qry.CITY: 'ZZTEST_A', qry.STATE_CODE: 'ZZ', qry.COUNTRY_CODE: 'ZZZ'},
+        {qry.CITY: 'ZZTEST_B', qry.STATE_CODE: 'ZZ', qry.COUNTRY_CODE: 'ZZZ'},
+        {qry.CITY: 'ZZTEST_C', qry.STATE_CODE: 'YY', qry.COUNTRY_CODE: 'ZZZ'},
+    ])
+    assert set(qry.get_cities_by_state('zz')) == {'ZZTEST_A', 'ZZTEST_B'}
+    assert len(qry.get_cities_by_country('ZZZ')) == 3
+    assert set(qry.get_cities_by_country_state('ZZZ', 'YY')) == {'ZZTEST_C'}
+    with patch('cities.cities_queries.dbc.delete', return_value=1):
+        qry.delete_city('ZZTEST_A', 'ZZ', 'ZZZ')
+    assert set(qry.get_cities_by_state('ZZ')) == {'ZZTEST_B'}
+    with pytest.raises(ValueError):
+        qry.get_city_by_name('ZZTEST_A')
+    assert qry.get_city_by_name('ZZTEST_C')[qry.STATE_CODE] == 'YY'
+
+
+def test_city_doc():
+    with pytest.raises(ValueError):
+        qry.city_doc({qry.CITY: 'ZZTEST_A'})
+    with pytest.raises(ValueError):
+        qry.city_doc(['not', 'a', 'row'])
+    doc = qry.city_doc({**qry.SAMPLE_CITY, '_id': 'x'})
+    assert doc == qry.SAMPLE_CITY
+
+
+def test_add_cities_writes_through(reset_cache):
+    load_test_cache([{**qry.SAMPLE_CITY, 'extra': 1}])
+    docs = [{**qry.SAMPLE_CITY, qry.REC_RESTAURANT: 'new'},
+            {qry.CITY: 'ZZTEST_B', qry.STATE_CODE: 'ZZ', qry.COUNTRY_CODE: 'ZZ'}]
+    with patch('cities.cities_queries.dbc.upsert_many') as mock_upsert:
+        qry.add_cities(docs)
+    mock_upsert.assert_called_once_with(qry.CITY_COLLECTION, docs, qry.KEY_FLDS, ordered=True)
+    city = qry.get_city('ZZTEST_City', 'ZZ', 'ZZ')
+    assert city[qry.REC_RESTAURANT] == 'new'
+    assert city['extra'] == 1
+    assert set(qry.get_cities_by_state('ZZ')) == {'ZZTEST_City', 'ZZTEST_B'}
+
+
+def test_get_city_miss_uses_loader(reset_cache):
+    load_test_cache([])
+    qry.cache.bloom = None
+    doc = dict(qry.SAMPLE_CITY)
+    with patch('cities.cities_queries.dbc.read_by_keys', return_value=iter([doc])) as mock_read:
+        assert qry.get_city('ZZTEST_City', 'ZZ', 'ZZ') == doc
+    mock_read.assert_called_once_with(qry.CITY_COLLECTION, qry.KEY_FLDS, [('ZZTEST_City', 'ZZ', 'ZZ')])
+    # and it was written through
+    assert qry.read_one('ZZTEST_City', 'ZZ', 'ZZ') == doc
+
+
+def test_get_city_misses_remembered(reset_cache):
+    load_test_cache([])
+    qry.cache.bloom = None
+    with patch('cities.cities_queries.dbc.read_by_keys', return_value=iter([])) as mock_read:
+        for _ in range(3):
+            with pytest.raises(ValueError):
+                qry.get_city('ZZTEST_Gone', 'ZZ', 'ZZ')
+    mock_read.assert_called_once()
+    with patch('cities.cities_queries.dbc.upsert', side_effect=lambda coll, filt, doc, no_id: doc):
+        qry.add_city('ZZ', 'ZZ', 'ZZTEST_Gone', 'ZZTEST_Restaurant')
+    assert qry.get_city('ZZTEST_Gone', 'ZZ', 'ZZ')[qry.REC_RESTAURANT] == 'ZZTEST_Restaurant'
+
+
+def test_get_city_bloom_skips_db(reset_cache):
+    load_test_cache([qry.SAMPLE_CITY])
+    with patch('cities.cities_queries.dbc.read_by_keys') as mock_read:
+        with pytest.raises(ValueError):
+            qry.get_city('ZZTEST_Gone', 'ZZ', 'ZZ')
+    mock_read.assert_not_called()
@@ -1,6 +1,10 @@
-from functools import wraps
+import unicodedata
+
+from pymongo.errors import BulkWriteError
 
 import data.db_connect as dbc
+from data.batch_loader import BatchLoader
+from data.collection_cache import CollectionCache
 import logging
 logging.basicConfig(level=logging.INFO)
 
@@ -13,57 +17,127 @@ CAPITAL = "capital"
 NATIONAL_DISH = "nat_dish"
 POP_DISH_1 = "pop_dish_1"
 POP_DISH_2 = "pop_dish_2"
+COUNTRY_CODE = "country_code"
+REQUIRED_FLDS = [COUNTRY_CODE, NAME, CAPITAL, NATIONAL_DISH, POP_DISH_1, POP_DISH_2]
+# default CSV export columns
+EXPORT_FLDS = [ID, NAME, CAPITAL, NATIONAL_DISH, POP_DISH_1, POP_DISH_2]
+
+# countries are keyed on _id, which the DB always indexes
+dbc.register_indexes(COUNTRY_COLLECTION, [], [[ID]])
+
+# secondary indexes over the cache
+BY_NAME = "by_name"
+BY_NORM_NAME = "by_norm_name"
+
+
+def normalize_name(name: str) -> str:
+    """
+    Unicode-normalize, casefold and collapse whitespace, so that
+    "Morocco", "morocco" and " MOROCCO " are the same name.
+    """
+    return ' '.join(unicodedata.normalize('NFKC', name).casefold().split())
 
-country_cache = None
 
+def name_of(doc: dict):
+    name = doc.get(NAME)
+    return name if isinstance(name, str) else None
 
-def needs_cache(fn):
-    @wraps(fn)
-    def wrapper(*args, **kwargs):
-        if country_cache is None:
-            load_cache()
-        return fn(*args, **kwargs)
-    return wrapper
+
+def norm_name_of(doc: dict):
+    name = name_of(doc)
+    return normalize_name(name) if name is not None else None
+
+
+country_cache = CollectionCache(
+    COUNTRY_COLLECTION,
+    lambda doc: doc.get(ID),
+    indexes={BY_NAME: name_of, BY_NORM_NAME: norm_name_of},
+    no_id=False,
+)
 
 
 def load_cache() -> None:
-    global country_cache
-    country_cache = {}
+    country_cache.load()
 
-    try:
-        docs = dbc.read(COUNTRY_COLLECTION, no_id=False)
-    except Exception:
-        docs = []
 
-    for doc in docs:
-        cid = doc.get(ID)
-        if cid is not None:
-            country_cache[cid] = doc
+def find_by_name(name: str):
+    """
+    Return the cached country with this name, or None.
+    An exact match wins over a normalized one.
+    """
+    if not isinstance(name, str):
+        return None
+    snap = country_cache.snapshot()
+    matches = snap.lookup(BY_NAME, name)
+    if not matches:
+        matches = snap.lookup(BY_NORM_NAME, normalize_name(name))
+    return next(iter(matches.values()), None)
 
 
-@needs_cache
-def get_country(country_id) -> dict:
+def get_country(country_id, fields=None) -> dict:
     """
     Retrieve a country by ID.
+    Cache misses are read through miss_loader, batched with concurrent
+    ones; IDs the cache's Bloom filter rules out, or that the DB recently
+    didn't have, aren't asked for.
+    With fields, only those fields are returned; a cache miss then
+    asks Mongo for just them and the partial doc is not cached.
 
     Note: Unit tests use integer IDs (e.g., 1), so we accept any hashable ID.
     """
     doc = country_cache.get(country_id)
     if doc is not None:
-        return doc
+        return dbc.trim_doc(doc, fields)
 
     try:
-        doc = dbc.read_one(COUNTRY_COLLECTION, {ID: country_id})
+        if not country_cache.might_contain(country_id) or \
+                country_cache.is_known_missing(country_id):
+            doc = None
+        elif fields is None:
+            doc = miss_loader.load(country_id)
+        else:
+            doc = dbc.read_one(COUNTRY_COLLECTION, {ID: country_id}, projection=fields,
+                               no_id=ID not in fields)
+            if doc is None:
+                country_cache.remember_missing(country_id)
     except Exception:
         doc = None
 
     if doc is None:
         raise ValueError(f"No such country with id {country_id}.")
-
-    country_cache[country_id] = doc
     return doc
 
 
+def fetch_countries(country_ids: list) -> dict:
+    """
+    Read countries missing from the cache with one $in query per chunk
+    and write them through to the cache, remembering the IDs it doesn't
+    have. Returns {ID: doc}.
+    """
+    docs = list(dbc.read_by_keys(COUNTRY_COLLECTION, [ID], country_ids, no_id=False))
+    country_cache.write(puts=docs)
+    found = {doc[ID]: doc for doc in docs}
+    for country_id in country_ids:
+        if country_id not in found:
+            country_cache.remember_missing(country_id)
+    return found
+
+
+miss_loader = BatchLoader(fetch_countries)
+
+
+def get_countries(country_ids: list) -> dict:
+    """
+    Look up many countries by ID at once: hits come from one pass over
+    the cache, misses from a single $in query.
+    Returns {ID: doc} for the IDs that exist.
+    """
+    found, missing = country_cache.get_many(dict.fromkeys(country_ids))
+    if missing:
+        found.update(fetch_countries(missing))
+    return found
+
+
 def add_country(country_id: str, name: str, capital: str, **extra_fields) -> None:
     """
     Add or update a country with all its fields.
@@ -75,13 +149,42 @@ def add_country(country_id: str, name: str, capital: str, **extra_fields) -> Non
         CAPITAL: capital,
         **extra_fields  # This adds any additional fields like nat_dish, pop_dish_1, etc.
     }
-    result = dbc.update(COUNTRY_COLLECTION, {ID: country_id}, doc)
-    if result.matched_count == 0:
-        dbc.create(COUNTRY_COLLECTION, doc)
-    load_cache()
+    # one atomic upsert; the doc it returns has every field, so it can
+    # go straight into the cache
+    country_cache.put(dbc.upsert(COUNTRY_COLLECTION, {ID: country_id}, doc))
+
+
+def country_doc(row: dict) -> dict:
+    """
+    Check an uploaded row, shaped like an /countries/add request, and
+    turn it into a country doc keyed by its country_code.
+    """
+    if not isinstance(row, dict):
+        raise ValueError("Row must be a JSON object")
+    missing = [fld for fld in REQUIRED_FLDS if not row.get(fld)]
+    if missing:
+        raise ValueError(f"Missing required fields: {', '.join(missing)}")
+    doc = {fld: val for fld, val in row.items() if fld not in (ID, COUNTRY_CODE)}
+    doc[ID] = row[COUNTRY_CODE]
+    return doc
+
+
+def add_countries(docs: list) -> list:
+    """
+    Upsert a batch of country docs in one round trip per chunk.
+    Later docs for the same country win.
+    If a doc fails, the ones written before it are still cached, and
+    the BulkWriteError is raised.
+    """
+    try:
+        results = dbc.upsert_many(COUNTRY_COLLECTION, docs, [ID], ordered=True)
+    except BulkWriteError as e:
+        country_cache.merge(dbc.written(docs, e, ordered=True))
+        raise
+    country_cache.merge(docs)
+    return results
 
 
-@needs_cache
 def search_country(keyword: str) -> dict:
     if not keyword:
         raise ValueError("Keyword must not be empty.")
@@ -89,7 +192,7 @@ def search_country(keyword: str) -> dict:
 
     return {
         cid: c
-        for cid, c in country_cache.items()
+        for cid, c in country_cache.as_dict().items()
         if isinstance(c.get(NAME), str) and keyword_lower in c[NAME].lower()
     }
 
@@ -98,54 +201,69 @@ def delete_country(country_id: str) -> bool:
     result = dbc.delete(COUNTRY_COLLECTION, {ID: country_id})
     if result < 1:
         raise ValueError(f"Country with id {country_id} not found.")
-    load_cache()
+    country_cache.evict(country_id)
     return True
 
 
-@needs_cache
 def get_capital_by_name(name: str) -> str:
-    for doc in country_cache.values():
-        if doc.get(NAME) == name:
-            return doc[CAPITAL]
-    raise ValueError(f"No country found with name {name}")
+    doc = find_by_name(name)
+    if doc is None:
+        raise ValueError(f"No country found with name {name}")
+    return doc[CAPITAL]
 
 
-@needs_cache
 def get_national_dish_by_name(name: str) -> str:
-    for doc in country_cache.values():
-        if doc.get(NAME) == name:
-            return doc.get(NATIONAL_DISH, "")
-    raise ValueError(f"No country found with name {name}")
+    doc = find_by_name(name)
+    if doc is None:
+        raise ValueError(f"No country found with name {name}")
+    return doc.get(NATIONAL_DISH, "")
 
 
-@needs_cache
 def get_popular_dishes_by_name(name: str) -> list:
-    for doc in country_cache.values():
-        if doc.get(NAME) == name:
-            dishes = []
-            if doc.get(POP_DISH_1):
-                dishes.append(doc[POP_DISH_1])
-            if doc.get(POP_DISH_2):
-                dishes.append(doc[POP_DISH_2])
-            return dishes
-    raise ValueError(f"No country found with name {name}")
-
-
-@needs_cache
+    doc = find_by_name(name)
+    if doc is None:
+        raise ValueError(f"No country found with name {name}")
+    dishes = []
+    if doc.get(POP_DISH_1):
+        dishes.append(doc[POP_DISH_1])
+    if doc.get(POP_DISH_2):
+        dishes.append(doc[POP_DISH_2])
+    return dishes
+
+
 def num_countries() -> int:
     return len(country_cache)
 
 
-@needs_cache
 def country_exists(name: str) -> bool:
-    if not isinstance(name, str):
-        return False
-    return any(doc.get(NAME) == name for doc in country_cache.values())
+    return find_by_name(name) is not None
 
 
-@needs_cache
 def read_all() -> dict:
-    return country_cache
+    return country_cache.as_dict()
+
+
+def read_page(limit: int, after: tuple = None) -> tuple:
+    """
+    Return (countries, next) for one page of countries in id order.
+    See Snapshot.page().
+    """
+    return country_cache.snapshot().page(limit, after)
+
+
+def iter_export(country_code: str = None):
+    """
+    Yield country docs, or just the one country_code, from the cache
+    when it is loaded and otherwise straight from a DB cursor.
+    """
+    cc = country_code.strip().upper() if country_code else None
+    if not country_cache.is_loaded():
+        filt = {ID: cc} if cc else {}
+        return dbc.iter_docs(COUNTRY_COLLECTION, filt=filt, no_id=False)
+    snap = country_cache.snapshot()
+    if cc:
+        return iter([snap.get(cc)] if cc in snap else [])
+    return iter(snap.docs.values())
 
 
 def is_valid_capital(capital: str) -> bool:
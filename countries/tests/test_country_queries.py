@@ -30,3 +30,56 @@ def test_read_all_structure():
     assert isinstance(data, dict)
     for key in data.keys():
         assert isinstance(key, (int, str))
+
+
+@pytest.fixture
+def test_cache():
+    docs = [
+        {'_id': 'ZZZ', 'name': 'zztest', 'capital': 'old', 'nat_dish': 'soup'},
+        {'_id': 'ZZY', 'name': 'Zztest Île', 'capital': 'port'},
+    ]
+    with patch('country_queries.dbc.iter_docs', return_value=iter(docs)):
+        country_queries.load_cache()
+    yield
+    country_queries.country_cache.clear()
+
+
+def test_add_country_writes_through(test_cache):
+    # the upsert returns the whole doc, including fields it didn't set
+    stored = {'_id': 'ZZZ', 'name': 'zztest', 'capital': 'new', 'nat_dish': 'soup'}
+    with patch('country_queries.dbc.upsert', return_value=stored), \
+            patch('country_queries.load_cache') as mock_load:
+        country_queries.add_country('ZZZ', 'zztest', 'new')
+        mock_load.assert_not_called()
+    country = country_queries.get_country('ZZZ')
+    assert country['capital'] == 'new'
+    assert country['nat_dish'] == 'soup'
+
+
+def test_name_lookups_normalized(test_cache):
+    assert country_queries.get_capital_by_name('zztest') == 'old'
+    assert country_queries.get_capital_by_name('ZZTEST') == 'old'
+    assert country_queries.get_capital_by_name('zztest  \u00eele') == 'port'
+    assert country_queries.country_exists('Zztest Île')
+    assert not country_queries.country_exists('zztest land')
+    with pytest.raises(ValueError):
+        country_queries.get_national_dish_by_name('zztest land')
+
+
+def test_name_index_follows_writes(test_cache):
+    with patch('country_queries.dbc.delete', return_value=1):
+        country_queries.delete_country('ZZZ')
+    assert not country_queries.country_exists('zztest')
+
+
+def test_get_country_fields(test_cache):
+    assert country_queries.get_country('ZZZ', ('name',)) == {'name': 'zztest'}
+
+
+def test_get_country_fields_pushed_down(test_cache):
+    country_queries.country_cache.bloom = None
+    with patch('country_queries.dbc.read_one', return_value={'name': 'x'}) as mock_read:
+        assert country_queries.get_country('ZZX', ('name',)) == {'name': 'x'}
+    mock_read.assert_called_once_with(country_queries.COUNTRY_COLLECTION, {'_id': 'ZZX'},
+                                      projection=('name',), no_id=True)
+    assert 'ZZX' not in country_queries.country_cache
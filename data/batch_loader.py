@@ -0,0 +1,84 @@
+"""
+Coalesces single-key DB reads into batched ones.
+
+When many threads miss the cache at once (a cold start, or right after
+an invalidation), each would otherwise send its own one-doc query.
+A BatchLoader instead collects the keys asked for within a short window,
+drops duplicates, reads them all with one call to its batch function and
+hands each caller its own doc.
+"""
+import os
+import threading
+from concurrent.futures import Future
+
+# how long the first caller of a batch waits for others to join it
+BATCH_WINDOW = float(os.getenv('MISS_BATCH_WINDOW_MS', 2)) / 1000
+# a batch this big is sent without waiting out the window
+MAX_BATCH = int(os.getenv('MISS_MAX_BATCH', 500))
+
+# keys of the stats dict
+LOADS = 'loads'
+BATCHES = 'batches'
+
+
+class BatchLoader:
+    """
+    batch_fn(keys) reads the docs for a list of distinct keys and returns
+    them as {key: doc}; keys it leaves out load as None.
+    The first caller of a batch waits up to window seconds, then sends the
+    batch for everyone in it. An exception from batch_fn is raised to
+    every caller of that batch.
+    """
+    def __init__(self, batch_fn, window: float = BATCH_WINDOW,
+                 max_batch: int = MAX_BATCH):
+        self.batch_fn = batch_fn
+        self.window = window
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        # {key: Future} for the batch being collected
+        self.pending = {}
+        self.batch_full = threading.Event()
+        self.stats = {LOADS: 0, BATCHES: 0}
+
+    def load(self, key):
+        """
+        Return the doc for key, or None if there is none.
+        """
+        with self.lock:
+            self.stats[LOADS] += 1
+            future = self.pending.get(key)
+            leader = future is None and not self.pending
+            if future is None:
+                future = Future()
+                self.pending[key] = future
+                if len(self.pending) >= self.max_batch:
+                    self.batch_full.set()
+        if leader:
+            if self.window:
+                self.batch_full.wait(self.window)
+            self.dispatch()
+        return future.result()
+
+    def dispatch(self):
+        """
+        Send the batch collected so far and resolve its futures.
+        """
+        with self.lock:
+            batch, self.pending = self.pending, {}
+            self.batch_full.clear()
+            if batch:
+                self.stats[BATCHES] += 1
+        if not batch:
+            return
+        try:
+            docs = self.batch_fn(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                future.set_exception(e)
+            return
+        for key, future in batch.items():
+            future.set_result(docs.get(key))
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return dict(self.stats)
@@ -0,0 +1,50 @@
+"""
+A Bloom filter: a compact set that can say an item is definitely not
+in it, or that it may be.
+"""
+import hashlib
+import math
+
+DEFAULT_ERROR_RATE = 0.01
+
+
+class BloomFilter:
+    """
+    Sized for capacity items at a false positive rate of error_rate.
+    Items are hashed by their repr(), so str, int and tuples of them work.
+    There are no false negatives: anything added is always "maybe in".
+    """
+    def __init__(self, capacity: int, error_rate: float = DEFAULT_ERROR_RATE):
+        if capacity < 1:
+            raise ValueError(f'Bad value for {capacity=}')
+        if not 0 < error_rate < 1:
+            raise ValueError(f'Bad value for {error_rate=}')
+        self.capacity = capacity
+        self.nbits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.nhashes = max(1, round(self.nbits / capacity * math.log(2)))
+        self.bits = bytearray((self.nbits + 7) // 8)
+        self.count = 0
+
+    def positions(self, item):
+        # double hashing: the i-th position is h1 + i * h2
+        digest = hashlib.blake2b(repr(item).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.nbits for i in range(self.nhashes)]
+
+    def add(self, item):
+        for pos in self.positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self.positions(item))
+
+    def __len__(self) -> int:
+        """The number of adds, counting repeats."""
+        return self.count
+
+    def is_full(self) -> bool:
+        """Past capacity the false positive rate climbs above error_rate."""
+        return self.count > self.capacity
@@ -0,0 +1,697 @@
+"""
+An in-memory cache of a whole DB collection.
+Each query module builds one CollectionCache for its collection, then
+writes its changes through to it instead of re-reading the collection.
+
+The cached data lives in an immutable Snapshot. Reloads and writes build
+a new snapshot off to the side and publish it with a single reference
+swap, so a reader holding a snapshot never sees a half-built cache.
+"""
+import hashlib
+import json
+import os
+from bisect import bisect_right
+from collections import OrderedDict
+import threading
+import time
+
+import data.db_connect as dbc
+from data.bloom import BloomFilter
+
+# Freshness policy: a cache older than this many seconds is refreshed on
+# its next use. 0 means only refresh on load() or invalidate().
+MAX_STALENESS = float(os.getenv('CACHE_MAX_STALENESS', 300)) or None
+# Refresh stale caches in a background thread, serving the old snapshot
+# meanwhile, instead of making the request that noticed wait for it.
+BACKGROUND_REFRESH = os.getenv('CACHE_BACKGROUND_REFRESH', '1') == '1'
+# Keys known not to be in the DB are remembered for this many seconds,
+# at most NEGATIVE_MAX of them, so repeated misses don't go to the DB.
+NEGATIVE_TTL = float(os.getenv('CACHE_NEGATIVE_TTL', 60))
+NEGATIVE_MAX = int(os.getenv('CACHE_NEGATIVE_MAX', 10000))
+# False positive rate of the Bloom filter over the cached keys.
+BLOOM_ERROR_RATE = float(os.getenv('CACHE_BLOOM_ERROR_RATE', 0.01))
+# The filter is sized for this many times the keys loaded (at least
+# BLOOM_MIN_CAPACITY), leaving room for writes before it is rebuilt.
+BLOOM_HEADROOM = 2
+BLOOM_MIN_CAPACITY = 1024
+
+# keys of the stats dict
+HITS = 'hits'
+MISSES = 'misses'
+RELOADS = 'reloads'
+LOAD_ERRORS = 'load_errors'
+SIZE = 'size'
+GENERATION = 'generation'
+NEG_HITS = 'negative_hits'
+NEG_EVICTIONS = 'negative_evictions'
+NEG_SIZE = 'negative_size'
+BLOOM_SKIPS = 'bloom_skips'
+UNCHANGED_WRITES = 'unchanged_writes'
+
+# write operations remembered while a reload is running
+PUT = 'put'
+EVICT = 'evict'
+MERGE = 'merge'
+
+
+def sort_key(key) -> tuple:
+    """
+    The order pages are served in. Key parts are compared as strings,
+    so keys of mixed types (e.g. int and str ids) still sort.
+    """
+    if isinstance(key, tuple):
+        return tuple(str(part) for part in key)
+    return (str(key),)
+
+
+def content_hash(doc: dict) -> str:
+    """
+    A digest of the fields and values of doc, whatever their order.
+    """
+    text = json.dumps(doc, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+def entry_digest(key, doc_hash: str) -> int:
+    """
+    One doc's share of a snapshot's content digest. The shares are
+    XORed together, so the digest doesn't depend on the order of the
+    docs and can be updated a doc at a time.
+    """
+    digest = hashlib.blake2b(f'{key!r}:{doc_hash}'.encode(), digest_size=16).digest()
+    return int.from_bytes(digest, 'big')
+
+
+class Snapshot:
+    """
+    One published version of the cache: the docs by key, the secondary
+    indexes as {index name: {index key: {key: doc}}}, and the generation
+    and wall-clock time at which it was published.
+    Nothing in a snapshot is modified once it is published.
+    """
+    def __init__(self, docs: dict, indexes: dict, generation: int,
+                 hashes: dict = None, digest: int = None):
+        self.docs = docs
+        self.indexes = indexes
+        self.generation = generation
+        self.modified_at = time.time()
+        # {name: value} for derived()
+        self.derived_vals = {}
+        # {key: content_hash(doc)}; loads fill it in, writes keep it up to
+        # date, and any missing are worked out as they are asked for
+        self.hashes = {} if hashes is None else hashes
+        # XOR of entry_digest() over the docs, worked out when first
+        # asked for if the publisher didn't
+        self.digest = digest
+
+    def get(self, key, default=None):
+        return self.docs.get(key, default)
+
+    def content_hash(self, key):
+        """
+        The content_hash() of the doc under key, or None if there is none.
+        Worked out once per doc, and kept by later snapshots until the
+        doc is written.
+        """
+        digest = self.hashes.get(key)
+        if digest is None and key in self.docs:
+            digest = self.hashes[key] = content_hash(self.docs[key])
+        return digest
+
+    def content_digest(self) -> str:
+        """
+        A digest of every key and doc in the snapshot. It changes when
+        the content does, and is the same for the same docs in any
+        process, so it makes a good ETag.
+        """
+        if self.digest is None:
+            digest = 0
+            for key in self.docs:
+                digest ^= entry_digest(key, self.content_hash(key))
+            self.digest = digest
+        return f'{self.digest:032x}'
+
+    def __contains__(self, key) -> bool:
+        return key in self.docs
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def lookup(self, index_name: str, index_key) -> dict:
+        """
+        Return {key: doc} for every doc under index_key.
+        """
+        return self.indexes[index_name].get(index_key, {})
+
+    def derived(self, name: str, build_fn):
+        """
+        Return build_fn(docs), computed at most once per snapshot.
+        Use it for views of the whole cache, e.g. re-keyed or sorted.
+        """
+        if name not in self.derived_vals:
+            self.derived_vals[name] = build_fn(self.docs)
+        return self.derived_vals[name]
+
+    def sorted_keys(self, index_name: str = None, index_key=None) -> tuple:
+        """
+        Return (sort keys, keys) in sort_key() order for the whole cache,
+        or for one index bucket. Built once per snapshot.
+        """
+        name = ('sorted', index_name, index_key)
+        if name not in self.derived_vals:
+            if index_name is None:
+                items = self.docs
+            else:
+                items = self.lookup(index_name, index_key)
+            keys = sorted(items, key=sort_key)
+            self.derived_vals[name] = ([sort_key(key) for key in keys], keys)
+        return self.derived_vals[name]
+
+    def page(self, limit: int, after: tuple = None, index_name: str = None,
+             index_key=None) -> tuple:
+        """
+        Keyset pagination: return (docs, next) for up to limit docs whose
+        sort keys come after the sort key after (None for the first page).
+        next is the sort key to pass as after for the following page,
+        or None on the last page. Costs O(log n + limit).
+        """
+        sort_keys, keys = self.sorted_keys(index_name, index_key)
+        start = 0 if after is None else bisect_right(sort_keys, tuple(after))
+        end = start + limit
+        docs = [self.docs[key] for key in keys[start:end]]
+        return docs, (sort_keys[end - 1] if end < len(keys) else None)
+
+
+class CollectionCache:
+    """
+    Holds the docs of one collection keyed by key_fn(doc), plus any
+    secondary indexes declared as {index name: fn(doc) -> index key}.
+    A key_fn or index fn returning None leaves the doc out.
+
+    The cache loads itself on first use, and refreshes itself once it is
+    older than ttl seconds (None means never) or has been invalidated.
+    With background_refresh the refresh runs in its own thread and
+    requests keep being answered from the old snapshot.
+    Only one reload runs at a time: callers with no snapshot yet wait for
+    it, everyone else keeps reading the old snapshot until it is done.
+    Every change bumps generation, so callers can tell when what they
+    derived from the cache is out of date.
+
+    Keys the DB was found not to have can be remembered with
+    remember_missing() for negative_ttl seconds (LRU-bounded by
+    negative_max); any write of the key, or a reload, forgets them.
+
+    changed() compares docs about to be written with the cached ones, by
+    content hash, so that writes that change nothing can be skipped.
+
+    With bloom, a Bloom filter over the keys is rebuilt by each load and
+    added to by each write, so might_contain() can rule a key out of the
+    collection without a DB read. It is as current as the cache is.
+    """
+    def __init__(self, collection: str, key_fn, indexes: dict = None,
+                 no_id: bool = True, ttl: float = MAX_STALENESS,
+                 background_refresh: bool = BACKGROUND_REFRESH, loader=None,
+                 negative_ttl: float = NEGATIVE_TTL, negative_max: int = NEGATIVE_MAX,
+                 bloom: bool = True):
+        self.collection = collection
+        self.key_fn = key_fn
+        self.index_fns = indexes or {}
+        self.no_id = no_id
+        self.ttl = ttl
+        self.background_refresh = background_refresh
+        self.loader = loader or self.read_collection
+        self.current = None
+        self.generation = 0
+        self.loaded_at = None
+        self.stats = {HITS: 0, MISSES: 0, RELOADS: 0, LOAD_ERRORS: 0,
+                      NEG_HITS: 0, NEG_EVICTIONS: 0, BLOOM_SKIPS: 0,
+                      UNCHANGED_WRITES: 0}
+        self.negative_ttl = negative_ttl
+        self.negative_max = negative_max
+        # {missing key: monotonic time it expires}, oldest first
+        self.negative = OrderedDict()
+        self.use_bloom = bloom
+        # None until a load has read the whole collection
+        self.bloom = None
+        # serializes publishing snapshots
+        self.lock = threading.RLock()
+        # held by the one reload in flight
+        self.load_lock = threading.Lock()
+        self.loading = False
+        self.refreshing = False
+        self.invalidated = False
+        # writes made while a reload is in flight, replayed onto its result
+        self.pending = []
+
+    def read_collection(self):
+        return dbc.iter_docs(self.collection, no_id=self.no_id)
+
+    def is_loaded(self) -> bool:
+        return self.current is not None
+
+    def is_stale(self) -> bool:
+        if not self.is_loaded() or self.invalidated:
+            return True
+        if self.ttl is None:
+            return False
+        return time.monotonic() - self.loaded_at > self.ttl
+
+    def snapshot(self) -> Snapshot:
+        """
+        The current snapshot, loading or refreshing it if need be.
+        Take one snapshot and use it for a whole request to get a
+        consistent view.
+        """
+        snap = self.current
+        while snap is None:
+            self.load()
+            snap = self.current
+        if self.is_stale():
+            if self.background_refresh:
+                self.refresh_in_background()
+            else:
+                self.load(wait=False)
+                snap = self.current or snap
+        return snap
+
+    def refresh_in_background(self):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+
+        def refresh():
+            try:
+                self.load(wait=False)
+            finally:
+                self.refreshing = False
+        threading.Thread(target=refresh, daemon=True,
+                         name=f'{self.collection}-cache-refresh').start()
+
+    def invalidate(self):
+        """
+        Mark the cache stale: the next use refreshes it, under the same
+        policy as an expired ttl.
+        """
+        self.invalidated = True
+
+    def version(self) -> str:
+        """
+        The content digest of the snapshot in use, after applying the
+        freshness policy (so this may load or refresh the cache).
+        Every process holding the same docs gives the same version.
+        """
+        return self.snapshot().content_digest()
+
+    def ensure_loaded(self):
+        self.snapshot()
+
+    def load(self, wait: bool = True):
+        """
+        Re-read the whole collection and publish it as a new snapshot.
+        If a reload is already running, wait for it (or, with wait=False,
+        return at once) rather than start another.
+        If the DB can't be read we keep what we had, or start empty, so
+        that callers (and unit tests) work without a running MongoDB.
+        """
+        if not self.load_lock.acquire(blocking=False):
+            if wait:
+                with self.load_lock:
+                    pass
+            return
+        try:
+            with self.lock:
+                self.loading = True
+                self.pending = []
+            new_docs = {}
+            ok = True
+            try:
+                for doc in self.loader():
+                    self.add_doc(new_docs, None, doc)
+                # hash here, not in the first request to ask for a digest
+                hashes, digest = self.hash_docs(new_docs)
+            except Exception as e:
+                print(f'Error loading {self.collection} from DB: {e}')
+                self.stats[LOAD_ERRORS] += 1
+                ok = False
+            with self.lock:
+                if ok:
+                    for op, arg in self.pending:
+                        key = arg if op == EVICT else self.key_fn(self.prepare(arg))
+                        if key is None:
+                            continue
+                        if key in new_docs:
+                            digest ^= entry_digest(key, hashes.pop(key))
+                        if op == PUT:
+                            self.add_doc(new_docs, None, arg)
+                        elif op == MERGE:
+                            new_docs[key] = {**new_docs.get(key, {}), **self.prepare(arg)}
+                        else:
+                            new_docs.pop(key, None)
+                        if key in new_docs:
+                            hashes[key] = content_hash(new_docs[key])
+                            digest ^= entry_digest(key, hashes[key])
+                    self.publish(new_docs, self.build_indexes(new_docs), hashes, digest)
+                    self.negative.clear()
+                    self.bloom = self.build_bloom(new_docs)
+                elif self.current is None:
+                    self.publish({}, self.build_indexes({}))
+                self.loaded_at = time.monotonic()
+                self.invalidated = False
+                self.stats[RELOADS] += 1
+                self.loading = False
+                self.pending = []
+        finally:
+            self.load_lock.release()
+
+    def hash_docs(self, docs: dict) -> tuple:
+        """
+        Return ({key: content_hash(doc)}, content digest) for docs,
+        reusing the hashes the current snapshot has for docs that are
+        the same as its own.
+        """
+        old = self.current
+        hashes = {}
+        digest = 0
+        for key, doc in docs.items():
+            doc_hash = None
+            if old is not None and old.docs.get(key) == doc:
+                doc_hash = old.hashes.get(key)
+            if doc_hash is None:
+                doc_hash = content_hash(doc)
+            hashes[key] = doc_hash
+            digest ^= entry_digest(key, doc_hash)
+        return hashes, digest
+
+    def publish(self, docs: dict, indexes: dict, hashes: dict = None,
+                digest: int = None):
+        self.generation += 1
+        self.current = Snapshot(docs, indexes, self.generation, hashes, digest)
+
+    def clear(self):
+        """
+        Forget everything, so the next use reloads.
+        """
+        with self.lock:
+            self.current = None
+            self.generation += 1
+            self.negative.clear()
+            self.bloom = None
+
+    def build_bloom(self, docs: dict):
+        if not self.use_bloom:
+            return None
+        capacity = max(BLOOM_HEADROOM * len(docs), BLOOM_MIN_CAPACITY)
+        bloom = BloomFilter(capacity, BLOOM_ERROR_RATE)
+        for key in docs:
+            bloom.add(key)
+        return bloom
+
+    def might_contain(self, key) -> bool:
+        """
+        False if key is definitely not in the collection (as of the last
+        load plus our writes since), True if it may be.
+        """
+        bloom = self.bloom
+        if bloom is None or key in bloom:
+            return True
+        self.stats[BLOOM_SKIPS] += 1
+        return False
+
+    def prepare(self, doc: dict) -> dict:
+        if self.no_id and dbc.MONGO_ID in doc:
+            doc = {k: v for k, v in doc.items() if k != dbc.MONGO_ID}
+        return doc
+
+    def add_doc(self, docs: dict, indexes, doc: dict, copied=None):
+        """
+        Add doc to docs, and to indexes unless that is None.
+        """
+        doc = self.prepare(doc)
+        key = self.key_fn(doc)
+        if key is None:
+            return
+        if indexes is not None:
+            self.remove_doc(docs, indexes, key, copied)
+            self.index_add(indexes, key, doc, copied)
+        docs[key] = doc
+
+    def remove_doc(self, docs: dict, indexes: dict, key, copied=None):
+        old = docs.pop(key, None)
+        if old is not None:
+            self.index_remove(indexes, key, old, copied)
+
+    def build_indexes(self, docs: dict) -> dict:
+        indexes = {name: {} for name in self.index_fns}
+        for key, doc in docs.items():
+            self.index_add(indexes, key, doc)
+        return indexes
+
+    def writable_bucket(self, indexes: dict, name: str, index_key, copied):
+        """
+        Get the bucket for index_key, copying it first if it still
+        belongs to a published snapshot (copied is not None).
+        """
+        bucket = indexes[name].get(index_key)
+        if copied is not None and (name, index_key) not in copied:
+            bucket = dict(bucket) if bucket is not None else {}
+            indexes[name][index_key] = bucket
+            copied.add((name, index_key))
+        elif bucket is None:
+            bucket = indexes[name][index_key] = {}
+        return bucket
+
+    def index_add(self, indexes: dict, key, doc: dict, copied=None):
+        for name, index_fn in self.index_fns.items():
+            index_key = index_fn(doc)
+            if index_key is not None:
+                self.writable_bucket(indexes, name, index_key, copied)[key] = doc
+
+    def index_remove(self, indexes: dict, key, doc: dict, copied=None):
+        for name, index_fn in self.index_fns.items():
+            index_key = index_fn(doc)
+            if index_key not in indexes[name]:
+                continue
+            bucket = self.writable_bucket(indexes, name, index_key, copied)
+            bucket.pop(key, None)
+            if not bucket:
+                del indexes[name][index_key]
+
+    def get(self, key, default=None):
+        doc = self.snapshot().get(key)
+        if doc is None:
+            self.stats[MISSES] += 1
+            return default
+        self.stats[HITS] += 1
+        return doc
+
+    def get_many(self, keys) -> tuple:
+        """
+        Look keys up in one snapshot.
+        Returns ({key: doc} for the cached keys, [keys that aren't cached
+        but might be in the DB]).
+        """
+        snap = self.snapshot()
+        found = {}
+        missing = []
+        misses = 0
+        for key in keys:
+            doc = snap.get(key)
+            if doc is not None:
+                found[key] = doc
+                continue
+            misses += 1
+            if self.might_contain(key) and not self.is_known_missing(key):
+                missing.append(key)
+        self.stats[HITS] += len(found)
+        self.stats[MISSES] += misses
+        return found, missing
+
+    def __contains__(self, key) -> bool:
+        return key in self.snapshot()
+
+    def __len__(self) -> int:
+        return len(self.snapshot())
+
+    def as_dict(self) -> dict:
+        """
+        The cached docs by key. Callers must not modify it.
+        """
+        return self.snapshot().docs
+
+    def lookup(self, index_name: str, index_key) -> dict:
+        """
+        Return {key: doc} for every cached doc under index_key.
+        """
+        return self.snapshot().lookup(index_name, index_key)
+
+    def derived(self, name: str, build_fn):
+        """
+        Return build_fn(docs), computed at most once per generation.
+        """
+        return self.snapshot().derived(name, build_fn)
+
+    def write(self, puts=(), evicts=()):
+        """
+        Evict the keys in evicts, then write the docs in puts through to
+        the cache, replacing any cached versions, as one new snapshot.
+        While a load is running the writes are also kept for it to replay
+        onto what it read, even when there is no snapshot yet. Otherwise a
+        cache that isn't loaded ignores them: the next use loads it.
+        This copies the key map, so batch writes into one call.
+        """
+        with self.lock:
+            for doc in puts:
+                self.negative.pop(self.key_fn(self.prepare(doc)), None)
+            if self.loading:
+                self.pending.extend((EVICT, key) for key in evicts)
+                self.pending.extend((PUT, doc) for doc in puts)
+            snap = self.current
+            if snap is None:
+                return
+            docs = dict(snap.docs)
+            indexes = {name: dict(index) for name, index in snap.indexes.items()}
+            hashes = dict(snap.hashes)
+            copied = set()
+            touched = set()
+            for key in evicts:
+                self.remove_doc(docs, indexes, key, copied)
+                hashes.pop(key, None)
+                touched.add(key)
+            for doc in puts:
+                self.add_doc(docs, indexes, doc, copied)
+                key = self.key_fn(self.prepare(doc))
+                hashes.pop(key, None)
+                touched.add(key)
+            self.publish(docs, indexes, hashes,
+                         self.update_digest(snap, docs, hashes, touched))
+            if self.bloom is not None:
+                for doc in puts:
+                    self.bloom.add(self.key_fn(self.prepare(doc)))
+                if self.bloom.is_full():
+                    self.bloom = self.build_bloom(docs)
+
+    def update_digest(self, snap: Snapshot, docs: dict, hashes: dict, touched: set):
+        """
+        The content digest of docs, worked out from that of snap by
+        swapping the shares of the touched keys, or None if snap's
+        digest isn't known yet.
+        """
+        digest = snap.digest
+        if digest is None:
+            return None
+        for key in touched:
+            if key in snap.docs:
+                digest ^= entry_digest(key, snap.content_hash(key))
+            if key in docs:
+                hashes[key] = content_hash(docs[key])
+                digest ^= entry_digest(key, hashes[key])
+        return digest
+
+    def put(self, doc: dict):
+        """
+        Write a doc through to the cache, replacing any cached version.
+        """
+        self.write(puts=[doc])
+
+    def merge(self, docs):
+        """
+        Write docs that were $set on the DB through to the cache: the
+        fields of each doc are laid over those of its cached version,
+        in order, so later docs for the same key win.
+        """
+        with self.lock:
+            snap = self.current
+            if snap is None:
+                if self.loading:
+                    # no cached versions to lay them over yet; the load does
+                    self.pending.extend((MERGE, doc) for doc in docs)
+                return
+            merged = {}
+            for doc in docs:
+                key = self.key_fn(doc)
+                if key is None:
+                    continue
+                base = merged.get(key) or snap.get(key) or {}
+                merged[key] = {**base, **self.prepare(doc)}
+            self.write(puts=list(merged.values()))
+
+    def changed(self, docs) -> list:
+        """
+        Return the docs that would change what is stored: a key's docs
+        are dropped if, laid over its cached version in order (as $set
+        does), they leave its content hash as it was.
+        Only a fresh cache is trusted to tell, so when it is stale or not
+        loaded, or a key isn't cached, the docs are all kept.
+        """
+        docs = list(docs)
+        snap = self.current
+        if snap is None or self.is_stale():
+            return docs
+        keys = [self.key_fn(self.prepare(doc)) for doc in docs]
+        merged = {}
+        for key, doc in zip(keys, docs):
+            if key is not None and key in snap:
+                merged[key] = {**merged.get(key, snap.get(key)), **self.prepare(doc)}
+        same = {key for key, doc in merged.items()
+                if content_hash(doc) == snap.content_hash(key)}
+        kept = [doc for key, doc in zip(keys, docs) if key not in same]
+        self.stats[UNCHANGED_WRITES] += len(docs) - len(kept)
+        return kept
+
+    def unchanged(self, doc: dict) -> bool:
+        """
+        Would writing doc leave its cached version as it is?
+        See changed().
+        """
+        return not self.changed([doc])
+
+    def evict(self, key):
+        snap = self.current
+        if self.loading or (snap is not None and key in snap):
+            self.write(evicts=[key])
+
+    def refresh(self, key, filt: dict):
+        """
+        Re-read a single doc whose cached copy is known to be out of date.
+        """
+        doc = dbc.read_one(self.collection, filt, no_id=self.no_id)
+        if doc is None:
+            self.evict(key)
+        else:
+            self.put(doc)
+
+    def is_known_missing(self, key) -> bool:
+        """
+        Was key recently found not to be in the DB?
+        """
+        with self.lock:
+            expires = self.negative.get(key)
+            if expires is None:
+                return False
+            if expires <= time.monotonic():
+                del self.negative[key]
+                return False
+            self.negative.move_to_end(key)
+            self.stats[NEG_HITS] += 1
+            return True
+
+    def remember_missing(self, key):
+        """
+        Note that the DB has no doc for key.
+        """
+        if not self.negative_ttl or not self.negative_max:
+            return
+        with self.lock:
+            self.negative[key] = time.monotonic() + self.negative_ttl
+            self.negative.move_to_end(key)
+            while len(self.negative) > self.negative_max:
+                self.negative.popitem(last=False)
+                self.stats[NEG_EVICTIONS] += 1
+
+    def get_stats(self) -> dict:
+        stats = dict(self.stats)
+        stats[NEG_SIZE] = len(self.negative)
+        stats[SIZE] = len(self.current) if self.is_loaded() else 0
+        stats[GENERATION] = self.generation
+        return stats
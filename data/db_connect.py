@@ -1,20 +1,39 @@
 """
 All interaction with MongoDB should be through this file!
 We may be required to use a new database at any point.
+
+SENS_STORAGE picks the storage engine: mongo (the default), memory or
+sqlite. The other engines, in data/storage.py, stand in for the
+MongoClient, so nothing below needs to know which one is in use.
 """
 import os
+import threading
 import certifi
 from functools import wraps
+from inspect import isgeneratorfunction
 import pymongo as pm
 from pymongo.errors import (
+    BulkWriteError,
     ConnectionFailure,
     ServerSelectionTimeoutError,
     PyMongoError,
 )
 
+from data import storage
+from data.storage import COLLSCAN, Index, register_indexes  # noqa: F401
+
 LOCAL = "0"
 CLOUD = "1"
 
+MONGO = 'mongo'
+MEMORY = 'memory'
+SQLITE = 'sqlite'
+STORAGE_ENGINES = (MONGO, MEMORY, SQLITE)
+STORAGE = os.getenv('SENS_STORAGE', MONGO).strip().lower() or MONGO
+if STORAGE not in STORAGE_ENGINES:
+    raise ValueError(f'SENS_STORAGE must be one of {STORAGE_ENGINES}, not {STORAGE!r}')
+SQLITE_PATH = os.getenv('SENS_SQLITE_PATH', 'sens.db')
+
 SENS_DB = os.getenv('MONGO_DB', 'sensDB')
 user_nm = os.getenv('MONGO_USER_NM', 'datamixmaster')
 cloud_svc = os.getenv('MONGO_HOST', 'datamixmaster.Z6rvk.mongodb.net')
@@ -26,23 +45,132 @@ MONGO_ID = '_id'
 
 MIN_ID_LEN = 4
 
+# default number of operations sent per bulk_write() call
+BULK_CHUNK_SIZE = int(os.getenv('MONGO_BULK_CHUNK_SIZE', 1000))
+
+# number of docs per cursor batch when streaming a collection
+ITER_BATCH_SIZE = int(os.getenv('MONGO_BATCH_SIZE', 1000))
+
+# keys of the per-chunk counts returned by the bulk operations
+INSERTED = 'inserted'
+MATCHED = 'matched'
+MODIFIED = 'modified'
+UPSERTED = 'upserted'
+DELETED = 'deleted'
+# the counts in a BulkWriteError's details, by our name for them
+ERROR_COUNTS = {
+    INSERTED: 'nInserted',
+    MATCHED: 'nMatched',
+    MODIFIED: 'nModified',
+    UPSERTED: 'nUpserted',
+    DELETED: 'nRemoved',
+}
+WRITE_ERRORS = 'writeErrors'
+
+# keys of the per-collection ensure_indexes() report
+CREATED = 'created'
+FAILED = 'failed'
+COLLSCANS = 'collscans'
+
 # parameter names of mongo client settings
 SERVER_API_PARAM = 'server_api'
 CONN_TIMEOUT = 'connectTimeoutMS'
 SOCK_TIMEOUT = 'socketTimeoutMS'
 CONNECT = 'connect'
 MAX_POOL_SIZE = 'maxPoolSize'
+MIN_POOL_SIZE = 'minPoolSize'
+MAX_IDLE_TIME = 'maxIdleTimeMS'
+COMPRESSORS = 'compressors'
+READ_PREFERENCE = 'readPreference'
 
-# reccomended pythoneverywhere settings
-PA_MONGO = os.getenv('PA_MONGO0', True)
-PA_SETTINGS = {
-    CONN_TIMEOUT: os.getenv('MONGO_CONN_TIMEOUT', 30000),
-    SOCK_TIMEOUT: os.getenv("MONGO_SOCK_TIMEOUT", None),
-    CONNECT: os.getenv('MONGO_CONNECT', False),
-    MAX_POOL_SIZE: os.getenv('MONGO_MAX_POOL_SIZE', 1),
+WIRE_COMPRESSORS = ('zstd', 'snappy', 'zlib')
+READ_PREFERENCES = ('primary', 'primaryPreferred', 'secondary',
+                    'secondaryPreferred', 'nearest')
+
+TRUE_VALS = ('1', 'true', 'yes', 'on')
+FALSE_VALS = ('0', 'false', 'no', 'off')
+
+
+def env_int(name: str, default=None, minimum: int = 0):
+    """
+    Read an integer setting from the environment.
+    Raises ValueError if it is set to anything else.
+    """
+    raw = os.getenv(name, '').strip()
+    if not raw:
+        return default
+    try:
+        val = int(raw)
+    except ValueError:
+        raise ValueError(f'{name} must be an integer, not {raw!r}')
+    if val < minimum:
+        raise ValueError(f'{name} must be at least {minimum}, not {val}')
+    return val
+
+
+def env_bool(name: str, default: bool = False) -> bool:
+    raw = os.getenv(name, '').strip().lower()
+    if not raw:
+        return default
+    if raw in TRUE_VALS:
+        return True
+    if raw in FALSE_VALS:
+        return False
+    raise ValueError(f'{name} must be one of {TRUE_VALS + FALSE_VALS}, not {raw!r}')
+
+
+# reccomended pythoneverywhere settings, for whatever the environment
+# doesn't set
+PA_DEFAULTS = {
+    CONN_TIMEOUT: 30000,
+    CONNECT: False,
+    MAX_POOL_SIZE: 1,
 }
 
 
+def client_settings(defaults: dict = PA_DEFAULTS) -> dict:
+    """
+    Read the MongoClient connection and pool settings from the
+    environment, as the types MongoClient expects. Only read when a
+    client is made, so bad settings don't stop the module importing.
+    Settings the environment doesn't set come from defaults, or are
+    left to the driver.
+    Raises ValueError naming the first bad setting.
+    """
+    settings = {
+        CONN_TIMEOUT: env_int('MONGO_CONN_TIMEOUT', defaults.get(CONN_TIMEOUT), minimum=1),
+        SOCK_TIMEOUT: env_int('MONGO_SOCK_TIMEOUT', defaults.get(SOCK_TIMEOUT), minimum=1),
+        CONNECT: env_bool('MONGO_CONNECT', defaults.get(CONNECT)),
+        MAX_POOL_SIZE: env_int('MONGO_MAX_POOL_SIZE', defaults.get(MAX_POOL_SIZE), minimum=1),
+        MIN_POOL_SIZE: env_int('MONGO_MIN_POOL_SIZE', defaults.get(MIN_POOL_SIZE)),
+        MAX_IDLE_TIME: env_int('MONGO_MAX_IDLE_MS', defaults.get(MAX_IDLE_TIME), minimum=1),
+        READ_PREFERENCE: os.getenv('MONGO_READ_PREFERENCE', '').strip() or defaults.get(READ_PREFERENCE),
+    }
+    min_pool, max_pool = settings[MIN_POOL_SIZE], settings[MAX_POOL_SIZE]
+    if None not in (min_pool, max_pool) and min_pool > max_pool:
+        raise ValueError('MONGO_MIN_POOL_SIZE must not be more than MONGO_MAX_POOL_SIZE')
+    if settings[READ_PREFERENCE] not in READ_PREFERENCES + (None,):
+        raise ValueError(f'MONGO_READ_PREFERENCE must be one of {READ_PREFERENCES}')
+    compressors = [comp.strip() for comp in os.getenv('MONGO_COMPRESSORS', '').split(',')
+                   if comp.strip()]
+    unknown = [comp for comp in compressors if comp not in WIRE_COMPRESSORS]
+    if unknown:
+        raise ValueError(f'Unknown MONGO_COMPRESSORS {unknown}; use {WIRE_COMPRESSORS}')
+    if compressors:
+        settings[COMPRESSORS] = ','.join(compressors)
+    return {param: val for param, val in settings.items() if val is not None}
+
+
+PA_MONGO = os.getenv('PA_MONGO0', True)
+
+# Open a connection as soon as a process (or forked worker) starts,
+# rather than on its first request.
+WARM_UP = env_bool('MONGO_WARM_UP', False)
+
+# Have the server run ensure_indexes() when it starts.
+ENSURE_INDEXES = env_bool('MONGO_ENSURE_INDEXES', False)
+
+
 def is_valid_id(_id: str) -> bool:
     if not isinstance(_id, str):
         return False
@@ -60,22 +188,35 @@ def needs_db(fn, *args, **kwargs):
     return wrapper
 
 
+def report_error(e: Exception):
+    if isinstance(e, ServerSelectionTimeoutError):
+        print(f"MongoDB server selection timeout: {e}")
+    elif isinstance(e, ConnectionFailure):
+        print(f"MongoDB connection failed: {e}")
+    elif isinstance(e, PyMongoError):
+        print(f"MongoDB error: {e}")
+    else:
+        print(f"Unexpected error: {e}")
+
+
 def handling_errors(fn):
+    if isgeneratorfunction(fn):
+        # errors in a generator surface while it is consumed, not called
+        @wraps(fn)
+        def gen_wrapper(*args, **kwargs):
+            try:
+                yield from fn(*args, **kwargs)
+            except Exception as e:
+                report_error(e)
+                raise
+        return gen_wrapper
+
     @wraps(fn)
     def wrapper(*args, **kwargs):
         try:
             return fn(*args, **kwargs)
-        except ConnectionFailure as e:
-            print(f"MongoDB connection failed: {e}")
-            raise
-        except ServerSelectionTimeoutError as e:
-            print(f"MongoDB server selection timeout: {e}")
-            raise
-        except PyMongoError as e:
-            print(f"MongoDB error: {e}")
-            raise
         except Exception as e:
-            print(f"Unexpected error: {e}")
+            report_error(e)
             raise
     return wrapper
 
@@ -92,18 +233,65 @@ def connect_db():
     global client
     if client is None:  # not connected yet!
         print('Setting client because it is None.')
-        if os.environ.get('CLOUD_MONGO', LOCAL) == CLOUD:
+        if STORAGE == MEMORY:
+            print('Keeping the DB in memory.')
+            client = storage.MemoryClient()
+        elif STORAGE == SQLITE:
+            print(f'Using SQLite at {SQLITE_PATH}.')
+            client = storage.SQLiteClient(SQLITE_PATH)
+        elif os.environ.get('CLOUD_MONGO', LOCAL) == CLOUD:
             password = os.environ.get('MONGO_PASSWD')
             if not password:
                 raise ValueError('You must set your password ' + 'to use Mongo in the cloud.')
             print('Connecting to Mongo in the cloud.')
-            client = pm.MongoClient(f'{cloud_mdb}://{user_nm}:{password}' + f'@{cloud_svc}/' + f'?{db_params}', tlsCAFile=certifi.where(), **PA_SETTINGS)
+            client = pm.MongoClient(f'{cloud_mdb}://{user_nm}:{password}' + f'@{cloud_svc}/' + f'?{db_params}', tlsCAFile=certifi.where(), **client_settings())
         else:
             print("Connecting to Mongo locally.")
-            client = pm.MongoClient("mongodb://localhost:27017/")
+            # a local server keeps the driver's defaults (a pool of 100,
+            # and so on) for anything the environment doesn't set
+            client = pm.MongoClient("mongodb://localhost:27017/", **client_settings(defaults={}))
     return client
 
 
+def warm_up():
+    """
+    Connect now, paying for DNS, TLS and server selection up front, so
+    the first request doesn't. With MONGO_MIN_POOL_SIZE set the driver
+    then keeps that many connections open.
+    """
+    connect_db().admin.command('ping')
+
+
+def warm_up_in_background():
+    def run():
+        try:
+            warm_up()
+        except Exception as e:
+            report_error(e)
+    threading.Thread(target=run, daemon=True, name='mongo-warm-up').start()
+
+
+def forget_client():
+    """
+    Run in the child after a fork. A MongoClient's sockets and threads
+    (or an SQLite connection) can't be shared with the parent, so the
+    child makes its own client on first use (or at once, with WARM_UP).
+    The memory engine's client is kept, data and all.
+    """
+    global client
+    if isinstance(client, storage.MemoryClient):
+        return
+    client = None
+    if WARM_UP:
+        warm_up_in_background()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=forget_client)
+if WARM_UP:
+    warm_up_in_background()
+
+
 def convert_mongo_id(doc: dict):
     if MONGO_ID in doc:
         # Convert mongo ID to a string so it works as JSON
@@ -120,16 +308,182 @@ def create(collection, doc, db=SENS_DB):
     return client[db][collection].insert_one(doc)
 
 
+def chunked(items, chunk_size: int = BULK_CHUNK_SIZE):
+    """
+    Yield lists of at most chunk_size items from any iterable,
+    so callers can stream records without materializing them all.
+    """
+    if chunk_size < 1:
+        raise ValueError(f'Bad value for {chunk_size=}')
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def bulk_counts(result) -> dict:
+    """
+    Turn a pymongo BulkWriteResult into a plain dict of counts.
+    """
+    return {
+        INSERTED: result.inserted_count,
+        MATCHED: result.matched_count,
+        MODIFIED: result.modified_count,
+        UPSERTED: result.upserted_count,
+        DELETED: result.deleted_count,
+    }
+
+
+@needs_db
+@handling_errors
+def bulk_write(collection, ops, db=SENS_DB, chunk_size=BULK_CHUNK_SIZE,
+               ordered=False) -> list:
+    """
+    Send write operations to the DB in chunks of chunk_size.
+    Returns a list with one dict of counts per chunk.
+    If any op fails, raises one BulkWriteError for the whole write, its
+    writeErrors indexed by op across all the chunks, once the chunks are
+    sent (for an ordered write, once the failed chunk is).
+    """
+    results = []
+    errors = []
+    sent = 0
+    for chunk in chunked(ops, chunk_size):
+        try:
+            results.append(bulk_counts(client[db][collection].bulk_write(chunk, ordered=ordered)))
+        except BulkWriteError as e:
+            details = e.details
+            results.append({name: details.get(key, 0) for name, key in ERROR_COUNTS.items()})
+            errors.extend(dict(err, index=err['index'] + sent) for err in details.get(WRITE_ERRORS, []))
+            if ordered:
+                break
+        sent += len(chunk)
+    if errors:
+        details = {key: sum(counts[name] for counts in results) for name, key in ERROR_COUNTS.items()}
+        raise BulkWriteError(dict(details, **{WRITE_ERRORS: errors}))
+    return results
+
+
+def failed_ops(error: BulkWriteError) -> dict:
+    """
+    {index of the op: error message} for each op a bulk write failed.
+    """
+    return {err['index']: err.get('errmsg', '') for err in error.details.get(WRITE_ERRORS, [])}
+
+
+def written(items: list, error: BulkWriteError, ordered: bool = False) -> list:
+    """
+    The items, one per op, whose ops went through in the bulk write
+    that raised error: for an ordered write those before the first
+    failure, for an unordered one all but the failed ones.
+    """
+    failed = failed_ops(error)
+    if ordered:
+        return items[:min(failed, default=len(items))]
+    return [item for index, item in enumerate(items) if index not in failed]
+
+
+def create_many(collection, docs, db=SENS_DB, chunk_size=BULK_CHUNK_SIZE,
+                ordered=False) -> list:
+    """
+    Insert many docs into collection, one round trip per chunk.
+    """
+    ops = (pm.InsertOne(doc) for doc in docs)
+    return bulk_write(collection, ops, db=db, chunk_size=chunk_size,
+                      ordered=ordered)
+
+
+def identity_filter(doc: dict, key_flds: list) -> dict:
+    """
+    Build the filter that identifies doc by its key fields.
+    """
+    missing = [fld for fld in key_flds if fld not in doc]
+    if missing:
+        raise ValueError(f'Doc is missing key fields: {missing}')
+    return {fld: doc[fld] for fld in key_flds}
+
+
+def upsert_many(collection, docs, key_flds: list, db=SENS_DB,
+                chunk_size=BULK_CHUNK_SIZE, ordered=False) -> list:
+    """
+    Update or insert many docs, identified by the values of key_flds.
+    Like update(), fields not in a doc are left alone on existing records.
+    """
+    if not key_flds:
+        raise ValueError('key_flds must not be empty')
+    ops = (pm.UpdateOne(identity_filter(doc, key_flds), {'$set': doc},
+                        upsert=True)
+           for doc in docs)
+    return bulk_write(collection, ops, db=db, chunk_size=chunk_size,
+                      ordered=ordered)
+
+
+def delete_many(collection, filts, db=SENS_DB, chunk_size=BULK_CHUNK_SIZE,
+                ordered=False) -> list:
+    """
+    Delete the first doc matching each filter in filts.
+    """
+    ops = (pm.DeleteOne(filt) for filt in filts)
+    return bulk_write(collection, ops, db=db, chunk_size=chunk_size,
+                      ordered=ordered)
+
+
+def build_projection(projection=None, no_id=False):
+    """
+    Turn a list of field names or a Mongo projection dict into a
+    projection dict, excluding _id server-side when no_id is set.
+    Returns None when every field should be returned.
+    """
+    if projection is None and not no_id:
+        return None
+    if projection is None:
+        proj = {}
+    elif isinstance(projection, dict):
+        proj = dict(projection)
+    else:
+        proj = {fld: 1 for fld in projection}
+    if no_id:
+        proj.setdefault(MONGO_ID, 0)
+    return proj
+
+
+def trim_doc(doc: dict, fields=None) -> dict:
+    """
+    The client-side twin of build_projection: keep only the listed
+    fields of doc (those it has). None means keep everything.
+    """
+    if fields is None:
+        return doc
+    return {fld: doc[fld] for fld in fields if fld in doc}
+
+
+def build_sort(sort):
+    """
+    Accept a field name or a list of (field, direction) pairs.
+    """
+    if sort is None:
+        return None
+    if isinstance(sort, str):
+        return [(sort, pm.ASCENDING)]
+    return list(sort)
+
+
 @needs_db
 @handling_errors
-def read_one(collection, filt, db=SENS_DB):
+def read_one(collection, filt, db=SENS_DB, projection=None, no_id=False):
     """
     Find with a filter and return on the first doc found.
     Return None if not found.
     """
-    for doc in client[db][collection].find(filt):
+    doc = client[db][collection].find_one(
+        filt, build_projection(projection, no_id))
+    if doc is not None:
         convert_mongo_id(doc)
-        return doc
+    return doc
 
 
 @needs_db
@@ -151,35 +505,171 @@ def update(collection, filters, update_dict, db=SENS_DB):
 
 @needs_db
 @handling_errors
-def read(collection, db=SENS_DB, no_id=True) -> list:
+def upsert(collection, filt, update_dict, db=SENS_DB, no_id=False) -> dict:
+    """
+    Set the fields of update_dict on the doc matching filt, inserting it
+    if there is none, in one atomic round trip.
+    Returns the whole doc as it is after the write.
+    """
+    doc = client[db][collection].find_one_and_update(
+        filt, {'$set': update_dict}, projection=build_projection(None, no_id),
+        upsert=True, return_document=pm.ReturnDocument.AFTER)
+    convert_mongo_id(doc)
+    return doc
+
+
+@needs_db
+@handling_errors
+def iter_docs(collection, filt=None, projection=None,
+              batch_size=ITER_BATCH_SIZE, db=SENS_DB, no_id=True,
+              sort=None, skip=0, limit=0):
+    """
+    Yield docs one at a time as they come off the cursor.
+    Only one cursor batch is held in memory, so this is the way to
+    walk large collections.
+    filt, projection, sort, skip and limit are all applied by the server,
+    so only the requested docs and fields come over the wire.
+    A limit of 0 means no limit.
+    """
+    cursor = client[db][collection].find(
+        filt or {},
+        build_projection(projection, no_id),
+        sort=build_sort(sort),
+        skip=skip,
+        limit=limit,
+    )
+    if batch_size:
+        cursor = cursor.batch_size(batch_size)
+    for doc in cursor:
+        convert_mongo_id(doc)
+        yield doc
+
+
+def read(collection, db=SENS_DB, no_id=True, filt=None, projection=None,
+         sort=None, skip=0, limit=0, batch_size=ITER_BATCH_SIZE) -> list:
     """
     Returns a list from the db.
+    Takes the same query options as iter_docs().
     """
-    ret = []
-    for doc in client[db][collection].find():
-        if no_id:
-            del doc[MONGO_ID]
-        else:
-            convert_mongo_id(doc)
-        ret.append(doc)
-    return ret
+    return list(iter_docs(collection, filt=filt, projection=projection,
+                          batch_size=batch_size, db=db, no_id=no_id,
+                          sort=sort, skip=skip, limit=limit))
+
+
+def keys_filter(key_flds: list, keys: list) -> dict:
+    """
+    Build the filter matching any of keys, each a tuple of values for
+    key_flds (or a plain value when there is one key field): an $in on a
+    single key field, otherwise an $or of the key filters.
+    """
+    if len(key_flds) == 1:
+        return {key_flds[0]: {'$in': list(keys)}}
+    return {'$or': [dict(zip(key_flds, key)) for key in keys]}
+
+
+def read_by_keys(collection, key_flds: list, keys, db=SENS_DB, no_id=True,
+                 projection=None, chunk_size=BULK_CHUNK_SIZE):
+    """
+    Yield the docs identified by keys, with one query per chunk_size
+    keys instead of one per key. See keys_filter().
+    """
+    for chunk in chunked(keys, chunk_size):
+        yield from iter_docs(collection, filt=keys_filter(key_flds, chunk),
+                             projection=projection, db=db, no_id=no_id)
+
+
+def plan_stages(plan):
+    """
+    Yield the name of every stage in (part of) an explain() plan.
+    """
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for val in plan.values():
+            yield from plan_stages(val)
+    elif isinstance(plan, list):
+        for val in plan:
+            yield from plan_stages(val)
+
+
+def shape_filter(shape: list) -> dict:
+    """A filter of the given shape: an equality test on each field."""
+    return {fld: '' for fld in shape}
 
 
 @needs_db
 @handling_errors
+def is_collscan(collection, filt, db=SENS_DB) -> bool:
+    """
+    Would the DB answer filt by reading the whole collection?
+    """
+    plan = client[db][collection].find(filt).explain()
+    winning = plan.get('queryPlanner', {}).get('winningPlan', {})
+    return COLLSCAN in plan_stages(winning)
+
+
+@needs_db
+@handling_errors
+def ensure_indexes(db=SENS_DB) -> dict:
+    """
+    Create the indexes registered with register_indexes() that are
+    missing from the DB, then explain each registered query shape.
+    Returns {collection: {CREATED: [names], FAILED: {name: error},
+    COLLSCANS: [shapes that still read the whole collection]}}.
+    A unique index fails, for instance, if the data has duplicates.
+    """
+    report = {}
+    for collection, indexes in storage.INDEXES.items():
+        coll = client[db][collection]
+        existing = coll.index_information()
+        created = []
+        failed = {}
+        for index in indexes:
+            if index.name in existing:
+                continue
+            try:
+                coll.create_index(index.keys, unique=index.unique, name=index.name)
+                created.append(index.name)
+            except PyMongoError as e:
+                failed[index.name] = str(e)
+        collscans = [shape for shape in storage.QUERY_SHAPES.get(collection, [])
+                     if is_collscan(collection, shape_filter(shape), db=db)]
+        report[collection] = {CREATED: created, FAILED: failed, COLLSCANS: collscans}
+    return report
+
+
+def index_report_lines(report: dict) -> list:
+    lines = []
+    for collection, result in report.items():
+        for name in result[CREATED]:
+            lines.append(f'{collection}: created index {name}')
+        for name, error in result[FAILED].items():
+            lines.append(f'{collection}: could not create index {name}: {error}')
+        for shape in result[COLLSCANS]:
+            lines.append(f'{collection}: queries on {shape} scan the whole collection')
+    return lines
+
+
+def index_problems(report: dict) -> bool:
+    return any(result[FAILED] or result[COLLSCANS] for result in report.values())
+
+
+def ensure_indexes_in_background():
+    def run():
+        try:
+            for line in index_report_lines(ensure_indexes()):
+                print(line)
+        except Exception as e:
+            report_error(e)
+    threading.Thread(target=run, daemon=True, name='ensure-indexes').start()
+
+
 def read_dict(collection, key, db=SENS_DB, no_id=True) -> dict:
-    recs = read(collection, db=db, no_id=no_id)
     recs_as_dict = {}
-    for rec in recs:
+    for rec in iter_docs(collection, db=db, no_id=no_id):
         recs_as_dict[rec[key]] = rec
     return recs_as_dict
 
 
-@needs_db
-@handling_errors
 def fetch_all_as_dict(key, collection, db=SENS_DB):
-    ret = {}
-    for doc in client[db][collection].find():
-        del doc[MONGO_ID]
-        ret[doc[key]] = doc
-    return ret
+    return read_dict(collection, key, db=db)
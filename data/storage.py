@@ -0,0 +1,742 @@
+"""
+Storage engines that stand in for a MongoClient.
+
+db_connect only uses a small part of the pymongo API: client[db][collection]
+and, on a collection, insert_one, find (and explain), find_one, update_one,
+find_one_and_update, delete_one, bulk_write, create_index and
+index_information. The clients here implement that part on top
+of a Python dict (MemoryClient) or an SQLite file (SQLiteClient), so the
+server, tests and benchmarks can run without a Mongo server.
+
+Queries support what the query modules send: equality on (dotted)
+fields and the $in, $ne, $exists, $or and $and operators. Updates
+support $set. Anything else raises UnsupportedQuery.
+"""
+import copy
+import json
+import re
+import sqlite3
+import threading
+from itertools import islice
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+
+MONGO_ID = '_id'
+SET = '$set'
+# Mongo's error code for a duplicate key
+DUPLICATE_KEY = 11000
+
+# {collection: [Index]} and {collection: [[field]]}, registered by the
+# query modules; see db_connect.ensure_indexes()
+INDEXES = {}
+QUERY_SHAPES = {}
+
+COLLSCAN = 'COLLSCAN'
+IXSCAN = 'IXSCAN'
+
+MISSING = object()
+
+
+class UnsupportedQuery(PyMongoError):
+    """A filter or update this engine can't run."""
+
+
+def index_keys(keys) -> list:
+    """Accept a field name or a list of field names or (field, direction) pairs."""
+    if isinstance(keys, str):
+        keys = [keys]
+    return [(key, 1) if isinstance(key, str) else tuple(key) for key in keys]
+
+
+def index_name(keys) -> str:
+    return '_'.join(f'{fld}_{direction}' for fld, direction in index_keys(keys))
+
+
+class Index:
+    """
+    An index on fields, each a field name (ascending) or a
+    (field, direction) pair. Named as Mongo would name it.
+    """
+    def __init__(self, fields, unique=False):
+        self.keys = index_keys(fields)
+        self.unique = unique
+        self.name = index_name(self.keys)
+
+    def __repr__(self):
+        return f'Index({self.keys}, unique={self.unique})'
+
+
+def register_indexes(collection: str, indexes: list, query_shapes=()):
+    """
+    Declare the indexes collection needs, and the shapes of the queries
+    (the fields filtered on) that they should serve.
+    """
+    INDEXES[collection] = list(indexes)
+    QUERY_SHAPES[collection] = [list(shape) for shape in query_shapes]
+
+
+def plan(stage: str, **details) -> dict:
+    """A minimal explain() result, shaped like Mongo's."""
+    return {'queryPlanner': {'winningPlan': dict(details, stage=stage)}}
+
+
+class InsertOneResult:
+    def __init__(self, inserted_id):
+        self.inserted_id = inserted_id
+
+
+class UpdateResult:
+    def __init__(self, matched_count=0, modified_count=0, upserted_id=None):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.upserted_id = upserted_id
+
+
+class DeleteResult:
+    def __init__(self, deleted_count=0):
+        self.deleted_count = deleted_count
+
+
+class BulkWriteResult:
+    def __init__(self):
+        self.inserted_count = 0
+        self.matched_count = 0
+        self.modified_count = 0
+        self.upserted_count = 0
+        self.deleted_count = 0
+
+    def add(self, result):
+        if isinstance(result, InsertOneResult):
+            self.inserted_count += 1
+        elif isinstance(result, DeleteResult):
+            self.deleted_count += result.deleted_count
+        else:
+            self.matched_count += result.matched_count
+            self.modified_count += result.modified_count
+            self.upserted_count += result.upserted_id is not None
+
+    def details(self, write_errors: list) -> dict:
+        """
+        The details of a BulkWriteError raised after these writes.
+        """
+        return {
+            'writeErrors': write_errors,
+            'writeConcernErrors': [],
+            'nInserted': self.inserted_count,
+            'nUpserted': self.upserted_count,
+            'nMatched': self.matched_count,
+            'nModified': self.modified_count,
+            'nRemoved': self.deleted_count,
+            'upserted': [],
+        }
+
+
+def get_field(doc: dict, path: str, default=MISSING):
+    val = doc
+    for part in path.split('.'):
+        if not isinstance(val, dict) or part not in val:
+            return default
+        val = val[part]
+    return val
+
+
+def is_operator_dict(cond) -> bool:
+    return isinstance(cond, dict) and bool(cond) and all(k.startswith('$') for k in cond)
+
+
+def match_cond(val, cond) -> bool:
+    if not is_operator_dict(cond):
+        return (None if val is MISSING else val) == cond
+    for op, arg in cond.items():
+        if op == '$eq':
+            ok = match_cond(val, arg)
+        elif op == '$ne':
+            ok = not match_cond(val, arg)
+        elif op == '$in':
+            ok = any(match_cond(val, item) for item in arg)
+        elif op == '$exists':
+            ok = (val is not MISSING) == bool(arg)
+        else:
+            raise UnsupportedQuery(f'Unsupported query operator {op}')
+        if not ok:
+            return False
+    return True
+
+
+def matches(doc: dict, filt: dict) -> bool:
+    """
+    Does doc pass filt? Missing fields compare equal to None, as in Mongo.
+    """
+    for key, cond in (filt or {}).items():
+        if key == '$or':
+            ok = any(matches(doc, sub) for sub in cond)
+        elif key == '$and':
+            ok = all(matches(doc, sub) for sub in cond)
+        elif key.startswith('$'):
+            raise UnsupportedQuery(f'Unsupported query operator {key}')
+        else:
+            ok = match_cond(get_field(doc, key), cond)
+        if not ok:
+            return False
+    return True
+
+
+def project(doc: dict, projection) -> dict:
+    """
+    Apply a Mongo projection dict: either the fields to keep (plus _id
+    unless it is excluded) or the fields to drop.
+    """
+    if not projection:
+        return doc
+    keep = [fld for fld, on in projection.items() if on and fld != MONGO_ID]
+    if keep:
+        fields = keep if projection.get(MONGO_ID, 1) == 0 else [MONGO_ID] + keep
+        return {fld: doc[fld] for fld in fields if fld in doc}
+    return {fld: val for fld, val in doc.items() if projection.get(fld, 1)}
+
+
+def sort_docs(docs: list, sort) -> list:
+    """
+    Sort on a list of (field, direction); missing fields sort first.
+    """
+    for fld, direction in reversed(sort or []):
+        docs.sort(key=lambda doc: sort_key(get_field(doc, fld, None)),
+                  reverse=direction < 0)
+    return docs
+
+
+def sort_key(val):
+    return (val is not None, val if val is not None else 0)
+
+
+def apply_update(doc: dict, update: dict) -> dict:
+    unknown = [op for op in update if op != SET]
+    if unknown:
+        raise UnsupportedQuery(f'Unsupported update operators {unknown}')
+    new_doc = dict(doc)
+    new_doc.update(update.get(SET, {}))
+    return new_doc
+
+
+def upsert_doc(filt: dict, update: dict) -> dict:
+    """
+    The doc an upsert inserts: the equality fields of filt and the $set.
+    """
+    doc = {fld: cond for fld, cond in filt.items()
+           if not fld.startswith('$') and not is_operator_dict(cond)}
+    return apply_update(doc, update)
+
+
+def bulk_op(op):
+    """
+    Split a pymongo InsertOne, UpdateOne or DeleteOne into
+    (kind, filter, doc, upsert).
+    """
+    kind = type(op).__name__
+    if kind == 'InsertOne':
+        return kind, None, op._doc, False
+    if kind == 'UpdateOne':
+        return kind, op._filter, op._doc, op._upsert
+    if kind == 'DeleteOne':
+        return kind, op._filter, None, False
+    raise UnsupportedQuery(f'Unsupported bulk operation {kind}')
+
+
+class Cursor:
+    """
+    Iterates over a find(); batch_size() is accepted as in pymongo.
+    """
+    def __init__(self, docs):
+        self.docs = docs
+
+    def batch_size(self, _size):
+        return self
+
+    def __iter__(self):
+        return iter(self.docs)
+
+    def explain(self):
+        return plan(COLLSCAN)
+
+
+class Admin:
+    def command(self, name, *_args, **_kwargs):
+        if name != 'ping':
+            raise UnsupportedQuery(f'Unsupported command {name}')
+        return {'ok': 1.0}
+
+
+class BaseCollection:
+    """
+    find_one, update_one, delete_one and bulk_write in terms of the
+    find_ids, insert_one, put, remove and transaction of the engine.
+    """
+    def find_one(self, filt=None, projection=None):
+        for doc in self.find(filt, projection, limit=1):
+            return doc
+        return None
+
+    def write_op(self, kind, filt, doc, upsert):
+        if kind == 'InsertOne':
+            return self.insert_one(doc)
+        if kind == 'UpdateOne':
+            return self.update_one(filt, doc, upsert=upsert)
+        return self.delete_one(filt)
+
+    def bulk_write(self, ops, ordered=True):
+        """
+        Apply ops in order. As in Mongo, an ordered bulk write stops at
+        the first duplicate key, an unordered one carries on, and either
+        then raises a BulkWriteError listing the failed ops by index.
+        """
+        result = BulkWriteResult()
+        write_errors = []
+        with self.transaction():
+            for index, op in enumerate(ops):
+                try:
+                    result.add(self.write_op(*bulk_op(op)))
+                except DuplicateKeyError as e:
+                    write_errors.append({'index': index, 'code': DUPLICATE_KEY, 'errmsg': str(e)})
+                    if ordered:
+                        break
+        if write_errors:
+            raise BulkWriteError(result.details(write_errors))
+        return result
+
+    def modify_one(self, filt, update, upsert=False):
+        """
+        Update the first doc matching filt, or insert one if upsert is
+        set, all under one transaction.
+        Returns (doc before, doc after, _id inserted by the upsert).
+        """
+        with self.transaction():
+            for _id, doc in self.find_ids(filt, limit=1):
+                new_doc = apply_update(doc, update)
+                if new_doc != doc:
+                    self.put(_id, new_doc)
+                return doc, new_doc, None
+            if not upsert:
+                return None, None, None
+            new_doc = upsert_doc(filt, update)
+            return None, new_doc, self.insert_one(new_doc).inserted_id
+
+    def update_one(self, filt, update, upsert=False):
+        before, after, upserted_id = self.modify_one(filt, update, upsert)
+        if before is None:
+            return UpdateResult(upserted_id=upserted_id)
+        return UpdateResult(1, int(after != before))
+
+    def find_one_and_update(self, filt, update, projection=None, upsert=False,
+                            return_document=False, **_kwargs):
+        """
+        return_document is pymongo's ReturnDocument: False (BEFORE)
+        returns the doc as it was, True (AFTER) as it is now.
+        """
+        before, after, _upserted_id = self.modify_one(filt, update, upsert)
+        doc = after if return_document else before
+        return None if doc is None else project(copy.deepcopy(doc), projection)
+
+    def delete_one(self, filt):
+        with self.transaction():
+            for _id, _doc in self.find_ids(filt, limit=1):
+                self.remove(_id)
+                return DeleteResult(1)
+        return DeleteResult(0)
+
+
+class MemoryCollection(BaseCollection):
+    """
+    Docs are kept by _id in a dict, in insertion order, and copied on
+    the way in and out, so callers never share them. One lock per
+    collection makes every operation atomic.
+    """
+    def __init__(self):
+        self.docs = {}
+        self.lock = threading.RLock()
+        self.indexes = {}
+
+    def transaction(self):
+        return self.lock
+
+    def put(self, _id, doc):
+        self.docs[_id] = copy.deepcopy(doc)
+
+    def remove(self, _id):
+        del self.docs[_id]
+
+    def insert_one(self, doc):
+        doc.setdefault(MONGO_ID, ObjectId())
+        with self.lock:
+            if doc[MONGO_ID] in self.docs:
+                raise DuplicateKeyError(f'Duplicate _id {doc[MONGO_ID]}')
+            self.put(doc[MONGO_ID], doc)
+        return InsertOneResult(doc[MONGO_ID])
+
+    def find_ids(self, filt, sort=None, skip=0, limit=0):
+        with self.lock:
+            found = [(_id, doc) for _id, doc in self.docs.items() if matches(doc, filt)]
+        if sort:
+            found = [(doc[MONGO_ID], doc) for doc in sort_docs([doc for _id, doc in found], sort)]
+        return found[skip:skip + limit if limit else None]
+
+    def find(self, filt=None, projection=None, sort=None, skip=0, limit=0):
+        found = self.find_ids(filt, sort=sort, skip=skip, limit=limit)
+        return Cursor([project(copy.deepcopy(doc), projection) for _id, doc in found])
+
+    def create_index(self, keys, unique=False, name=None, **_kwargs):
+        """Recorded, but not built or enforced: every find is a scan."""
+        name = name or index_name(keys)
+        self.indexes[name] = {'key': index_keys(keys), 'unique': unique}
+        return name
+
+    def index_information(self) -> dict:
+        return dict(self.indexes, **{'_id_': {'key': [(MONGO_ID, 1)]}})
+
+    def count_documents(self, filt):
+        return len(self.find_ids(filt))
+
+
+class MemoryDatabase:
+    def __init__(self):
+        self.collections = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, collection: str) -> MemoryCollection:
+        with self.lock:
+            return self.collections.setdefault(collection, MemoryCollection())
+
+
+class MemoryClient:
+    """
+    Keeps every collection in this process's memory. A forked child gets
+    a copy of the parent's data, so the client survives a fork.
+    """
+    def __init__(self):
+        self.dbs = {}
+        self.lock = threading.Lock()
+        self.admin = Admin()
+
+    def __getitem__(self, db: str) -> MemoryDatabase:
+        with self.lock:
+            return self.dbs.setdefault(db, MemoryDatabase())
+
+    def close(self):
+        pass
+
+
+def quote(ident: str) -> str:
+    return '"' + ident.replace('"', '""') + '"'
+
+
+def json_path(fld: str) -> str:
+    return '$' + ''.join('.' + quote(part) for part in fld.split('.'))
+
+
+def field_expr(fld: str) -> str:
+    """
+    The SQL for a doc field. Expression indexes are built on exactly
+    this text, so that SQLite can use them for queries.
+    """
+    if fld == MONGO_ID:
+        return 'id'
+    return f"json_extract(doc, '{json_path(fld)}')"
+
+
+def sql_value(val):
+    if isinstance(val, ObjectId):
+        return str(val)
+    if isinstance(val, (dict, list)):
+        raise UnsupportedQuery('Can only compare fields to scalars')
+    return val
+
+
+def cond_sql(fld: str, cond):
+    expr = field_expr(fld)
+    if not is_operator_dict(cond):
+        if cond is None:
+            return f'{expr} IS NULL', []
+        return f'{expr} = ?', [sql_value(cond)]
+    clauses = []
+    params = []
+    for op, arg in cond.items():
+        if op == '$in':
+            if not arg:
+                clauses.append('0')
+                continue
+            values = [sql_value(item) for item in arg]
+            if None in values:
+                raise UnsupportedQuery('$in with None')
+            clauses.append(f'{expr} IN ({", ".join("?" * len(values))})')
+            params += values
+        elif op == '$eq':
+            clause, more = cond_sql(fld, arg)
+            clauses.append(clause)
+            params += more
+        elif op == '$ne':
+            clause, more = cond_sql(fld, arg)
+            clauses.append(f'NOT coalesce({clause}, 0)')
+            params += more
+        else:
+            raise UnsupportedQuery(f'Unsupported query operator {op}')
+    return ' AND '.join(clauses), params
+
+
+def filter_sql(filt: dict):
+    """
+    Translate filt into a WHERE clause and its parameters.
+    Raises UnsupportedQuery for what can't be done in SQL.
+    """
+    clauses = []
+    params = []
+    for key, cond in (filt or {}).items():
+        if key in ('$or', '$and'):
+            parts = [filter_sql(sub) for sub in cond]
+            joiner = ' OR ' if key == '$or' else ' AND '
+            if not parts:
+                clause = '0' if key == '$or' else '1'
+            else:
+                clause = joiner.join(f'({part})' for part, _more in parts)
+            clauses.append(clause)
+            for _part, more in parts:
+                params += more
+        elif key.startswith('$'):
+            raise UnsupportedQuery(f'Unsupported query operator {key}')
+        else:
+            clause, more = cond_sql(key, cond)
+            clauses.append(clause)
+            params += more
+    return ' AND '.join(f'({clause})' for clause in clauses) or '1', params
+
+
+def to_json(doc: dict) -> str:
+    return json.dumps(doc, separators=(',', ':'), default=str)
+
+
+class SQLiteCollection(BaseCollection):
+    """
+    A table of (id, doc) rows, with the doc stored as JSON. Filters are
+    run as SQL on json_extract() of the doc fields where possible, and
+    in Python otherwise. _ids are stored as strings.
+    """
+    def __init__(self, client, table: str, collection: str):
+        self.client = client
+        self.table = quote(table)
+        self.table_name = table
+        self.index_prefix = table + '.'
+        with client.lock:
+            client.conn.execute(f'CREATE TABLE IF NOT EXISTS {self.table} '
+                                '(id TEXT PRIMARY KEY, doc TEXT NOT NULL)')
+        for index in INDEXES.get(collection, []):
+            try:
+                self.create_index(index.keys, unique=index.unique)
+            except PyMongoError as e:
+                print(f'Could not create index {index} on {table}: {e}')
+
+    def transaction(self):
+        return self.client.transaction()
+
+    def put(self, _id, doc):
+        try:
+            self.client.conn.execute(f'UPDATE {self.table} SET doc = ? WHERE id = ?',
+                                     (to_json(doc), _id))
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError(f'Update of {_id} breaks a unique index: {e}')
+
+    def remove(self, _id):
+        self.client.conn.execute(f'DELETE FROM {self.table} WHERE id = ?', (_id,))
+
+    def insert_one(self, doc):
+        doc.setdefault(MONGO_ID, ObjectId())
+        stored = dict(doc, **{MONGO_ID: str(doc[MONGO_ID])})
+        try:
+            with self.client.lock:
+                self.client.conn.execute(f'INSERT INTO {self.table} (id, doc) VALUES (?, ?)',
+                                         (stored[MONGO_ID], to_json(stored)))
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError(f'Duplicate _id {doc[MONGO_ID]}: {e}')
+        return InsertOneResult(doc[MONGO_ID])
+
+    def query(self, filt, sort=None):
+        """
+        Return the SQL (without paging) and parameters for filt, and
+        whether the rows still have to be filtered in Python.
+        """
+        try:
+            where, params = filter_sql(filt)
+            post_filter = False
+        except UnsupportedQuery:
+            where, params = '1', []
+            post_filter = True
+        sql = f'SELECT id, doc FROM {self.table} WHERE {where}'
+        if sort:
+            order = ', '.join(f'{field_expr(fld)} {"DESC" if direction < 0 else "ASC"}'
+                              for fld, direction in sort)
+            sql += f' ORDER BY {order}'
+        return sql, params, post_filter
+
+    def iter_rows(self, filt, sort=None, batch_size=1000):
+        """
+        Yield matching (id, doc), fetching a batch_size page at a time
+        so the lock isn't held while the caller works through them.
+        Unsorted results are paged by rowid; sorted ones are read at once.
+        """
+        sql, params, post_filter = self.query(filt, sort)
+        if sort:
+            with self.client.lock:
+                rows = self.client.conn.execute(sql, params).fetchall()
+            pages = [rows]
+        else:
+            pages = self.rowid_pages(sql.replace('SELECT id, doc', 'SELECT rowid, id, doc', 1),
+                                     params, batch_size)
+        for page in pages:
+            for _id, doc in page:
+                doc = json.loads(doc)
+                if not post_filter or matches(doc, filt):
+                    yield _id, doc
+
+    def rowid_pages(self, sql, params, batch_size):
+        last = 0
+        while True:
+            with self.client.lock:
+                rows = self.client.conn.execute(f'{sql} AND rowid > ? ORDER BY rowid LIMIT ?',
+                                                params + [last, batch_size]).fetchall()
+            if not rows:
+                return
+            last = rows[-1][0]
+            yield [(_id, doc) for _rowid, _id, doc in rows]
+
+    def find_ids(self, filt, sort=None, skip=0, limit=0, batch_size=1000):
+        rows = self.iter_rows(filt, sort, batch_size)
+        return islice(rows, skip, skip + limit if limit else None)
+
+    def find(self, filt=None, projection=None, sort=None, skip=0, limit=0):
+        return SQLiteCursor(self, filt, projection, sort, skip, limit)
+
+    def create_index(self, keys, unique=False, name=None, **_kwargs):
+        keys = index_keys(keys)
+        name = name or index_name(keys)
+        cols = ', '.join(f'{field_expr(fld)} {"DESC" if direction < 0 else "ASC"}'
+                         for fld, direction in keys)
+        try:
+            with self.client.lock:
+                self.client.conn.execute(f'CREATE {"UNIQUE " if unique else ""}INDEX IF NOT EXISTS '
+                                         f'{quote(self.index_prefix + name)} ON {self.table} ({cols})')
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError(f'Duplicate keys for unique index {name}: {e}')
+        return name
+
+    def index_information(self) -> dict:
+        with self.client.lock:
+            rows = self.client.conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' "
+                                            'AND tbl_name = ? AND name LIKE ?',
+                                            (self.table_name, self.index_prefix + '%')).fetchall()
+        info = {name[len(self.index_prefix):]: {} for name, in rows}
+        info['_id_'] = {'key': [(MONGO_ID, 1)]}
+        return info
+
+    def count_documents(self, filt):
+        return sum(1 for _row in self.iter_rows(filt))
+
+    def query_plan(self, filt=None, sort=None) -> list:
+        """The SQLite query plan for filt, one line per step."""
+        sql, params, post_filter = self.query(filt, sort)
+        if post_filter:
+            return ['SCAN (filtered in Python)']
+        with self.client.lock:
+            return [row[-1] for row in self.client.conn.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+
+
+class SQLiteCursor(Cursor):
+    def __init__(self, collection, filt, projection, sort, skip, limit):
+        self.collection = collection
+        self.args = (filt, sort, skip, limit)
+        self.projection = projection
+        self.size = 1000
+
+    def batch_size(self, size):
+        self.size = size
+        return self
+
+    def __iter__(self):
+        filt, sort, skip, limit = self.args
+        for _id, doc in self.collection.find_ids(filt, sort, skip, limit, self.size):
+            yield project(doc, self.projection)
+
+    def explain(self):
+        """
+        SQLite reads a whole table for a SCAN step (a SEARCH uses an
+        index), which is what Mongo calls a COLLSCAN.
+        """
+        filt, sort, _skip, _limit = self.args
+        steps = self.collection.query_plan(filt, sort)
+        scans = [step for step in steps if step.startswith('SCAN') and 'INDEX' not in step]
+        return plan(COLLSCAN if scans else IXSCAN, steps=steps)
+
+
+class SQLiteDatabase:
+    def __init__(self, client, db: str):
+        self.client = client
+        self.db = db
+
+    def __getitem__(self, collection: str) -> SQLiteCollection:
+        return self.client.collection(self.db, collection)
+
+
+class SQLiteClient:
+    """
+    One SQLite connection, shared by all threads behind a lock.
+    Each collection of each db is a table named db.collection.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False,
+                                    isolation_level=None, timeout=30)
+        if path != ':memory:':
+            self.conn.execute('PRAGMA journal_mode=WAL')
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.collections = {}
+        self.admin = Admin()
+
+    def __getitem__(self, db: str) -> SQLiteDatabase:
+        return SQLiteDatabase(self, db)
+
+    def collection(self, db: str, collection: str) -> SQLiteCollection:
+        table = re.sub(r'\W', '_', db) + '.' + re.sub(r'\W', '_', collection)
+        with self.lock:
+            if table not in self.collections:
+                self.collections[table] = SQLiteCollection(self, table, collection)
+            return self.collections[table]
+
+    def transaction(self):
+        return Transaction(self)
+
+    def close(self):
+        self.conn.close()
+
+
+class Transaction:
+    """
+    Hold the client lock and wrap the outermost use in BEGIN/COMMIT,
+    so a bulk write is one SQLite transaction.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def __enter__(self):
+        self.client.lock.acquire()
+        if self.client.depth == 0:
+            self.client.conn.execute('BEGIN')
+        self.client.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # writes before an error are kept, as they would be in Mongo
+        self.client.depth -= 1
+        try:
+            if self.client.depth == 0:
+                self.client.conn.execute('COMMIT')
+        finally:
+            self.client.lock.release()
+        return False
@@ -0,0 +1,47 @@
+import threading
+
+import pytest
+
+import data.batch_loader as bl
+
+
+def run_threads(loader, keys):
+    results = {}
+
+    def load(i, key):
+        results[i] = loader.load(key)
+
+    threads = [threading.Thread(target=load, args=(i, key)) for i, key in enumerate(keys)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [results[i] for i in range(len(keys))]
+
+
+def test_concurrent_misses_share_one_batch():
+    batches = []
+
+    def batch_fn(keys):
+        batches.append(sorted(keys))
+        return {key: key.upper() for key in keys if key != 'gone'}
+
+    loader = bl.BatchLoader(batch_fn, window=0.2)
+    results = run_threads(loader, ['a', 'b', 'a', 'gone'])
+    assert results == ['A', 'B', 'A', None]
+    assert batches == [['a', 'b', 'gone']]
+    assert loader.get_stats() == {bl.LOADS: 4, bl.BATCHES: 1}
+
+
+def test_full_batch_sent_early():
+    loader = bl.BatchLoader(lambda keys: {key: key for key in keys}, window=10, max_batch=1)
+    assert loader.load('a') == 'a'
+
+
+def test_errors_reach_every_caller():
+    def batch_fn(keys):
+        raise ConnectionError('db down')
+
+    loader = bl.BatchLoader(batch_fn, window=0)
+    with pytest.raises(ConnectionError):
+        loader.load('a')
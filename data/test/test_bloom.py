@@ -0,0 +1,28 @@
+import pytest
+
+from data.bloom import BloomFilter
+
+
+def test_no_false_negatives():
+    bloom = BloomFilter(1000)
+    keys = [(f'city{i}', 'NY', 'USA') for i in range(1000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+    assert len(bloom) == 1000
+    assert not bloom.is_full()
+
+
+def test_false_positive_rate():
+    bloom = BloomFilter(1000, error_rate=0.01)
+    for i in range(1000):
+        bloom.add(f'in{i}')
+    false_positives = sum(f'out{i}' in bloom for i in range(10000))
+    assert false_positives < 300
+
+
+def test_bad_params():
+    with pytest.raises(ValueError):
+        BloomFilter(0)
+    with pytest.raises(ValueError):
+        BloomFilter(10, error_rate=1)
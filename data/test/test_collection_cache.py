@@ -0,0 +1,325 @@
+import threading
+import time
+
+import pytest
+
+import data.collection_cache as cc
+
+BY_STATE = 'by_state'
+
+DOCS = [
+    {'_id': 'a', 'city': 'NYC', 'state_code': 'NY'},
+    {'_id': 'b', 'city': 'Buffalo', 'state_code': 'NY'},
+    {'_id': 'c', 'city': 'Boston', 'state_code': 'MA'},
+]
+
+
+@pytest.fixture
+def cache():
+    return cc.CollectionCache(
+        'cities',
+        lambda doc: doc.get('city'),
+        indexes={BY_STATE: lambda doc: doc.get('state_code')},
+        loader=lambda: iter([dict(doc) for doc in DOCS]),
+    )
+
+
+def test_loads_on_first_use(cache):
+    assert not cache.is_loaded()
+    assert len(cache) == 3
+    assert cache.get_stats()[cc.RELOADS] == 1
+    assert '_id' not in cache.get('NYC')
+
+
+def test_hit_miss_stats(cache):
+    cache.get('NYC')
+    cache.get('Nowhere')
+    stats = cache.get_stats()
+    assert stats[cc.HITS] == 1
+    assert stats[cc.MISSES] == 1
+
+
+def test_put_and_evict_keep_indexes(cache):
+    cache.ensure_loaded()
+    gen = cache.generation
+    cache.put({'city': 'Albany', 'state_code': 'NY'})
+    assert set(cache.lookup(BY_STATE, 'NY')) == {'NYC', 'Buffalo', 'Albany'}
+    cache.put({'city': 'Albany', 'state_code': 'MA'})
+    assert set(cache.lookup(BY_STATE, 'NY')) == {'NYC', 'Buffalo'}
+    cache.evict('Boston')
+    assert set(cache.lookup(BY_STATE, 'MA')) == {'Albany'}
+    assert cache.generation == gen + 3
+
+
+def test_put_before_load_is_ignored(cache):
+    cache.put({'city': 'Albany', 'state_code': 'NY'})
+    assert 'Albany' not in cache
+
+
+def test_ttl_reload(cache):
+    cache.ttl = 0
+    cache.background_refresh = False
+    len(cache)
+    len(cache)
+    assert cache.get_stats()[cc.RELOADS] >= 2
+
+
+def test_writes_during_first_load(cache):
+    def loader():
+        # writes that land while the first load is still reading
+        cache.put({'city': 'Albany', 'state_code': 'NY'})
+        cache.evict('Boston')
+        cache.merge([{'city': 'NYC', 'pop': 8}])
+        return iter([dict(doc) for doc in DOCS])
+    cache.loader = loader
+    cache.load()
+    assert 'Albany' in cache
+    assert cache.might_contain('Albany')
+    assert 'Boston' not in cache
+    assert cache.get('NYC')['pop'] == 8
+    assert cache.get('NYC')['state_code'] == 'NY'
+
+
+def test_load_error_keeps_old_docs(cache):
+    cache.ensure_loaded()
+
+    def bad_loader():
+        raise RuntimeError('DB down')
+    cache.loader = bad_loader
+    cache.load()
+    assert len(cache.as_dict()) == 3
+    assert cache.get_stats()[cc.LOAD_ERRORS] == 1
+
+
+def test_derived_memoized_per_generation(cache):
+    calls = []
+
+    def build(docs):
+        calls.append(1)
+        return sorted(docs)
+    assert cache.derived('sorted', build) == ['Boston', 'Buffalo', 'NYC']
+    cache.derived('sorted', build)
+    assert len(calls) == 1
+    cache.evict('NYC')
+    assert cache.derived('sorted', build) == ['Boston', 'Buffalo']
+    assert len(calls) == 2
+
+
+def test_snapshot_unchanged_by_writes(cache):
+    snap = cache.snapshot()
+    cache.put({'city': 'Albany', 'state_code': 'NY'})
+    cache.evict('NYC')
+    assert 'Albany' not in snap
+    assert set(snap.lookup(BY_STATE, 'NY')) == {'NYC', 'Buffalo'}
+    assert set(cache.lookup(BY_STATE, 'NY')) == {'Buffalo', 'Albany'}
+
+
+def test_readers_keep_old_snapshot_during_reload(cache):
+    cache.ensure_loaded()
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_loader():
+        started.set()
+        release.wait(5)
+        return iter([{'city': 'Albany', 'state_code': 'NY'}])
+    cache.loader = slow_loader
+    reloader = threading.Thread(target=cache.load)
+    reloader.start()
+    started.wait(5)
+    # a second reload does not start while one is in flight
+    cache.load(wait=False)
+    assert len(cache) == 3
+    cache.put({'city': 'Troy', 'state_code': 'NY'})
+    release.set()
+    reloader.join(5)
+    assert set(cache.as_dict()) == {'Albany', 'Troy'}
+    assert cache.get_stats()[cc.RELOADS] == 2
+
+
+def test_invalidate_refreshes_in_background(cache):
+    cache.ensure_loaded()
+    cache.loader = lambda: iter([{'city': 'Albany', 'state_code': 'NY'}])
+    cache.invalidate()
+    # the request that notices is still served the old snapshot
+    assert 'NYC' in cache.snapshot()
+    for _ in range(100):
+        if 'Albany' in cache.current:
+            break
+        time.sleep(0.05)
+    assert set(cache.as_dict()) == {'Albany'}
+    assert not cache.is_stale()
+
+
+def test_page_walks_keys_in_order(cache):
+    snap = cache.snapshot()
+    docs, after = snap.page(2)
+    assert [doc['city'] for doc in docs] == ['Boston', 'Buffalo']
+    docs, after = snap.page(2, after)
+    assert [doc['city'] for doc in docs] == ['NYC']
+    assert after is None
+
+
+def test_page_within_index(cache):
+    docs, after = cache.snapshot().page(1, index_name=BY_STATE, index_key='NY')
+    assert [doc['city'] for doc in docs] == ['Buffalo']
+    docs, after = cache.snapshot().page(1, after, BY_STATE, 'NY')
+    assert [doc['city'] for doc in docs] == ['NYC']
+
+
+def test_merge_lays_fields_over_cached(cache):
+    cache.ensure_loaded()
+    cache.merge([
+        {'city': 'NYC', 'rec_restaurant': 'a'},
+        {'city': 'NYC', 'rec_restaurant': 'b'},
+        {'city': 'Albany', 'state_code': 'NY'},
+    ])
+    assert cache.get('NYC') == {'city': 'NYC', 'state_code': 'NY', 'rec_restaurant': 'b'}
+    assert set(cache.lookup(BY_STATE, 'NY')) == {'NYC', 'Buffalo', 'Albany'}
+
+
+def test_get_many(cache):
+    found, missing = cache.get_many(['NYC', 'Nowhere', 'Boston'])
+    assert set(found) == {'NYC', 'Boston'}
+    # the Bloom filter rules Nowhere out
+    assert missing == []
+    assert cache.get_stats()[cc.BLOOM_SKIPS] == 1
+    cache.bloom = None
+    assert cache.get_many(['Nowhere'])[1] == ['Nowhere']
+    assert cache.get_stats()[cc.MISSES] == 2
+
+
+def test_negative_cache():
+    cache = cc.CollectionCache('cities', lambda doc: doc.get('city'), loader=lambda: iter([]),
+                               negative_max=2)
+    cache.remember_missing('Atlantis')
+    assert cache.is_known_missing('Atlantis')
+    cache.put({'city': 'Atlantis'})
+    assert not cache.is_known_missing('Atlantis')
+    for city in ('A', 'B', 'C'):
+        cache.remember_missing(city)
+    assert not cache.is_known_missing('A')
+    stats = cache.get_stats()
+    assert stats[cc.NEG_HITS] == 1
+    assert stats[cc.NEG_EVICTIONS] == 1
+    assert stats[cc.NEG_SIZE] == 2
+
+
+def test_negative_cache_expires(cache):
+    cache.ensure_loaded()
+    cache.bloom = None
+    cache.negative_ttl = 0.01
+    cache.remember_missing('Atlantis')
+    time.sleep(0.02)
+    assert not cache.is_known_missing('Atlantis')
+    found, missing = cache.get_many(['Atlantis'])
+    assert missing == ['Atlantis']
+
+
+def test_bloom_follows_writes(cache):
+    cache.ensure_loaded()
+    assert not cache.might_contain('Albany')
+    cache.put({'city': 'Albany', 'state_code': 'NY'})
+    assert cache.might_contain('Albany')
+    assert cache.might_contain('NYC')
+    cache.clear()
+    assert cache.might_contain('Albany')
+
+
+def test_content_hash_ignores_field_order():
+    assert cc.content_hash({'a': 1, 'b': [1, 2]}) == cc.content_hash({'b': [1, 2], 'a': 1})
+    assert cc.content_hash({'a': 1}) != cc.content_hash({'a': '1'})
+
+
+def test_changed_drops_unchanged_docs(cache):
+    cache.ensure_loaded()
+    docs = [
+        {'city': 'NYC', 'state_code': 'NY'},
+        {'state_code': 'MA', 'city': 'Boston'},
+        {'city': 'Buffalo', 'state_code': 'PA'},
+        {'city': 'Albany', 'state_code': 'NY'},
+    ]
+    assert cache.changed(docs) == docs[2:]
+    assert cache.get_stats()[cc.UNCHANGED_WRITES] == 2
+    assert cache.unchanged({'city': 'NYC'})
+    assert not cache.unchanged({'city': 'NYC', 'rec_restaurant': 'a'})
+
+
+def test_changed_judges_a_key_by_all_its_docs(cache):
+    cache.ensure_loaded()
+    docs = [{'city': 'NYC', 'state_code': 'NJ'}, {'city': 'NYC', 'state_code': 'NY'}]
+    assert cache.changed(docs) == []
+    docs = [{'city': 'NYC', 'state_code': 'NY'}, {'city': 'NYC', 'state_code': 'NJ'}]
+    assert cache.changed(docs) == docs
+
+
+def test_changed_follows_writes(cache):
+    cache.ensure_loaded()
+    assert cache.snapshot().content_hash('NYC') is not None
+    cache.put({'city': 'NYC', 'state_code': 'NJ'})
+    assert cache.snapshot().hashes['NYC'] == cc.content_hash({'city': 'NYC', 'state_code': 'NJ'})
+    assert cache.unchanged({'city': 'NYC', 'state_code': 'NJ'})
+    assert not cache.unchanged({'city': 'NYC', 'state_code': 'NY'})
+
+
+def test_stale_cache_keeps_every_doc(cache):
+    assert not cache.unchanged({'city': 'NYC', 'state_code': 'NY'})
+    cache.ensure_loaded()
+    cache.invalidate()
+    assert not cache.unchanged({'city': 'NYC', 'state_code': 'NY'})
+
+
+def test_version_is_content_based(cache):
+    other = cc.CollectionCache('cities', lambda doc: doc.get('city'),
+                               loader=lambda: iter([dict(doc) for doc in reversed(DOCS)]))
+    assert cache.version() == other.version()
+    cache.put({'city': 'Albany', 'state_code': 'NY'})
+    assert cache.version() != other.version()
+    cache.evict('Albany')
+    assert cache.version() == other.version()
+
+
+def test_digest_follows_writes(cache):
+    cache.version()
+    cache.write(puts=[{'city': 'NYC', 'state_code': 'NJ'}, {'city': 'Albany'}],
+                evicts=['Boston'])
+    snap = cache.snapshot()
+    assert snap.digest is not None
+    incremental = snap.content_digest()
+    snap.digest = None
+    assert snap.content_digest() == incremental
+
+
+def test_version_applies_freshness_policy(cache):
+    cache.background_refresh = False
+    cache.version()
+    cache.invalidate()
+    cache.version()
+    assert cache.get_stats()[cc.RELOADS] == 2
+
+
+def test_load_hashes_docs(cache, monkeypatch):
+    snap = cache.snapshot()
+    assert snap.digest is not None
+    assert set(snap.hashes) == set(snap.docs)
+    hashed = []
+    monkeypatch.setattr(cc, 'content_hash', lambda doc: hashed.append(doc) or 'h')
+    cache.loader = lambda: iter([dict(doc) for doc in DOCS] + [{'city': 'Albany'}])
+    cache.load()
+    # only the new doc is hashed again
+    assert hashed == [{'city': 'Albany'}]
+
+
+def test_load_digest_includes_pending_writes(cache):
+    def loader():
+        cache.put({'city': 'Albany', 'state_code': 'NY'})
+        cache.evict('Boston')
+        cache.merge([{'city': 'NYC', 'pop': 8}])
+        return iter([dict(doc) for doc in DOCS])
+    cache.loader = loader
+    cache.load()
+    snap = cache.snapshot()
+    digest = snap.content_digest()
+    snap.digest = None
+    snap.hashes = {}
+    assert snap.content_digest() == digest
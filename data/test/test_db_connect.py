@@ -1,3 +1,12 @@
+import os
+import subprocess
+import sys
+from unittest.mock import MagicMock, patch
+
+import pymongo as pm
+import pytest
+from pymongo.errors import BulkWriteError
+
 import data.db_connect as dbc
 
 VALID_ID = '1' * dbc.MIN_ID_LEN
@@ -11,3 +20,242 @@ def test_is_not_valid_id():
 
 def test_is_not_valid_id_bad_type():
     assert not dbc.is_valid_id(17)
+
+
+def test_chunked():
+    assert list(dbc.chunked(range(5), 2)) == [[0, 1], [2, 3], [4]]
+
+
+def test_chunked_bad_size():
+    with pytest.raises(ValueError):
+        list(dbc.chunked(range(5), 0))
+
+
+def test_identity_filter_missing_key():
+    with pytest.raises(ValueError):
+        dbc.identity_filter({'city': 'x'}, ['city', 'state_code'])
+
+
+@patch('data.db_connect.client')
+def test_upsert_many_chunks(mock_client):
+    coll = mock_client[dbc.SENS_DB]['cities']
+    coll.bulk_write.return_value = MagicMock(
+        inserted_count=0, matched_count=1, modified_count=1,
+        upserted_count=1, deleted_count=0)
+    docs = [{'city': f'c{i}', 'state_code': 'NY'} for i in range(5)]
+    results = dbc.upsert_many('cities', docs, ['city', 'state_code'],
+                              chunk_size=2)
+    assert len(results) == 3
+    assert results[0][dbc.UPSERTED] == 1
+    ops = coll.bulk_write.call_args_list[0][0][0]
+    assert len(ops) == 2
+    assert all(isinstance(op, pm.UpdateOne) for op in ops)
+
+
+def test_build_projection():
+    assert dbc.build_projection() is None
+    assert dbc.build_projection(no_id=True) == {dbc.MONGO_ID: 0}
+    assert dbc.build_projection(['city'], no_id=True) == {'city': 1, dbc.MONGO_ID: 0}
+    assert dbc.build_projection({'city': 1}) == {'city': 1}
+
+
+def test_trim_doc():
+    doc = {'city': 'NYC', 'state_code': 'NY', 'rec_restaurant': 'x'}
+    assert dbc.trim_doc(doc) is doc
+    assert dbc.trim_doc(doc, ['city', 'nope']) == {'city': 'NYC'}
+
+
+def test_build_sort():
+    assert dbc.build_sort(None) is None
+    assert dbc.build_sort('city') == [('city', pm.ASCENDING)]
+
+
+@patch('data.db_connect.client')
+def test_read_pushdown(mock_client):
+    coll = mock_client[dbc.SENS_DB]['cities']
+    coll.find.return_value.batch_size.return_value = [{'city': 'NYC'}]
+    ret = dbc.read('cities', filt={'state_code': 'NY'}, projection=['city'],
+                   sort='city', limit=5)
+    assert ret == [{'city': 'NYC'}]
+    coll.find.assert_called_once_with(
+        {'state_code': 'NY'}, {'city': 1, dbc.MONGO_ID: 0},
+        sort=[('city', pm.ASCENDING)], skip=0, limit=5)
+
+
+@patch('data.db_connect.client')
+def test_read_one_uses_find_one(mock_client):
+    coll = mock_client[dbc.SENS_DB]['cities']
+    coll.find_one.return_value = None
+    assert dbc.read_one('cities', {'city': 'Nowhere'}) is None
+    coll.find_one.assert_called_once_with({'city': 'Nowhere'}, None)
+
+
+@patch('data.db_connect.client')
+def test_iter_docs_streams(mock_client):
+    coll = mock_client[dbc.SENS_DB]['cities']
+    coll.find.return_value.batch_size.return_value = iter(
+        [{dbc.MONGO_ID: 1, 'city': 'NYC'}, {dbc.MONGO_ID: 2, 'city': 'LA'}])
+    docs = dbc.iter_docs('cities', batch_size=10, no_id=False)
+    assert not isinstance(docs, list)
+    assert next(docs) == {dbc.MONGO_ID: '1', 'city': 'NYC'}
+    coll.find.return_value.batch_size.assert_called_once_with(10)
+
+
+def test_keys_filter():
+    assert dbc.keys_filter(['_id'], ['USA', 'FRA']) == {'_id': {'$in': ['USA', 'FRA']}}
+    assert dbc.keys_filter(['city', 'state_code'], [('NYC', 'NY')]) == {
+        '$or': [{'city': 'NYC', 'state_code': 'NY'}]}
+
+
+@patch('data.db_connect.client')
+def test_read_by_keys_one_query_per_chunk(mock_client):
+    coll = mock_client[dbc.SENS_DB]['countries']
+    coll.find.return_value.batch_size.return_value = []
+    list(dbc.read_by_keys('countries', ['_id'], ['A', 'B', 'C'], chunk_size=2))
+    assert coll.find.call_count == 2
+    assert coll.find.call_args_list[0].args[0] == {'_id': {'$in': ['A', 'B']}}
+
+
+def test_client_settings_typed(monkeypatch):
+    monkeypatch.setenv('MONGO_MAX_POOL_SIZE', '20')
+    monkeypatch.setenv('MONGO_MIN_POOL_SIZE', '2')
+    monkeypatch.setenv('MONGO_CONNECT', 'false')
+    monkeypatch.setenv('MONGO_COMPRESSORS', 'zstd, zlib')
+    monkeypatch.setenv('MONGO_READ_PREFERENCE', 'secondaryPreferred')
+    monkeypatch.delenv('MONGO_SOCK_TIMEOUT', raising=False)
+    settings = dbc.client_settings()
+    assert settings[dbc.MAX_POOL_SIZE] == 20
+    assert settings[dbc.MIN_POOL_SIZE] == 2
+    assert settings[dbc.CONNECT] is False
+    assert settings[dbc.COMPRESSORS] == 'zstd,zlib'
+    assert settings[dbc.READ_PREFERENCE] == 'secondaryPreferred'
+    assert dbc.SOCK_TIMEOUT not in settings
+
+
+def test_client_settings_defaults(monkeypatch):
+    for name in ('MONGO_CONN_TIMEOUT', 'MONGO_CONNECT', 'MONGO_MAX_POOL_SIZE',
+                 'MONGO_MIN_POOL_SIZE', 'MONGO_READ_PREFERENCE'):
+        monkeypatch.delenv(name, raising=False)
+    assert dbc.client_settings()[dbc.MAX_POOL_SIZE] == 1
+    # the local client leaves unset settings to the driver
+    assert dbc.client_settings(defaults={}) == {}
+    monkeypatch.setenv('MONGO_MIN_POOL_SIZE', '5')
+    assert dbc.client_settings(defaults={}) == {dbc.MIN_POOL_SIZE: 5}
+
+
+def test_pool_settings_read_when_connecting():
+    # too big for the PythonAnywhere pool, but only a cloud client cares
+    env = dict(os.environ, MONGO_MIN_POOL_SIZE='5', SENS_STORAGE='memory')
+    subprocess.run([sys.executable, '-c', 'import data.db_connect as dbc; dbc.connect_db()'],
+                   env=env, check=True, cwd=os.path.dirname(os.path.dirname(dbc.__file__)))
+
+
+@pytest.mark.parametrize('name, val', [
+    ('MONGO_MAX_POOL_SIZE', 'lots'),
+    ('MONGO_MAX_POOL_SIZE', '0'),
+    ('MONGO_MIN_POOL_SIZE', '5'),
+    ('MONGO_CONNECT', 'maybe'),
+    ('MONGO_COMPRESSORS', 'gzip'),
+    ('MONGO_READ_PREFERENCE', 'anywhere'),
+])
+def test_client_settings_bad(monkeypatch, name, val):
+    monkeypatch.setenv(name, val)
+    with pytest.raises(ValueError):
+        dbc.client_settings()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs os.fork')
+def test_child_forgets_client(monkeypatch):
+    monkeypatch.setattr(dbc, 'client', MagicMock())
+    monkeypatch.setattr(dbc, 'WARM_UP', False)
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0 if dbc.client is None else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert dbc.client is not None
+
+
+@patch('data.db_connect.client')
+def test_warm_up_pings(mock_client):
+    dbc.warm_up()
+    mock_client.admin.command.assert_called_once_with('ping')
+
+
+def test_plan_stages():
+    plan = {'stage': 'FETCH', 'inputStage': {'stage': 'OR', 'inputStages': [
+        {'stage': 'IXSCAN'}, {'stage': 'COLLSCAN'}]}}
+    assert list(dbc.plan_stages(plan)) == ['FETCH', 'OR', 'IXSCAN', 'COLLSCAN']
+
+
+@patch('data.db_connect.client')
+def test_is_collscan(mock_client):
+    coll = mock_client[dbc.SENS_DB]['cities']
+    coll.find.return_value.explain.return_value = {
+        'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN'}, 'rejectedPlans': []}}
+    assert dbc.is_collscan('cities', {'city': ''})
+    coll.find.return_value.explain.return_value = {
+        'queryPlanner': {'winningPlan': {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}},
+                         'rejectedPlans': [{'stage': 'COLLSCAN'}]}}
+    assert not dbc.is_collscan('cities', {'city': ''})
+
+
+def test_ensure_indexes(monkeypatch, tmp_path):
+    monkeypatch.setattr(dbc.storage, 'INDEXES', {'idx_test': [dbc.Index(['a', 'b'], unique=True)]})
+    monkeypatch.setattr(dbc.storage, 'QUERY_SHAPES', {'idx_test': [['a', 'b'], ['a'], ['b']]})
+    client = dbc.storage.SQLiteClient(str(tmp_path / 'test.db'))
+    monkeypatch.setattr(dbc, 'client', client)
+    report = dbc.ensure_indexes()
+    assert report['idx_test'][dbc.FAILED] == {}
+    assert report['idx_test'][dbc.COLLSCANS] == [['b']]
+    assert dbc.index_problems(report)
+    assert 'a_1_b_1' in client[dbc.SENS_DB]['idx_test'].index_information()
+    client.close()
+
+
+def test_ensure_indexes_creates_missing(monkeypatch):
+    monkeypatch.setattr(dbc.storage, 'INDEXES', {'idx_test': [dbc.Index(['a'], unique=True)]})
+    monkeypatch.setattr(dbc.storage, 'QUERY_SHAPES', {})
+    monkeypatch.setattr(dbc, 'client', dbc.storage.MemoryClient())
+    assert dbc.ensure_indexes()['idx_test'][dbc.CREATED] == ['a_1']
+    assert dbc.ensure_indexes()['idx_test'][dbc.CREATED] == []
+
+
+def test_ensure_indexes_reports_duplicates(monkeypatch, tmp_path):
+    monkeypatch.setattr(dbc.storage, 'INDEXES', {})
+    client = dbc.storage.SQLiteClient(str(tmp_path / 'test.db'))
+    monkeypatch.setattr(dbc, 'client', client)
+    coll = client[dbc.SENS_DB]['idx_test']
+    coll.insert_one({'a': 1})
+    coll.insert_one({'a': 1})
+    monkeypatch.setattr(dbc.storage, 'INDEXES', {'idx_test': [dbc.Index(['a'], unique=True)]})
+    report = dbc.ensure_indexes()
+    assert list(report['idx_test'][dbc.FAILED]) == ['a_1']
+    assert dbc.index_report_lines(report) == [
+        f'idx_test: could not create index a_1: {report["idx_test"][dbc.FAILED]["a_1"]}']
+    client.close()
+
+
+@patch('data.db_connect.client')
+def test_upsert_one_round_trip(mock_client):
+    coll = mock_client[dbc.SENS_DB]['cities']
+    coll.find_one_and_update.return_value = {'city': 'Albany', 'pop': 1}
+    assert dbc.upsert('cities', {'city': 'Albany'}, {'pop': 1}, no_id=True) == {'city': 'Albany', 'pop': 1}
+    coll.find_one_and_update.assert_called_once_with(
+        {'city': 'Albany'}, {'$set': {'pop': 1}}, projection={'_id': 0},
+        upsert=True, return_document=pm.ReturnDocument.AFTER)
+
+
+@pytest.mark.parametrize('ordered, failed, written', [
+    (True, [3], [0, 1, 2]),
+    (False, [3], [0, 1, 2, 4]),
+])
+def test_bulk_write_errors_across_chunks(monkeypatch, ordered, failed, written):
+    monkeypatch.setattr(dbc, 'client', dbc.storage.MemoryClient())
+    docs = [{'_id': i} for i in range(3)] + [{'_id': 0}, {'_id': 4}]
+    with pytest.raises(BulkWriteError) as err:
+        dbc.create_many('things', [dict(doc) for doc in docs], chunk_size=2, ordered=ordered)
+    assert list(dbc.failed_ops(err.value)) == failed
+    assert err.value.details['nInserted'] == len(written)
+    assert [doc['_id'] for doc in dbc.written(docs, err.value, ordered)] == written
+    assert sorted(doc['_id'] for doc in dbc.read('things', no_id=False)) == [str(i) for i in written]
@@ -0,0 +1,169 @@
+import threading
+
+import pymongo as pm
+import pytest
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+import data.storage as stg
+
+TEST_COLLECTION = 'cities'
+DOCS = [
+    {'city': 'Albany', 'state_code': 'NY', 'country_code': 'USA', 'pop': 100},
+    {'city': 'Buffalo', 'state_code': 'NY', 'country_code': 'USA', 'pop': 300},
+    {'city': 'Austin', 'state_code': 'TX', 'country_code': 'USA', 'pop': 900},
+]
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def coll(request, tmp_path):
+    if request.param == 'memory':
+        client = stg.MemoryClient()
+    else:
+        client = stg.SQLiteClient(str(tmp_path / 'test.db'))
+    coll = client['testDB'][TEST_COLLECTION]
+    for doc in DOCS:
+        coll.insert_one(dict(doc))
+    yield coll
+    client.close()
+
+
+def names(docs):
+    return [doc['city'] for doc in docs]
+
+
+def test_find_equality(coll):
+    assert names(coll.find({'state_code': 'NY'})) == ['Albany', 'Buffalo']
+    assert coll.find_one({'city': 'Nowhere'}) is None
+
+
+def test_find_in_and_or(coll):
+    assert names(coll.find({'city': {'$in': ['Austin', 'Albany']}})) == ['Albany', 'Austin']
+    filt = {'$or': [{'city': 'Austin', 'state_code': 'TX'},
+                    {'city': 'Buffalo', 'state_code': 'TX'}]}
+    assert names(coll.find(filt)) == ['Austin']
+
+
+def test_find_falls_back_to_python(coll):
+    assert names(coll.find({'pop': {'$exists': True, '$ne': 300}})) == ['Albany', 'Austin']
+
+
+def test_unsupported_operator(coll):
+    with pytest.raises(stg.UnsupportedQuery):
+        list(coll.find({'pop': {'$gt': 1}}))
+
+
+def test_projection_sort_skip_limit(coll):
+    docs = list(coll.find({}, {'city': 1, '_id': 0}, sort=[('pop', pm.DESCENDING)],
+                          skip=1, limit=1))
+    assert docs == [{'city': 'Buffalo'}]
+
+
+def test_insert_sets_id(coll):
+    doc = {'city': 'Ithaca'}
+    result = coll.insert_one(doc)
+    assert doc['_id'] == result.inserted_id
+    with pytest.raises(DuplicateKeyError):
+        coll.insert_one(doc)
+
+
+def test_update_and_delete(coll):
+    result = coll.update_one({'city': 'Albany'}, {'$set': {'pop': 101}})
+    assert (result.matched_count, result.modified_count) == (1, 1)
+    assert coll.find_one({'city': 'Albany'})['pop'] == 101
+    result = coll.update_one({'city': 'Albany'}, {'$set': {'pop': 101}})
+    assert (result.matched_count, result.modified_count) == (1, 0)
+    assert coll.update_one({'city': 'Nowhere'}, {'$set': {'pop': 1}}).matched_count == 0
+    assert coll.delete_one({'city': 'Albany'}).deleted_count == 1
+    assert coll.delete_one({'city': 'Albany'}).deleted_count == 0
+
+
+def test_bulk_write(coll):
+    result = coll.bulk_write([
+        pm.UpdateOne({'city': 'Albany', 'state_code': 'NY'}, {'$set': {'pop': 5}}, upsert=True),
+        pm.UpdateOne({'city': 'Ithaca', 'state_code': 'NY'}, {'$set': {'pop': 7}}, upsert=True),
+        pm.InsertOne({'city': 'Utica'}),
+        pm.DeleteOne({'city': 'Austin'}),
+    ])
+    assert (result.matched_count, result.modified_count, result.upserted_count,
+            result.inserted_count, result.deleted_count) == (1, 1, 1, 1, 1)
+    assert coll.find_one({'city': 'Ithaca'}, {'_id': 0}) == {'city': 'Ithaca', 'state_code': 'NY', 'pop': 7}
+
+
+def test_docs_are_copies(coll):
+    doc = coll.find_one({'city': 'Albany'})
+    doc['pop'] = 0
+    assert coll.find_one({'city': 'Albany'})['pop'] == 100
+
+
+def test_concurrent_upserts(coll):
+    def run(i):
+        for j in range(20):
+            coll.update_one({'city': f'c{i}-{j}'}, {'$set': {'n': j}}, upsert=True)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert coll.count_documents({'n': {'$in': list(range(20))}}) == 80
+
+
+def test_sqlite_builds_registered_indexes(tmp_path, monkeypatch):
+    monkeypatch.setitem(stg.INDEXES, 'idx_test', [stg.Index(['city', 'state_code'], unique=True)])
+    client = stg.SQLiteClient(str(tmp_path / 'test.db'))
+    coll = client['testDB']['idx_test']
+    assert 'city_1_state_code_1' in coll.index_information()
+    plan = coll.find({'city': 'Albany', 'state_code': 'NY'}).explain()
+    assert plan['queryPlanner']['winningPlan']['stage'] == stg.IXSCAN
+    plan = coll.find({'state_code': 'NY'}).explain()
+    assert plan['queryPlanner']['winningPlan']['stage'] == stg.COLLSCAN
+    coll.insert_one({'city': 'Albany', 'state_code': 'NY'})
+    with pytest.raises(DuplicateKeyError):
+        coll.insert_one({'city': 'Albany', 'state_code': 'NY'})
+    client.close()
+
+
+def test_index_keys():
+    assert stg.Index(['a', ('b', -1)]).keys == [('a', 1), ('b', -1)]
+    assert stg.Index('a').name == 'a_1'
+
+
+def test_sqlite_keeps_data(tmp_path):
+    path = str(tmp_path / 'test.db')
+    client = stg.SQLiteClient(path)
+    client['testDB']['kept'].insert_one({'city': 'Albany'})
+    client.close()
+    client = stg.SQLiteClient(path)
+    assert client['testDB']['kept'].find_one({'city': 'Albany'}, {'_id': 0}) == {'city': 'Albany'}
+    client.close()
+
+
+def test_find_one_and_update(coll):
+    doc = coll.find_one_and_update({'city': 'Albany'}, {'$set': {'pop': 5}}, {'_id': 0},
+                                   return_document=pm.ReturnDocument.AFTER)
+    assert doc == dict(DOCS[0], pop=5)
+    doc = coll.find_one_and_update({'city': 'Albany'}, {'$set': {'pop': 6}}, {'_id': 0})
+    assert doc['pop'] == 5
+    assert coll.find_one_and_update({'city': 'Ithaca'}, {'$set': {'pop': 7}}) is None
+    doc = coll.find_one_and_update({'city': 'Ithaca'}, {'$set': {'pop': 7}}, {'_id': 0},
+                                   upsert=True, return_document=pm.ReturnDocument.AFTER)
+    assert doc == {'city': 'Ithaca', 'pop': 7}
+    assert coll.count_documents({'city': 'Ithaca'}) == 1
+
+
+@pytest.mark.parametrize('ordered, failed, written', [
+    (True, [1], ['Ithaca']),
+    (False, [1, 3], ['Ithaca', 'Utica']),
+])
+def test_bulk_write_errors(coll, ordered, failed, written):
+    _id = coll.find_one({'city': 'Albany'})['_id']
+    with pytest.raises(BulkWriteError) as err:
+        coll.bulk_write([
+            pm.InsertOne({'city': 'Ithaca'}),
+            pm.InsertOne({'_id': _id, 'city': 'Albany'}),
+            pm.InsertOne({'city': 'Utica'}),
+            pm.InsertOne({'_id': _id, 'city': 'Albany'}),
+        ], ordered=ordered)
+    assert [e['index'] for e in err.value.details['writeErrors']] == failed
+    assert err.value.details['nInserted'] == len(written)
+    assert names(coll.find({'city': {'$in': ['Ithaca', 'Utica']}})) == written
@@ -0,0 +1,25 @@
+"""
+Create the indexes the query modules declare, and report the query
+shapes that would still scan a whole collection.
+Exits with status 1 if an index could not be built or a shape scans.
+"""
+import sys
+
+import cities.cities_queries  # noqa: F401
+import countries.country_queries  # noqa: F401
+import states.states_queries  # noqa: F401
+import users.users_queries  # noqa: F401
+import data.db_connect as dbc
+
+
+def main():
+    report = dbc.ensure_indexes()
+    for line in dbc.index_report_lines(report):
+        print(line)
+    if dbc.index_problems(report):
+        sys.exit(1)
+    print(f'Indexes are in place for {", ".join(report)}.')
+
+
+if __name__ == "__main__":
+    main()
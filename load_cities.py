@@ -34,40 +34,45 @@ def transform(rows: list) -> list:
 def load(rev_list: list):
     created_count = 0
     updated_count = 0
+    unchanged_count = 0
     error_count = 0
 
+    actions = []
     for city in rev_list:
+        # Exists check using your current API
         try:
-            city_name = city.get("city")
-            state_code = city.get("state_code")
-            country_code = city.get("country_code")
-            rec_restaurant = city.get("rec_restaurant")
-
-            # Exists check using your current API
-            try:
-                ct.read_one(city_name, state_code, country_code)
-                action = "Updated"
-                updated_count += 1
-            except ValueError:
-                action = "Created"
-                created_count += 1
-
-            extra_fields = {
-                k: v for k, v in city.items()
-                if k not in ["city", "state_code", "country_code", "rec_restaurant"]
-            }
-
-            # Upsert (no custom _id)
-            ct.add_city(country_code, state_code, city_name, rec_restaurant, **extra_fields)
-
-            print(f"✓ {action}: {city_name}")
-            print(f"   Country: {country_code}")
-            print(f"   State Code: {state_code}")
-            print(f"   Recommended Restaurant: {rec_restaurant}")
-
-        except Exception as e:
-            print(f"✗ Error loading {city.get('city', 'Unknown')}: {e}")
+            ct.read_one(city.get("city"), city.get("state_code"), city.get("country_code"))
+            actions.append("Updated")
+        except ValueError:
+            actions.append("Created")
+
+    # this script owns the rows it loads, so rows the cache already holds
+    # as-is need no write; the rest go in one batched upsert (no custom
+    # _id), not a round trip and a new cache snapshot per row
+    to_write = {id(city) for city in ct.cache.changed(rev_list)}
+    try:
+        ct.add_cities([city for city in rev_list if id(city) in to_write])
+        write_error = None
+    except Exception as e:
+        write_error = e
+
+    for city, action in zip(rev_list, actions):
+        if id(city) not in to_write:
+            action = "Unchanged"
+            unchanged_count += 1
+        elif write_error is not None:
+            print(f"✗ Error loading {city.get('city', 'Unknown')}: {write_error}")
             error_count += 1
+            continue
+        elif action == "Updated":
+            updated_count += 1
+        else:
+            created_count += 1
+
+        print(f"✓ {action}: {city.get('city')}")
+        print(f"   Country: {city.get('country_code')}")
+        print(f"   State Code: {city.get('state_code')}")
+        print(f"   Recommended Restaurant: {city.get('rec_restaurant')}")
 
     time.sleep(0.5)
     ct.load_cache()
@@ -76,6 +81,7 @@ def load(rev_list: list):
     print("Summary:")
     print(f"  Created: {created_count}")
     print(f"  Updated: {updated_count}")
+    print(f"  Unchanged: {unchanged_count}")
     print(f"  Failed: {error_count}")
     print(f"  Total cities in database: {ct.count()}")
     print(f"{'=' * 60}")
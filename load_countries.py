@@ -34,42 +34,47 @@ def load(rev_list: list):
     error_count = 0
     created_count = 0
     updated_count = 0
+    unchanged_count = 0
 
+    actions = []
     for country in rev_list:
+        # Check if it exists before adding
         try:
-            # Check if country already exists
-            country_id = country.get('_id')
-            name = country.get('name')
-            capital = country.get('capital')
-
-            # Check if it exists before adding
-            try:
-                cntry.get_country(country_id)
-                action = "Updated"
-                updated_count += 1
-            except ValueError:
-                action = "Created"
-                created_count += 1
-
-            # Extract optional fields (nat_dish, pop_dish_1, pop_dish_2)
-            extra_fields = {
-                k: v for k, v in country.items()
-                if k not in ['_id', 'name', 'capital']
-            }
-
-            # Call add_country with extra fields
-            cntry.add_country(country_id, name, capital, **extra_fields)
-
-            print(f"✓ {action}: {name} ({country_id})")
-            print(f"   Capital: {capital}")
-            print(f"   National Dish: {extra_fields.get('nat_dish', 'N/A')}")
-            dishes = f"{extra_fields.get('pop_dish_1', 'N/A')}, {extra_fields.get('pop_dish_2', 'N/A')}"
-            print(f"   Popular Dishes: {dishes}")
-            success_count += 1
-
-        except Exception as e:
-            print(f"✗ Error loading {country.get('name', 'Unknown')}: {e}")
+            cntry.get_country(country.get('_id'))
+            actions.append("Updated")
+        except ValueError:
+            actions.append("Created")
+
+    # this script owns the rows it loads, so rows the cache already holds
+    # as-is need no write; the rest (with their optional fields like
+    # nat_dish, pop_dish_1, pop_dish_2) go in one batched upsert, not a
+    # round trip and a new cache snapshot per row
+    to_write = {id(country) for country in cntry.country_cache.changed(rev_list)}
+    try:
+        cntry.add_countries([country for country in rev_list if id(country) in to_write])
+        write_error = None
+    except Exception as e:
+        write_error = e
+
+    for country, action in zip(rev_list, actions):
+        if id(country) not in to_write:
+            action = "Unchanged"
+            unchanged_count += 1
+        elif write_error is not None:
+            print(f"✗ Error loading {country.get('name', 'Unknown')}: {write_error}")
             error_count += 1
+            continue
+        elif action == "Updated":
+            updated_count += 1
+        else:
+            created_count += 1
+
+        print(f"✓ {action}: {country.get('name')} ({country.get('_id')})")
+        print(f"   Capital: {country.get('capital')}")
+        print(f"   National Dish: {country.get('nat_dish', 'N/A')}")
+        dishes = f"{country.get('pop_dish_1', 'N/A')}, {country.get('pop_dish_2', 'N/A')}"
+        print(f"   Popular Dishes: {dishes}")
+        success_count += 1
 
     # Force reload cache after ALL inserts are done
     time.sleep(0.5)
@@ -79,6 +84,7 @@ def load(rev_list: list):
     print("Summary:")
     print(f"  Created: {created_count}")
     print(f"  Updated: {updated_count}")
+    print(f"  Unchanged: {unchanged_count}")
     print(f"  Failed: {error_count}")
     print(f"  Total countries in database: {cntry.num_countries()}")
     print(f"{'=' * 60}")
@@ -34,38 +34,52 @@ def transform(rows: list) -> list:
 def load(rev_list: list):
     created_count = 0
     updated_count = 0
+    unchanged_count = 0
     error_count = 0
 
+    loaded = []
     for state in rev_list:
         try:
-            name = state.get("name")
-            state_code = state.get("state_code")
-            country_code = state.get("country_code")
-
-            # Exists check using your current API
-            try:
-                st.read_one(state_code, country_code)
-                action = "Updated"
-                updated_count += 1
-            except ValueError:
-                action = "Created"
-                created_count += 1
-
-            extra_fields = {
-                k: v for k, v in state.items()
-                if k not in ["name", "state_code", "country_code"]
-            }
-
-            # Upsert (no custom _id)
-            st.add_state(country_code, state_code, name, **extra_fields)
-
-            print(f"✓ {action}: {name}")
-            print(f"   Country: {country_code}")
-            print(f"   State Code: {state_code}")
-
-        except Exception as e:
+            doc = st.state_doc(state)
+        except ValueError as e:
             print(f"✗ Error loading {state.get('name', 'Unknown')}: {e}")
             error_count += 1
+            continue
+
+        # Exists check using your current API
+        try:
+            st.read_one(doc["state_code"], doc["country_code"])
+            action = "Updated"
+        except ValueError:
+            action = "Created"
+        loaded.append((doc, action))
+
+    # this script owns the rows it loads, so rows the cache already holds
+    # as-is need no write; the rest go in one batched upsert (no custom
+    # _id), not a round trip and a new cache snapshot per row
+    to_write = {id(doc) for doc in st.cache.changed(doc for doc, _action in loaded)}
+    try:
+        st.add_states([doc for doc, _action in loaded if id(doc) in to_write])
+        write_error = None
+    except Exception as e:
+        write_error = e
+
+    for doc, action in loaded:
+        if id(doc) not in to_write:
+            action = "Unchanged"
+            unchanged_count += 1
+        elif write_error is not None:
+            print(f"✗ Error loading {doc['name']}: {write_error}")
+            error_count += 1
+            continue
+        elif action == "Updated":
+            updated_count += 1
+        else:
+            created_count += 1
+
+        print(f"✓ {action}: {doc['name']}")
+        print(f"   Country: {doc['country_code']}")
+        print(f"   State Code: {doc['state_code']}")
 
     time.sleep(0.5)
     st.load_cache()
@@ -74,6 +88,7 @@ def load(rev_list: list):
     print("Summary:")
     print(f"  Created: {created_count}")
     print(f"  Updated: {updated_count}")
+    print(f"  Unchanged: {unchanged_count}")
     print(f"  Failed: {error_count}")
     print(f"  Total states in database: {st.count()}")
     print(f"{'=' * 60}")
@@ -0,0 +1,179 @@
+"""
+Streaming ingestion of uploaded rows.
+
+An upload is read from the request stream a row at a time, either as
+NDJSON (one JSON object per line) or as a single JSON array, checked row
+by row, and written in batches, so memory use depends on the batch size
+and not on the size of the upload. A status is produced for every row.
+"""
+import codecs
+import json
+import os
+
+from pymongo.errors import BulkWriteError
+
+import data.db_connect as dbc
+
+NDJSON = 'application/x-ndjson'
+JSON = 'application/json'
+
+# rows written per DB round trip
+BATCH_SIZE = int(os.getenv('BULK_BATCH_SIZE', 500))
+# longest row we will buffer, in bytes
+MAX_ROW_BYTES = int(os.getenv('BULK_MAX_ROW_BYTES', 1024 * 1024))
+READ_SIZE = 64 * 1024
+
+# keys of the per-row status records
+ROW = 'row'
+STATUS = 'status'
+ERROR = 'error'
+OK = 'ok'
+SUMMARY = 'summary'
+ROWS = 'rows'
+ERRORS = 'errors'
+
+NOT_WRITTEN = 'Not written: an earlier row in its batch failed'
+
+
+def iter_ndjson(stream, max_row=MAX_ROW_BYTES):
+    """
+    Yield (row number, data, error) for each non-blank line of stream.
+    data is None when the line could not be parsed; error says why.
+    """
+    row = 0
+    while True:
+        line = stream.readline(max_row + 1)
+        if not line:
+            return
+        if len(line) > max_row:
+            # skip the rest of an over-long line
+            while line and not line.endswith(b'\n'):
+                line = stream.readline(max_row + 1)
+            row += 1
+            yield row, None, f'Row longer than {max_row} bytes'
+            continue
+        if not line.strip():
+            continue
+        row += 1
+        try:
+            yield row, json.loads(line), None
+        except ValueError as e:
+            yield row, None, f'Bad JSON: {e}'
+
+
+def iter_json_array(stream, max_row=MAX_ROW_BYTES):
+    """
+    Yield (row number, data, error) for each element of a JSON array,
+    decoding it incrementally. A syntax error ends the upload, as there
+    is no telling where the next row would start.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    eof = False
+    started = False
+    row = 0
+    while True:
+        buf = buf.lstrip()
+        if started:
+            buf = buf.lstrip(',').lstrip()
+        elif buf:
+            if buf[0] != '[':
+                yield row + 1, None, 'Body must be a JSON array'
+                return
+            started = True
+            buf = buf[1:]
+            continue
+        if buf.startswith(']'):
+            return
+        if buf:
+            try:
+                data, end = decoder.raw_decode(buf)
+            except ValueError as e:
+                if eof or len(buf) > max_row:
+                    yield row + 1, None, f'Bad JSON: {e}'
+                    return
+            else:
+                row += 1
+                buf = buf[end:]
+                yield row, data, None
+                continue
+        if eof:
+            if buf or not started:
+                yield row + 1, None, 'Unexpected end of JSON array'
+            return
+        chunk = stream.read(READ_SIZE)
+        eof = not chunk
+        buf += text_decoder.decode(chunk, final=eof)
+
+
+def iter_rows(stream, mimetype: str):
+    if mimetype == JSON:
+        return iter_json_array(stream)
+    return iter_ndjson(stream)
+
+
+def row_status(row: int, error: str = None) -> dict:
+    if error is None:
+        return {ROW: row, STATUS: OK}
+    return {ROW: row, STATUS: ERROR, ERROR: error}
+
+
+def write_batch(batch: list, add_many):
+    """
+    Write a batch of (row number, doc) and yield the status of each row.
+    add_many writes the docs in order and stops at the first that fails,
+    so the rows before it are ok and those after it weren't written.
+    """
+    try:
+        add_many([doc for _row, doc in batch])
+        failed = {}
+    except BulkWriteError as e:
+        failed = dbc.failed_ops(e)
+    except Exception as e:
+        failed = {index: str(e) for index in range(len(batch))}
+    first = min(failed, default=len(batch))
+    for index, (row, _doc) in enumerate(batch):
+        if index in failed:
+            yield row_status(row, failed[index])
+        elif index > first:
+            yield row_status(row, NOT_WRITTEN)
+        else:
+            yield row_status(row)
+
+
+def ingest(rows, to_doc, add_many, batch_size=BATCH_SIZE):
+    """
+    Turn each (row number, data, error) of rows into a doc with to_doc,
+    which raises ValueError for a bad row, and write the docs with
+    add_many a batch at a time. Yields a status for every row and then
+    a summary.
+    """
+    counts = {ROWS: 0, OK: 0, ERRORS: 0}
+    batch = []
+
+    def tally(statuses):
+        for status in statuses:
+            counts[ROWS] += 1
+            counts[OK if status[STATUS] == OK else ERRORS] += 1
+            yield status
+
+    for row, data, error in rows:
+        if error is None:
+            try:
+                batch.append((row, to_doc(data)))
+            except ValueError as e:
+                error = str(e)
+        if error is not None:
+            yield from tally([row_status(row, error)])
+        elif len(batch) >= batch_size:
+            yield from tally(write_batch(batch, add_many))
+            batch = []
+    if batch:
+        yield from tally(write_batch(batch, add_many))
+    yield {SUMMARY: counts}
+
+
+def as_ndjson(records):
+    for record in records:
+        yield json.dumps(record, separators=(',', ':')) + '\n'
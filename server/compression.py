@@ -0,0 +1,109 @@
+"""
+Negotiated compression of response bodies.
+
+gzip is always available; brotli and zstd are used when their libraries
+are installed. Bodies built by the response cache are compressed once
+per encoding and the compressed bytes are kept with the cached body.
+"""
+import gzip
+import os
+
+from flask import g, request
+
+import server.response_cache as rc
+
+try:
+    import brotli
+except ImportError:  # optional
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # optional
+    zstandard = None
+
+GZIP = 'gzip'
+BROTLI = 'br'
+ZSTD = 'zstd'
+
+# bodies smaller than this are sent as they are
+MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+GZIP_LEVEL = int(os.getenv('COMPRESS_GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.getenv('COMPRESS_BROTLI_QUALITY', 5))
+ZSTD_LEVEL = int(os.getenv('COMPRESS_ZSTD_LEVEL', 3))
+
+COMPRESSIBLE_TYPES = {'application/json', 'text/html', 'text/plain', 'text/csv'}
+
+
+def compress_gzip(data: bytes) -> bytes:
+    # mtime=0 so the same body always compresses to the same bytes
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def compress_brotli(data: bytes) -> bytes:
+    return brotli.compress(data, quality=BROTLI_QUALITY)
+
+
+def compress_zstd(data: bytes) -> bytes:
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+
+# {encoding: compress fn}, in order of preference
+COMPRESSORS = {}
+if brotli is not None:
+    COMPRESSORS[BROTLI] = compress_brotli
+if zstandard is not None:
+    COMPRESSORS[ZSTD] = compress_zstd
+COMPRESSORS[GZIP] = compress_gzip
+
+
+def choose_encoding():
+    """
+    The encoding the client accepts that we like best, or None.
+    """
+    return request.accept_encodings.best_match(list(COMPRESSORS))
+
+
+def compressed_body(data: bytes, encoding: str) -> bytes:
+    """
+    Compress data, reusing the compressed bytes kept with the cached body
+    of this request when there is one.
+    """
+    cached = g.get('cached_body')
+    if cached is None:
+        return COMPRESSORS[encoding](data)
+    key, entry = cached
+    variant = entry.variants.get(encoding)
+    if variant is None:
+        variant = COMPRESSORS[encoding](data)
+        rc.response_cache.add_variant(key, entry, encoding, variant)
+    return variant
+
+
+def compressible(response) -> bool:
+    if response.status_code != 200 or response.direct_passthrough:
+        return False
+    if response.is_streamed or 'Content-Encoding' in response.headers:
+        return False
+    return response.mimetype in COMPRESSIBLE_TYPES
+
+
+def compress_response(response):
+    """
+    after_request hook: compress the body if the client takes it and it
+    is worth it. A compressed body gets a weak ETag, since it is the same
+    data as the uncompressed one but not the same bytes.
+    """
+    if not compressible(response):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding()
+    data = response.get_data()
+    if encoding is None or len(data) < MIN_SIZE:
+        return response
+    response.set_data(compressed_body(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -2,7 +2,10 @@
 This is the file containing all of the endpoints for our flask app.
 The endpoint called `endpoints` will return all available endpoints.
 """
+import base64
+import json
 import os
+import time
 from datetime import timedelta
 from functools import wraps
 # from http import HTTPStatus
@@ -10,10 +13,17 @@ import cities.cities_queries as cqry
 import countries.country_queries as cntry
 import states.states_queries as sqry
 import users.users_queries as user_qry
+import server.bulk as bulk
+import server.compression as compression
+import server.export as export
+import server.response_cache as rc
 
-from flask import Flask, request, session
+from flask import Flask, Response, g, request, session, stream_with_context
 from flask_restx import Resource, Api  # , fields  # Namespace
 from flask_cors import CORS
+from werkzeug.http import http_date, quote_etag
+
+from data.db_connect import ENSURE_INDEXES, ensure_indexes_in_background, trim_doc
 
 # import werkzeug.exceptions as wz
 
@@ -28,6 +38,11 @@ authorizations = {
     }
 }
 api = Api(app, authorizations=authorizations)
+app.after_request(compression.compress_response)
+
+# the query modules imported above have registered their indexes
+if ENSURE_INDEXES:
+    ensure_indexes_in_background()
 
 ERROR = "Error"
 READ = "read"
@@ -48,10 +63,39 @@ STATE_RESP = "States"
 CITIES_EPS = "/cities"
 CITY_RESP = "Cities"
 
+# keyset pagination
+LIMIT = "limit"
+AFTER = "after"
+NEXT = "next"
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# sparse fieldsets
+FIELDS = "fields"
+
+# batch lookups
+KEYS = "keys"
+MISSING = "missing"
+MAX_BATCH_KEYS = 1000
+
+EXPORT_EP = "/export"
+FORMAT = "format"
+COUNTRY = "country"
+STATE = "state"
+
 HEALTH_EP = "/health"
 VERSION_EP = "/version"
 VERSION_NAME = "project-sens"
 
+# the in-memory caches of each collection, by collection name
+RESPONSES = "responses"
+CACHES = {
+    cqry.CITY_COLLECTION: cqry.cache,
+    sqry.STATE_COLLECTION: sqry.cache,
+    cntry.COUNTRY_COLLECTION: cntry.country_cache,
+    user_qry.USERS_COLLECTION: user_qry.cache,
+}
+
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=31)
 app.config['SESSION_COOKIE_SECURE'] = True  # Set True in production with HTTPS
@@ -81,6 +125,82 @@ def developer_required(f):
     return login_required(decorated_function)
 
 
+def unpack(resp):
+    """
+    Split a Resource method's return value into (data, status, headers).
+    """
+    if not isinstance(resp, tuple):
+        return resp, 200, {}
+    data = resp[0]
+    status = resp[1] if len(resp) > 1 else 200
+    headers = dict(resp[2]) if len(resp) > 2 else {}
+    return data, status, headers
+
+
+def not_modified(etag: str, last_modified) -> bool:
+    """
+    Do the request's validators show the client already has this?
+    If-Modified-Since only counts when there is no If-None-Match, and
+    when there is a last_modified to compare it with.
+    Weak tags match too: compressed responses carry a weak ETag.
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    ims = request.if_modified_since
+    return None not in (ims, last_modified) and ims.timestamp() >= last_modified
+
+
+def settled_last_modified(modified_at: float):
+    """
+    Last-Modified has whole seconds, so it can only vouch for a snapshot
+    once the second it was published in is over: until then, another
+    write in that second would get the same date. Returns None before.
+    """
+    last_modified = int(modified_at)
+    return last_modified if time.time() >= last_modified + 1 else None
+
+
+def conditional(*caches):
+    """
+    Tag successful responses with an ETag and Last-Modified derived from
+    the snapshots of the caches they are built from, and answer a
+    matching conditional GET with a 304 without running the endpoint.
+    Until every cache is loaded the endpoint just runs. After that the
+    snapshots are taken first, through the caches' freshness policy,
+    so a TTL or invalidate() takes effect even on requests that never
+    reach the endpoint. The ETag is built from the content digests of
+    the snapshots, so every worker gives the same tag for the same data.
+    Successful bodies are encoded once per tag and kept in the response
+    cache, so repeats of the same request are served from those bytes
+    (and compressed variants of them).
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not all(cache.is_loaded() for cache in caches):
+                # the endpoint loads them; tag the responses after that
+                return fn(*args, **kwargs)
+            snaps = [cache.snapshot() for cache in caches]
+            etag = '.'.join(snap.content_digest() for snap in snaps)
+            last_modified = settled_last_modified(max(snap.modified_at for snap in snaps))
+            validators = {'ETag': quote_etag(etag)}
+            if last_modified is not None:
+                validators['Last-Modified'] = http_date(last_modified)
+            if not_modified(etag, last_modified):
+                return Response(status=304, headers=validators)
+            key = (request.path, tuple(sorted(request.args.items(multi=True))))
+            entry = rc.response_cache.get(key, etag)
+            if entry is None:
+                data, status, headers = unpack(fn(*args, **kwargs))
+                if status != 200 or headers:
+                    return data, status, headers
+                entry = rc.response_cache.put(key, etag, rc.encode_json(data))
+            g.cached_body = (key, entry)
+            return Response(entry.body, mimetype='application/json', headers=validators)
+        return wrapper
+    return decorator
+
+
 @api.route(f'{CITIES_EPS}/{READ}')
 class Cities(Resource):
     """
@@ -88,19 +208,28 @@ class Cities(Resource):
     app is working at all.
     """
 
+    @conditional(cqry.cache)
     def get(self):
         """
         A trivial endpoint to see if the server is running.
         """
 
         try:
-            cqry.load_cache()
+            page = parse_page_args()
+        except ValueError as e:
+            return {ERROR: str(e)}, 400
+        fields = parse_fields()
+        try:
+            if page is not None:
+                docs, next_key = cqry.read_page(*page)
+                return {
+                    CITY_RESP: sparse({doc[cqry.CITY]: doc for doc in docs}, fields),
+                    NEXT: encode_cursor(next_key),
+                }
             cities = cqry.read()
-        # prints out the names and the valies with f string
         except ConnectionError as e:
             return {ERROR: str(e)}
-        print(f'{cities=}')
-        return {CITY_RESP: cities}
+        return {CITY_RESP: sparse(cities, fields)}
 
 
 @api.route(HELLO_EP)
@@ -168,6 +297,128 @@ def parse_limit(raw):
     return n
 
 
+def encode_cursor(sort_key):
+    """
+    Make an opaque ?after= cursor from a page's last sort key.
+    """
+    if sort_key is None:
+        return None
+    raw = json.dumps(list(sort_key), separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """
+    Turn an ?after= cursor back into a sort key.
+    Raises ValueError if it isn't one of ours.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        sort_key = json.loads(raw)
+    except (ValueError, TypeError):
+        raise ValueError(f"Bad cursor: {cursor}")
+    if not isinstance(sort_key, list) or not all(isinstance(part, str) for part in sort_key):
+        raise ValueError(f"Bad cursor: {cursor}")
+    return tuple(sort_key)
+
+
+def parse_page_args():
+    """
+    Return (limit, after) for a paginated request, or None when the
+    client asked for neither ?limit= nor ?after= and wants everything.
+    A bad ?limit= is ignored, as it always has been; a bad ?after= raises
+    ValueError.
+    """
+    try:
+        limit = parse_limit(request.args.get(LIMIT))
+    except ValueError:
+        limit = None
+    cursor = request.args.get(AFTER)
+    if limit is None and not cursor:
+        return None
+    after = decode_cursor(cursor) if cursor else None
+    return min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE), after
+
+
+def parse_fields():
+    """
+    Return the field names asked for with ?fields=a,b,c, in order and
+    without repeats, or None when the client wants whole documents.
+    """
+    raw = request.args.get(FIELDS, '')
+    fields = tuple(dict.fromkeys(fld.strip() for fld in raw.split(',') if fld.strip()))
+    return fields or None
+
+
+def sparse(docs, fields):
+    """
+    Trim a dict or list of docs to fields before they are serialized.
+    """
+    if fields is None:
+        return docs
+    if isinstance(docs, dict):
+        return {key: trim_doc(doc, fields) for key, doc in docs.items()}
+    return [trim_doc(doc, fields) for doc in docs]
+
+
+def parse_batch_keys(key_flds: list) -> list:
+    """
+    Read the keys of a batch lookup from a JSON body {"keys": [...]},
+    each key either an object with key_flds or a list of their values
+    in order (or a plain value when there is one key field).
+    Returns a list of tuples, or of plain values for one key field.
+    Raises ValueError on a malformed body.
+    """
+    body = request.get_json(silent=True)
+    keys = body.get(KEYS) if isinstance(body, dict) else None
+    if not isinstance(keys, list):
+        raise ValueError(f'Body must be {{"{KEYS}": [...]}}')
+    if len(keys) > MAX_BATCH_KEYS:
+        raise ValueError(f"At most {MAX_BATCH_KEYS} keys per batch")
+    parsed = []
+    for key in keys:
+        if isinstance(key, dict):
+            key = [key.get(fld) for fld in key_flds]
+        elif len(key_flds) == 1 and not isinstance(key, list):
+            key = [key]
+        if not isinstance(key, list) or len(key) != len(key_flds) or \
+                not all(isinstance(part, str) and part for part in key):
+            raise ValueError(f"Bad key: {key}")
+        parsed.append(key[0] if len(key_flds) == 1 else tuple(key))
+    return parsed
+
+
+def batch_response(resp_name: str, key_flds: list, get_many):
+    """
+    Resolve a batch lookup with get_many(keys) -> {key: doc}, answering
+    with the docs found, in request order, and the keys that weren't.
+    """
+    try:
+        keys = parse_batch_keys(key_flds)
+    except ValueError as e:
+        return {ERROR: str(e)}, 400
+    try:
+        found = get_many(keys)
+    except Exception as e:
+        return {ERROR: str(e)}, 500
+    fields = parse_fields()
+    return {
+        resp_name: [trim_doc(found[key], fields) for key in dict.fromkeys(keys) if key in found],
+        MISSING: [key for key in dict.fromkeys(keys) if key not in found],
+    }, 200
+
+
+def bulk_response(to_doc, add_many):
+    """
+    Ingest the NDJSON or JSON array request body with bulk.ingest(),
+    streaming back an NDJSON status line per row and a summary.
+    """
+    rows = bulk.iter_rows(request.stream, request.mimetype)
+    statuses = bulk.ingest(rows, to_doc, add_many)
+    return Response(stream_with_context(bulk.as_ndjson(statuses)),
+                    mimetype=bulk.NDJSON)
+
+
 @api.route(f'{CITIES_EPS}/add')
 class AddCity(Resource):
     def post(self):
@@ -227,22 +478,43 @@ class AddCity(Resource):
             return {ERROR: f"Unexpected error: {str(e)}"}, 500
 
 
+@api.route(f'{CITIES_EPS}/batch')
+class BatchCities(Resource):
+    def post(self):
+        """
+        Look up many cities in one request. Keys are
+        {"city", "state_code", "country_code"} objects or lists.
+        """
+        return batch_response(CITY_RESP, cqry.KEY_FLDS, cqry.get_cities)
+
+
+@api.route(f'{CITIES_EPS}/bulk')
+class BulkCities(Resource):
+    def post(self):
+        """
+        Add or update many cities, sent as NDJSON or a JSON array of
+        /cities/add bodies.
+        """
+        return bulk_response(cqry.city_doc, cqry.add_cities)
+
+
 @api.route(f'{CITIES_EPS}/<string:city_name>')
 class CityDetails(Resource):
     """
     Get details for a specific city
     """
+    @conditional(cqry.cache)
     def get(self, city_name):
         """
         Retrieve details for a single city by name
         """
         try:
-            cities = cqry.read()
-            if city_name not in cities:
+            city = cqry.find_by_name(city_name)
+            if city is None:
                 return {ERROR: f"City '{city_name}' not found"}, 404
             return {
                 CITY_RESP: city_name,
-                "details": cities[city_name]
+                "details": trim_doc(city, parse_fields())
             }, 200
         except ConnectionError as e:
             return {ERROR: str(e)}, 500
@@ -264,15 +536,30 @@ class CityDetails(Resource):
 
 @api.route(f"{CITIES_EPS}/state/<string:state_code>")
 class CitiesByState(Resource):
+    @conditional(cqry.cache)
     def get(self, state_code):
         """
         Retrieve all cities for a specific state.
         """
         try:
-            cities = cqry.get_cities_by_state(state_code)
-            if not cities:
+            page = parse_page_args()
+        except ValueError as e:
+            return {ERROR: str(e)}, 400
+        try:
+            next_key = None
+            if page is not None:
+                limit, after = page
+                docs, next_key = cqry.get_cities_by_state_page(state_code, limit, after)
+                cities = {doc[cqry.CITY]: doc for doc in docs}
+            else:
+                after = None
+                cities = cqry.get_cities_by_state(state_code)
+            if not cities and after is None:
                 msg = f"No cities found for state '{state_code}'"
                 return {ERROR: msg}, 404
+            cities = sparse(cities, parse_fields())
+            if page is not None:
+                return {CITY_RESP: cities, NEXT: encode_cursor(next_key)}, 200
             return {CITY_RESP: cities}, 200
 
         except Exception as e:
@@ -281,14 +568,25 @@ class CitiesByState(Resource):
 
 @api.route("/countries")
 class Countries(Resource):
+    @conditional(cntry.country_cache)
     def get(self):
         """
         Retrieve all countries (cached).
         """
         try:
-            cntry.load_cache()
+            page = parse_page_args()
+        except ValueError as e:
+            return {ERROR: str(e)}, 400
+        fields = parse_fields()
+        try:
+            if page is not None:
+                docs, next_key = cntry.read_page(*page)
+                return {
+                    "countries": sparse({doc[cntry.ID]: doc for doc in docs}, fields),
+                    NEXT: encode_cursor(next_key),
+                }, 200
             countries = cntry.read_all()
-            return {"countries": countries}, 200
+            return {"countries": sparse(countries, fields)}, 200
         except Exception as e:
             return {ERROR: str(e)}, 500
 
@@ -375,27 +673,47 @@ class AddCountry(Resource):
             return {ERROR: f"Unexpected error: {str(e)}"}, 500
 
 
+@api.route(f"{COUNTRIES_EPS}/batch")
+class BatchCountries(Resource):
+    def post(self):
+        """
+        Look up many countries by id in one request.
+        """
+        return batch_response(COUNTRY_RESP, [cntry.ID], cntry.get_countries)
+
+
+@api.route(f"{COUNTRIES_EPS}/bulk")
+class BulkCountries(Resource):
+    def post(self):
+        """
+        Add or update many countries, sent as NDJSON or a JSON array of
+        /countries/add bodies.
+        """
+        return bulk_response(cntry.country_doc, cntry.add_countries)
+
+
 @api.route(f'{COUNTRIES_EPS}/<string:country_id>')
 class CountryDetails(Resource):
     """
     Get details for a specific country
     """
-    def get(self, country_name):
+    @conditional(cntry.country_cache)
+    def get(self, country_id):
         """
-        Retrieve details for a single country by name
+        Retrieve details for a single country by id
         """
         try:
-            countries = cntry.read_all()
-            if country_name not in countries:
-                return {ERROR: f"Country '{country_name}' not found"}, 404
-            return {
-                COUNTRY_RESP: country_name,
-                "details": countries[country_name]
-            }, 200
+            details = cntry.get_country(country_id, parse_fields())
+        except ValueError:
+            return {ERROR: f"Country '{country_id}' not found"}, 404
         except ConnectionError as e:
             return {ERROR: str(e)}, 500
         except Exception as e:
             return {ERROR: str(e)}, 500
+        return {
+            COUNTRY_RESP: country_id,
+            "details": details
+        }, 200
 
     def delete(self, country_id):
         """
@@ -418,12 +736,20 @@ class States(Resource):
     Retrieve all states from the states cache or database.
     """
 
+    @conditional(sqry.cache)
     def get(self):
         """
         Return all stored states.
         """
         try:
-            sqry.load_cache()
+            page = parse_page_args()
+        except ValueError as e:
+            return {ERROR: str(e)}, 400
+        fields = parse_fields()
+        try:
+            if page is not None:
+                docs, next_key = sqry.read_page(*page)
+                return {STATE_RESP: sparse(docs, fields), NEXT: encode_cursor(next_key)}, 200
             states = sqry.read()
 
             # If sqry.read() returns the cache dict (like your test_queries),
@@ -434,7 +760,7 @@ class States(Resource):
             else:
                 data = states
 
-            return {STATE_RESP: data}, 200
+            return {STATE_RESP: sparse(data, fields)}, 200
         except Exception as e:
             # Catch any error and surface the message instead of a generic 500.
             return {ERROR: str(e)}, 500
@@ -442,8 +768,15 @@ class States(Resource):
 
 @api.route(f"{STATES_EPS}/country/<string:country_code>")
 class StatesByCountry(Resource):
+    @conditional(sqry.cache)
     def get(self, country_code):
         try:
+            page = parse_page_args()
+        except ValueError as e:
+            return {ERROR: str(e)}, 400
+        try:
+            if page is not None:
+                return self.get_page(country_code, *page)
             all_states = sqry.read()
             filtered_states = []
             if isinstance(all_states, dict):
@@ -469,12 +802,27 @@ class StatesByCountry(Resource):
                 "success": True,
                 "country_code": country_code,
                 "count": len(filtered_states),
-                "states": filtered_states
+                "states": sparse(filtered_states, parse_fields())
             }, 200
         except Exception as e:
             print(f"StatesByCountry - Error: {str(e)}")
             return {ERROR: str(e)}, 500
 
+    def get_page(self, country_code, limit, after):
+        states, next_key = sqry.get_states_by_country_page(country_code, limit, after)
+        if not states and after is None:
+            return {
+                ERROR: f"No states found for country code '{country_code}'",
+                "country_code": country_code
+            }, 404
+        return {
+            "success": True,
+            "country_code": country_code,
+            "count": len(states),
+            "states": sparse(states, parse_fields()),
+            NEXT: encode_cursor(next_key),
+        }, 200
+
 
 @api.route(f"{STATES_EPS}/count")
 class StateCount(Resource):
@@ -551,18 +899,39 @@ class AddState(Resource):
             return {ERROR: f"Unexpected error: {str(e)}"}, 500
 
 
+@api.route(f"{STATES_EPS}/batch")
+class BatchStates(Resource):
+    def post(self):
+        """
+        Look up many states in one request. Keys are
+        {"state_code", "country_code"} objects or lists.
+        """
+        return batch_response(STATE_RESP, [sqry.STATE_CODE, sqry.COUNTRY_CODE], sqry.read_many)
+
+
+@api.route(f"{STATES_EPS}/bulk")
+class BulkStates(Resource):
+    def post(self):
+        """
+        Add or update many states, sent as NDJSON or a JSON array of
+        /states/add bodies.
+        """
+        return bulk_response(sqry.state_doc, sqry.add_states)
+
+
 @api.route(f"{STATES_EPS}/<string:state_code>/<string:country_code>")
 class StateDetails(Resource):
     """
     Retrieve or delete a specific state using its code and country code.
     """
 
+    @conditional(sqry.cache)
     def get(self, state_code, country_code):
         """
         Retrieve details for a single state by code and country code.
         """
         try:
-            state = sqry.read_one(state_code, country_code)
+            state = sqry.read_one(state_code, country_code, parse_fields())
             return {
                 STATE_RESP: {
                     "code": state_code,
@@ -596,6 +965,41 @@ class StateDetails(Resource):
             return {ERROR: str(e)}, 500
 
 
+# the collections /export serves:
+# {collection name: (iter fn, default CSV columns, {filter arg: iter fn kwarg})}
+EXPORTS = {
+    cqry.CITY_COLLECTION: (cqry.iter_export, cqry.EXPORT_FLDS,
+                           {COUNTRY: 'country_code', STATE: 'state_code'}),
+    sqry.STATE_COLLECTION: (sqry.iter_export, sqry.EXPORT_FLDS,
+                            {COUNTRY: 'country_code'}),
+    cntry.COUNTRY_COLLECTION: (cntry.iter_export, cntry.EXPORT_FLDS,
+                               {COUNTRY: 'country_code'}),
+}
+
+
+@api.route(f"{EXPORT_EP}/<string:collection>")
+class Export(Resource):
+    def get(self, collection):
+        """
+        Stream a whole collection as ?format=ndjson (the default) or csv.
+        ?country= and ?state= limit the rows; ?fields= picks the fields.
+        """
+        if collection not in EXPORTS:
+            return {ERROR: f"No export for '{collection}'"}, 404
+        iter_fn, columns, filter_args = EXPORTS[collection]
+        fmt = request.args.get(FORMAT, export.NDJSON)
+        if fmt not in export.MIMETYPES:
+            return {ERROR: f"Unknown format '{fmt}'"}, 400
+        unknown = [arg for arg in (COUNTRY, STATE) if arg in request.args and arg not in filter_args]
+        if unknown:
+            return {ERROR: f"Can't filter {collection} by {', '.join(unknown)}"}, 400
+        filters = {kwarg: request.args[arg] for arg, kwarg in filter_args.items() if request.args.get(arg)}
+        docs = iter_fn(**filters)
+        lines = export.export_lines(docs, fmt, parse_fields(), columns)
+        return Response(stream_with_context(lines), mimetype=export.MIMETYPES[fmt],
+                        headers={'Content-Disposition': f'attachment; filename={collection}.{fmt}'})
+
+
 # ============= AUTHENTICATION ENDPOINTS =============
 
 
@@ -792,6 +1196,34 @@ class DevLogs(Resource):
             return {'error': str(e)}, 500
 
 
+@api.route('/dev/cache')
+@api.doc(security='developerEmail')
+class DevCache(Resource):
+    """
+    Developer-only view and invalidation of the in-memory caches.
+    """
+    @developer_required
+    def get(self):
+        """Return hit/miss/reload stats for each cache"""
+        stats = {name: cache.get_stats() for name, cache in CACHES.items()}
+        stats[RESPONSES] = rc.response_cache.get_stats()
+        return stats, 200
+
+    @developer_required
+    def post(self):
+        """
+        Mark caches stale so they are re-read from the DB.
+        ?collection= limits this to one cache.
+        """
+        name = request.args.get('collection')
+        if name is not None and name not in CACHES:
+            return {'error': f'No cache named {name}'}, 404
+        names = [name] if name is not None else list(CACHES)
+        for cache_name in names:
+            CACHES[cache_name].invalidate()
+        return {'invalidated': names}, 200
+
+
 @api.route('/dev/logs/<path:filename>')
 @api.doc(security='developerEmail')
 class DevLogFile(Resource):
@@ -0,0 +1,80 @@
+"""
+Streaming exports of a collection as NDJSON or CSV.
+
+Docs are encoded one at a time as they come from the query module and
+sent in chunks of about CHUNK_BYTES, so memory use stays flat however
+many rows are exported.
+"""
+import csv
+import json
+import os
+
+from data.db_connect import trim_doc
+
+NDJSON = 'ndjson'
+CSV = 'csv'
+MIMETYPES = {
+    NDJSON: 'application/x-ndjson',
+    CSV: 'text/csv',
+}
+
+CHUNK_BYTES = int(os.getenv('EXPORT_CHUNK_BYTES', 64 * 1024))
+
+
+class LineWriter:
+    """
+    A file-like object csv.writer can write a row to, that just hands
+    the formatted line back.
+    """
+    def write(self, line: str) -> str:
+        return line
+
+
+def csv_value(val):
+    if val is None:
+        return ''
+    if isinstance(val, (dict, list)):
+        return json.dumps(val, separators=(',', ':'))
+    return val
+
+
+def ndjson_lines(docs, fields=None):
+    for doc in docs:
+        yield json.dumps(trim_doc(doc, fields), separators=(',', ':'), default=str) + '\n'
+
+
+def csv_lines(docs, columns):
+    writer = csv.writer(LineWriter())
+    yield writer.writerow(columns)
+    for doc in docs:
+        yield writer.writerow([csv_value(doc.get(col)) for col in columns])
+
+
+def chunked(lines, chunk_bytes=CHUNK_BYTES):
+    """
+    Join lines into chunks of about chunk_bytes, rather than sending
+    every line as its own chunk.
+    """
+    chunk = []
+    size = 0
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= chunk_bytes:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def export_lines(docs, fmt: str, fields=None, default_columns=()):
+    """
+    Encode docs in fmt. fields limits the keys of each NDJSON doc and
+    picks the CSV columns, which are default_columns otherwise.
+    """
+    if fmt == CSV:
+        lines = csv_lines(docs, list(fields or default_columns))
+    else:
+        lines = ndjson_lines(docs, fields)
+    return chunked(lines)
@@ -0,0 +1,133 @@
+"""
+A bounded LRU cache of encoded response bodies.
+
+Read endpoints that are built from a CollectionCache produce the same
+JSON for as long as the snapshot they were built from stays current,
+so the encoded bytes are kept per (path, query args) together with the
+version of the data they were built from. A newer version replaces the
+old entry instead of sitting beside it.
+"""
+import json
+import os
+import threading
+from collections import OrderedDict
+
+try:
+    import orjson
+except ImportError:  # optional: the stdlib encoder is used instead
+    orjson = None
+
+MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 256))
+MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+# keys of the stats dict
+HITS = 'hits'
+MISSES = 'misses'
+EVICTIONS = 'evictions'
+ENTRIES = 'entries'
+BYTES = 'bytes'
+
+
+def encode_json(data) -> bytes:
+    """
+    Encode data as compact JSON, with orjson when it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS) + b'\n'
+    return json.dumps(data, separators=(',', ':'), default=str).encode() + b'\n'
+
+
+class CachedBody:
+    """
+    The encoded body of one response, plus any content-encoded variants
+    of it, as {encoding: bytes}.
+    """
+    def __init__(self, version: str, body: bytes):
+        self.version = version
+        self.body = body
+        self.variants = {}
+
+    def size(self) -> int:
+        return len(self.body) + sum(len(var) for var in self.variants.values())
+
+
+class ResponseCache:
+    """
+    Holds at most max_entries bodies and max_bytes bytes, evicting the
+    least recently used first.
+    """
+    def __init__(self, max_entries: int = MAX_ENTRIES, max_bytes: int = MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.stats = {HITS: 0, MISSES: 0, EVICTIONS: 0}
+
+    def get(self, key, version: str):
+        """
+        The CachedBody for key if it was built from version, else None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.version != version:
+                self.stats[MISSES] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats[HITS] += 1
+            return entry
+
+    def put(self, key, version: str, body: bytes) -> CachedBody:
+        """
+        Remember body for key, replacing what was there.
+        Bodies too big for the whole cache are returned but not kept.
+        """
+        entry = CachedBody(version, body)
+        with self.lock:
+            self.discard(key)
+            if entry.size() <= self.max_bytes:
+                self.entries[key] = entry
+                self.nbytes += entry.size()
+                self.shrink()
+        return entry
+
+    def add_variant(self, key, entry: CachedBody, encoding: str, data: bytes):
+        """
+        Attach an encoded variant to entry, keeping the size bound.
+        """
+        with self.lock:
+            if entry.variants.get(encoding) is not None:
+                return
+            entry.variants[encoding] = data
+            if self.entries.get(key) is entry:
+                self.nbytes += len(data)
+                self.shrink()
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry.size()
+
+    def is_full(self) -> bool:
+        return len(self.entries) > self.max_entries or self.nbytes > self.max_bytes
+
+    def shrink(self):
+        while self.entries and self.is_full():
+            _key, entry = self.entries.popitem(last=False)
+            self.nbytes -= entry.size()
+            self.stats[EVICTIONS] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.stats)
+            stats[ENTRIES] = len(self.entries)
+            stats[BYTES] = self.nbytes
+        return stats
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,73 @@
+import io
+import json
+
+from pymongo.errors import BulkWriteError
+
+import server.bulk as bulk
+
+
+def rows_of(results):
+    return [(row, data, error is not None) for row, data, error in results]
+
+
+def test_iter_ndjson():
+    body = b'{"a": 1}\n\n{bad\n{"a": 2}'
+    assert rows_of(bulk.iter_ndjson(io.BytesIO(body))) == [
+        (1, {'a': 1}, False), (2, None, True), (3, {'a': 2}, False)]
+
+
+def test_iter_ndjson_long_row():
+    body = b'{"a": "' + b'x' * 50 + b'"}\n{"a": 2}\n'
+    results = list(bulk.iter_ndjson(io.BytesIO(body), max_row=20))
+    assert rows_of(results) == [(1, None, True), (2, {'a': 2}, False)]
+
+
+def test_iter_json_array_across_reads(monkeypatch):
+    monkeypatch.setattr(bulk, 'READ_SIZE', 3)
+    body = json.dumps([{'a': 'é'}, {'a': [1, 2]}]).encode()
+    assert rows_of(bulk.iter_json_array(io.BytesIO(body))) == [
+        (1, {'a': 'é'}, False), (2, {'a': [1, 2]}, False)]
+
+
+def test_iter_json_array_errors():
+    assert rows_of(bulk.iter_json_array(io.BytesIO(b'{"a": 1}'))) == [(1, None, True)]
+    assert rows_of(bulk.iter_json_array(io.BytesIO(b'[{"a": 1}, {"a"'))) == [
+        (1, {'a': 1}, False), (2, None, True)]
+    assert list(bulk.iter_json_array(io.BytesIO(b' [ ] '))) == []
+
+
+def test_ingest_batches():
+    batches = []
+
+    def to_doc(data):
+        if 'a' not in data:
+            raise ValueError('no a')
+        return data
+
+    rows = [(1, {'a': 1}, None), (2, {}, None), (3, None, 'Bad JSON'),
+            (4, {'a': 2}, None), (5, {'a': 3}, None)]
+    statuses = list(bulk.ingest(rows, to_doc, batches.append, batch_size=2))
+    assert batches == [[{'a': 1}, {'a': 2}], [{'a': 3}]]
+    assert [s[bulk.STATUS] for s in statuses[:-1]] == ['error', 'error', 'ok', 'ok', 'ok']
+    assert statuses[-1] == {bulk.SUMMARY: {bulk.ROWS: 5, bulk.OK: 3, bulk.ERRORS: 2}}
+
+
+def test_ingest_failed_batch():
+    def add_many(docs):
+        raise ConnectionError('db down')
+
+    statuses = list(bulk.ingest([(1, {}, None)], dict, add_many))
+    assert statuses[0] == {bulk.ROW: 1, bulk.STATUS: bulk.ERROR, bulk.ERROR: 'db down'}
+
+
+def test_ingest_partly_written_batch():
+    def add_many(docs):
+        raise BulkWriteError({'writeErrors': [{'index': 1, 'errmsg': 'duplicate key'}]})
+
+    rows = [(row, {'a': row}, None) for row in (1, 2, 3)]
+    statuses = list(bulk.ingest(rows, dict, add_many))
+    assert statuses[:-1] == [
+        {bulk.ROW: 1, bulk.STATUS: bulk.OK},
+        {bulk.ROW: 2, bulk.STATUS: bulk.ERROR, bulk.ERROR: 'duplicate key'},
+        {bulk.ROW: 3, bulk.STATUS: bulk.ERROR, bulk.ERROR: bulk.NOT_WRITTEN},
+    ]
@@ -7,9 +7,12 @@ from http.client import (  # noqa: F401
     SERVICE_UNAVAILABLE,
 )
 
+import gzip
+import json
 from unittest.mock import patch
 
 import pytest
+from pymongo.errors import DuplicateKeyError
 
 import server.endpoints as ep
 
@@ -22,6 +25,13 @@ def client():
     return ep.app.test_client()
 
 
+@pytest.fixture(autouse=True)
+def clear_response_cache():
+    """Don't let one test's cached bodies answer another's requests."""
+    yield
+    ep.rc.response_cache.clear()
+
+
 # Test that /hello returns correct status + JSON format
 def test_hello_ok(client):
     resp = client.get(ep.HELLO_EP)
@@ -81,3 +91,295 @@ def test_cities_success(mock_read, client):
 def test_endpoints_listing(client):
     resp = client.get(ep.ENDPOINT_EP)
     assert resp.status_code == 200
+
+
+@patch("countries.country_queries.load_cache")
+@patch("countries.country_queries.read_all", return_value={"ZZZ": {"name": "zztest"}})
+def test_countries_served_from_cache(mock_read_all, mock_load, client):
+    resp = client.get(ep.COUNTRIES_EPS)
+    assert resp.status_code == 200
+    assert resp.get_json() == {"countries": {"ZZZ": {"name": "zztest"}}}
+    mock_load.assert_not_called()
+
+
+@patch("users.users_queries.is_user_developer", return_value=True)
+def test_dev_cache_invalidate(mock_dev, loaded_city_cache, client, monkeypatch):
+    monkeypatch.setattr(ep.cqry.cache, "background_refresh", False)
+    url = f"{ep.CITIES_EPS}/{ep.READ}"
+    assert "ZZTEST_New" not in client.get(url).get_json()[ep.CITY_RESP]
+    docs = [{"city": "ZZTEST_City", "state_code": "ZZ", "country_code": "ZZ"},
+            {"city": "ZZTEST_New", "state_code": "ZZ", "country_code": "ZZ"}]
+    with patch("data.db_connect.iter_docs", return_value=iter(docs)):
+        assert "ZZTEST_New" not in client.get(url).get_json()[ep.CITY_RESP]
+        resp = client.post(f"/dev/cache?collection={ep.cqry.CITY_COLLECTION}",
+                           headers={"Developer-Email": "dev@projectsens.com"})
+        assert resp.status_code == 200
+        assert resp.get_json() == {"invalidated": [ep.cqry.CITY_COLLECTION]}
+        assert "ZZTEST_New" in client.get(url).get_json()[ep.CITY_RESP]
+
+
+@patch("users.users_queries.is_user_developer", return_value=True)
+def test_dev_cache_unknown(mock_dev, client):
+    resp = client.post("/dev/cache?collection=nope",
+                       headers={"Developer-Email": "dev@projectsens.com"})
+    assert resp.status_code == 404
+
+
+def age_snapshot(cache, seconds=2):
+    """Make the cache's snapshot look published seconds ago."""
+    cache.current.modified_at -= seconds
+
+
+@pytest.fixture
+def loaded_city_cache():
+    docs = [{"city": "ZZTEST_City", "state_code": "ZZ", "country_code": "ZZ"}]
+    with patch("data.db_connect.iter_docs", return_value=iter(docs)):
+        ep.cqry.cache.load()
+    age_snapshot(ep.cqry.cache)
+    yield
+    ep.cqry.cache.clear()
+
+
+def test_cities_conditional_get(loaded_city_cache, client):
+    resp = client.get(f"{ep.CITIES_EPS}/{ep.READ}")
+    assert resp.status_code == 200
+    etag = resp.headers["ETag"]
+    assert resp.headers["Last-Modified"]
+    with patch("cities.cities_queries.read") as mock_read:
+        resp = client.get(f"{ep.CITIES_EPS}/{ep.READ}",
+                          headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        assert resp.headers["ETag"] == etag
+        mock_read.assert_not_called()
+
+
+def test_cities_etag_changes_on_write(loaded_city_cache, client):
+    resp = client.get(f"{ep.CITIES_EPS}/{ep.READ}")
+    etag = resp.headers["ETag"]
+    ep.cqry.cache.put({"city": "ZZTEST_Other", "state_code": "ZZ", "country_code": "ZZ"})
+    resp = client.get(f"{ep.CITIES_EPS}/{ep.READ}",
+                      headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] != etag
+    assert "ZZTEST_Other" in resp.get_json()[ep.CITY_RESP]
+
+
+def test_cities_if_modified_since(loaded_city_cache, client):
+    resp = client.get(f"{ep.CITIES_EPS}/{ep.READ}")
+    resp = client.get(f"{ep.CITIES_EPS}/{ep.READ}",
+                      headers={"If-Modified-Since": resp.headers["Last-Modified"]})
+    assert resp.status_code == 304
+
+
+def test_no_last_modified_within_the_write_second(loaded_city_cache, client):
+    url = f"{ep.CITIES_EPS}/{ep.READ}"
+    last_modified = client.get(url).headers["Last-Modified"]
+    ep.cqry.cache.put({"city": "ZZTEST_Other", "state_code": "ZZ", "country_code": "ZZ"})
+    ep.cqry.cache.current.modified_at = ep.cqry.cache.current.modified_at // 1 + 0.9
+    resp = client.get(url, headers={"If-Modified-Since": last_modified})
+    assert resp.status_code == 200
+    assert "Last-Modified" not in resp.headers
+    assert "ZZTEST_Other" in resp.get_json()[ep.CITY_RESP]
+
+
+def test_conditional_get_applies_freshness_policy(loaded_city_cache, client, monkeypatch):
+    monkeypatch.setattr(ep.cqry.cache, "background_refresh", False)
+    url = f"{ep.CITIES_EPS}/{ep.READ}"
+    etag = client.get(url).headers["ETag"]
+    ep.cqry.cache.invalidate()
+    docs = [{"city": "ZZTEST_City", "state_code": "ZZ", "country_code": "ZZ"},
+            {"city": "ZZTEST_New", "state_code": "ZZ", "country_code": "ZZ"}]
+    with patch("data.db_connect.iter_docs", return_value=iter(docs)):
+        resp = client.get(url, headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] != etag
+    assert "ZZTEST_New" in resp.get_json()[ep.CITY_RESP]
+
+
+def test_cursor_round_trip():
+    key = ("ZZTEST_City", "ZZ", "ZZ")
+    assert ep.decode_cursor(ep.encode_cursor(key)) == key
+    assert ep.encode_cursor(None) is None
+    with pytest.raises(ValueError):
+        ep.decode_cursor("not a cursor!")
+
+
+@pytest.fixture
+def many_cities():
+    docs = [{"city": f"ZZTEST_{i:02d}", "state_code": "ZZ", "country_code": "ZZ"}
+            for i in range(25)]
+    with patch("data.db_connect.iter_docs", return_value=iter(docs)):
+        ep.cqry.cache.load()
+    yield
+    ep.cqry.cache.clear()
+
+
+def test_cities_keyset_pages(many_cities, client):
+    seen = []
+    url = f"{ep.CITIES_EPS}/{ep.READ}?limit=10"
+    while url:
+        body = client.get(url).get_json()
+        seen.extend(body[ep.CITY_RESP])
+        nxt = body[ep.NEXT]
+        url = f"{ep.CITIES_EPS}/{ep.READ}?limit=10&after={nxt}" if nxt else None
+    assert seen == [f"ZZTEST_{i:02d}" for i in range(25)]
+
+
+def test_cities_by_state_page(many_cities, client):
+    resp = client.get(f"{ep.CITIES_EPS}/state/ZZ?limit=5")
+    assert resp.status_code == 200
+    body = resp.get_json()
+    assert len(body[ep.CITY_RESP]) == 5
+    assert body[ep.NEXT]
+
+
+def test_bad_cursor(client):
+    resp = client.get(f"{ep.STATES_EPS}/{ep.READ}?after=bogus")
+    assert resp.status_code == 400
+
+
+def test_cities_fields(loaded_city_cache, client):
+    resp = client.get(f"{ep.CITIES_EPS}/{ep.READ}?fields=state_code, nope")
+    for doc in resp.get_json()[ep.CITY_RESP].values():
+        assert list(doc) == ["state_code"]
+
+
+def test_parse_fields():
+    with ep.app.test_request_context("/?fields=a,,b,a"):
+        assert ep.parse_fields() == ("a", "b")
+    with ep.app.test_request_context("/"):
+        assert ep.parse_fields() is None
+
+
+def test_cities_body_served_from_response_cache(loaded_city_cache, client):
+    url = f"{ep.CITIES_EPS}/{ep.READ}"
+    first = client.get(url)
+    with patch("cities.cities_queries.read") as mock_read:
+        second = client.get(url)
+        mock_read.assert_not_called()
+    assert second.data == first.data
+    assert second.headers["ETag"] == first.headers["ETag"]
+
+
+def test_gzip_negotiated(many_cities, client):
+    url = f"{ep.CITIES_EPS}/{ep.READ}"
+    plain = client.get(url)
+    assert "Content-Encoding" not in plain.headers
+    resp = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in resp.headers["Vary"]
+    assert gzip.decompress(resp.data) == plain.data
+    assert resp.headers["ETag"] == "W/" + plain.headers["ETag"]
+    resp = client.get(url, headers={"If-None-Match": resp.headers["ETag"]})
+    assert resp.status_code == 304
+
+
+def test_gzip_variant_reused(many_cities, client):
+    url = f"{ep.CITIES_EPS}/{ep.READ}"
+    first = client.get(url, headers={"Accept-Encoding": "gzip"})
+    with patch.dict(ep.compression.COMPRESSORS, {"gzip": None}):
+        second = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert second.data == first.data
+
+
+def test_small_body_not_compressed(client):
+    resp = client.get(ep.HELLO_EP, headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in resp.headers
+
+
+def test_bulk_cities(client):
+    good = {"city": "ZZTEST_City", "state_code": "ZZ", "country_code": "ZZ",
+            "rec_restaurant": "ZZTEST_Restaurant"}
+    body = "\n".join([json.dumps(good), json.dumps({"city": "x"})])
+    with patch("cities.cities_queries.add_cities") as mock_add:
+        resp = client.post(f"{ep.CITIES_EPS}/bulk", data=body,
+                           content_type="application/x-ndjson")
+        lines = [json.loads(line) for line in resp.data.splitlines()]
+    mock_add.assert_called_once_with([good])
+    # bad rows are reported at once, good ones when their batch is written
+    assert lines[0]["row"] == 2 and lines[0]["status"] == "error"
+    assert lines[1] == {"row": 1, "status": "ok"}
+    assert lines[-1]["summary"] == {"rows": 2, "ok": 1, "errors": 1}
+
+
+def test_export_cities_ndjson(many_cities, client):
+    resp = client.get(f"{ep.EXPORT_EP}/cities?state=zz&fields=city")
+    assert resp.status_code == 200
+    assert resp.mimetype == "application/x-ndjson"
+    rows = [json.loads(line) for line in resp.data.splitlines()]
+    assert len(rows) == 25
+    assert rows[0] == {"city": "ZZTEST_00"}
+
+
+def test_export_cities_csv_from_cursor(client):
+    docs = [{"city": "ZZTEST_City", "state_code": "ZZ", "country_code": "ZZ"}]
+    with patch("data.db_connect.iter_docs", return_value=iter(docs)) as mock_iter:
+        resp = client.get(f"{ep.EXPORT_EP}/cities?format=csv&country=zz")
+        lines = resp.data.decode().splitlines()
+    assert mock_iter.call_args.kwargs["filt"] == {"country_code": "ZZ"}
+    assert lines == ["city,state_code,country_code,rec_restaurant", "ZZTEST_City,ZZ,ZZ,"]
+
+
+def test_export_bad_requests(client):
+    assert client.get(f"{ep.EXPORT_EP}/users").status_code == 404
+    assert client.get(f"{ep.EXPORT_EP}/cities?format=xml").status_code == 400
+    assert client.get(f"{ep.EXPORT_EP}/countries?state=ZZ").status_code == 400
+
+
+def test_batch_cities(loaded_city_cache, client):
+    fetched = [{"city": "ZZTEST_Other", "state_code": "ZZ", "country_code": "ZZ"}]
+    keys = [["ZZTEST_City", "ZZ", "ZZ"],
+            {"city": "ZZTEST_Other", "state_code": "ZZ", "country_code": "ZZ"},
+            ["ZZTEST_Gone", "ZZ", "ZZ"]]
+    # without a Bloom filter every miss might be in the DB
+    ep.cqry.cache.bloom = None
+    with patch("data.db_connect.read_by_keys", return_value=iter(fetched)) as mock_read:
+        resp = client.post(f"{ep.CITIES_EPS}/batch", json={"keys": keys})
+    # both misses go to the DB in one call
+    assert mock_read.call_args.args[2] == [("ZZTEST_Other", "ZZ", "ZZ"), ("ZZTEST_Gone", "ZZ", "ZZ")]
+    body = resp.get_json()
+    assert [doc["city"] for doc in body[ep.CITY_RESP]] == ["ZZTEST_City", "ZZTEST_Other"]
+    assert body[ep.MISSING] == [["ZZTEST_Gone", "ZZ", "ZZ"]]
+
+
+def test_batch_bad_keys(client):
+    resp = client.post(f"{ep.STATES_EPS}/batch", json={"keys": [["ZZ"]]})
+    assert resp.status_code == 400
+    resp = client.post(f"{ep.STATES_EPS}/batch", json=["ZZ", "ZZZ"])
+    assert resp.status_code == 400
+
+
+@patch("data.db_connect.create", side_effect=DuplicateKeyError("E11000"))
+@patch("data.db_connect.read_one", return_value=None)
+def test_register_concurrent_duplicate(mock_read, mock_create, client):
+    resp = client.post("/auth/register", json={"email": "zz@example.com", "password": "password123"})
+    assert resp.status_code == 400
+    assert resp.get_json() == {"error": "Email 'zz@example.com' already exists"}
+
+
+@patch("data.db_connect.read_one", return_value=None)
+def test_authenticate_always_reads_db(mock_read, monkeypatch):
+    monkeypatch.setattr(ep.user_qry.cache, "might_contain", lambda key: False)
+    with pytest.raises(ValueError):
+        ep.user_qry.authenticate("zz@example.com", "password123")
+    mock_read.assert_called_once()
+
+
+def test_city_details_by_name(loaded_city_cache, client):
+    resp = client.get(f"{ep.CITIES_EPS}/ZZTEST_City")
+    assert resp.status_code == 200
+    assert resp.get_json()["details"]["state_code"] == "ZZ"
+    with patch("cities.cities_queries.read") as mock_read:
+        assert client.get(f"{ep.CITIES_EPS}/ZZTEST_Nowhere").status_code == 404
+    mock_read.assert_not_called()
+
+
+@patch("data.db_connect.create", side_effect=DuplicateKeyError("E11000"))
+@patch("data.db_connect.read_one")
+def test_register_new_email_skips_read(mock_read, mock_create, client, monkeypatch):
+    monkeypatch.setattr(ep.user_qry.cache, "might_contain", lambda key: False)
+    resp = client.post("/auth/register", json={"email": "zz@example.com", "password": "password123"})
+    mock_read.assert_not_called()
+    # the unique index is the final check
+    assert resp.status_code == 400
+    assert resp.get_json() == {"error": "Email 'zz@example.com' already exists"}
@@ -0,0 +1,26 @@
+import csv
+import io
+import json
+
+import server.export as export
+
+DOCS = [
+    {'city': 'NYC', 'state_code': 'NY', 'tags': ['big', 'apple']},
+    {'city': 'Buffalo, NY', 'state_code': 'NY'},
+]
+
+
+def test_ndjson_lines():
+    lines = list(export.ndjson_lines(DOCS, fields=['city']))
+    assert [json.loads(line) for line in lines] == [{'city': 'NYC'}, {'city': 'Buffalo, NY'}]
+
+
+def test_csv_lines():
+    text = ''.join(export.csv_lines(DOCS, ['city', 'tags']))
+    assert list(csv.reader(io.StringIO(text))) == [
+        ['city', 'tags'], ['NYC', '["big","apple"]'], ['Buffalo, NY', '']]
+
+
+def test_chunked():
+    assert list(export.chunked(['ab', 'cd', 'e'], chunk_bytes=3)) == ['abcd', 'e']
+    assert list(export.chunked([])) == []
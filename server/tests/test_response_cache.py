@@ -0,0 +1,40 @@
+import json
+
+import server.response_cache as rc
+
+
+def test_get_needs_matching_version():
+    cache = rc.ResponseCache()
+    cache.put('k', 'v1', b'{}')
+    assert cache.get('k', 'v1').body == b'{}'
+    assert cache.get('k', 'v2') is None
+    cache.put('k', 'v2', b'[]')
+    assert cache.get('k', 'v1') is None
+    assert cache.get_stats()[rc.ENTRIES] == 1
+
+
+def test_lru_entry_bound():
+    cache = rc.ResponseCache(max_entries=2)
+    cache.put('a', 'v', b'a')
+    cache.put('b', 'v', b'b')
+    cache.get('a', 'v')
+    cache.put('c', 'v', b'c')
+    assert cache.get('b', 'v') is None
+    assert cache.get('a', 'v') is not None
+    assert cache.get_stats()[rc.EVICTIONS] == 1
+
+
+def test_byte_bound_counts_variants():
+    cache = rc.ResponseCache(max_bytes=10)
+    entry = cache.put('a', 'v', b'12345')
+    cache.add_variant('a', entry, 'gzip', b'123')
+    assert cache.get_stats()[rc.BYTES] == 8
+    cache.put('b', 'v', b'1234')
+    assert cache.get('a', 'v') is None
+    assert cache.get_stats()[rc.BYTES] == 4
+    assert cache.put('c', 'v', b'x' * 11).body == b'x' * 11
+    assert cache.get('c', 'v') is None
+
+
+def test_encode_json():
+    assert json.loads(rc.encode_json({'a': [1, 'b']})) == {'a': [1, 'b']}
@@ -1,6 +1,7 @@
-from functools import wraps
+from pymongo.errors import BulkWriteError
 
 import data.db_connect as dbc
+from data.collection_cache import CollectionCache
 from data.db_connect import is_valid_id  # noqa: F401
 
 STATE_COLLECTION = 'states'
@@ -8,6 +9,20 @@ NAME = 'name'
 STATE_CODE = 'state_code'
 COUNTRY_CODE = 'country_code'
 
+# secondary index over the cache
+BY_COUNTRY = 'by_country'
+
+KEY_FLDS = [STATE_CODE, COUNTRY_CODE]
+# default CSV export columns
+EXPORT_FLDS = [STATE_CODE, COUNTRY_CODE, NAME]
+
+INDEXES = [
+    dbc.Index(KEY_FLDS, unique=True),
+    dbc.Index([COUNTRY_CODE]),
+]
+QUERY_SHAPES = [KEY_FLDS, [COUNTRY_CODE]]
+dbc.register_indexes(STATE_COLLECTION, INDEXES, QUERY_SHAPES)
+
 SAMPLE_CODE = 'ZZ'
 SAMPLE_COUNTRY = 'ZZZ'
 SAMPLE_KEY = (SAMPLE_CODE, SAMPLE_COUNTRY)
@@ -17,40 +32,57 @@ SAMPLE_STATE = {
     COUNTRY_CODE: SAMPLE_COUNTRY
 }
 
-cache = None
+
+def state_key(doc: dict) -> tuple:
+    if doc.get(STATE_CODE) is None or doc.get(COUNTRY_CODE) is None:
+        return None
+    return (doc[STATE_CODE], doc[COUNTRY_CODE])
 
 
-def needs_cache(fn):
-    @wraps(fn)
-    def wrapper(*args, **kwargs):
-        if not cache:
-            load_cache()
-        return fn(*args, **kwargs)
-    return wrapper
+cache = CollectionCache(
+    STATE_COLLECTION,
+    state_key,
+    indexes={BY_COUNTRY: lambda doc: doc.get(COUNTRY_CODE)},
+)
 
 
-@needs_cache
 def count():
     return len(cache)
 
 
-@needs_cache
 def read():
-    return cache
+    return cache.as_dict()
+
+
+def read_page(limit: int, after: tuple = None) -> tuple:
+    """
+    Return (states, next) for one page of states in key order.
+    See Snapshot.page().
+    """
+    return cache.snapshot().page(limit, after)
+
+
+def iter_export(country_code: str = None):
+    """
+    Yield state docs, optionally only those of one country, from the
+    cache when it is loaded and otherwise straight from a DB cursor.
+    """
+    cc = country_code.strip().upper() if country_code else None
+    if not cache.is_loaded():
+        filt = {COUNTRY_CODE: cc} if cc else {}
+        return dbc.iter_docs(STATE_COLLECTION, filt=filt, no_id=True)
+    snap = cache.snapshot()
+    docs = snap.lookup(BY_COUNTRY, cc) if cc else snap.docs
+    return iter(docs.values())
 
 
 def load_cache():
     """
     Load all states from database into memory cache
     """
-    global cache
-    cache = {}
-    states = dbc.read(STATE_COLLECTION)
-    for state in states:
-        cache[(state[STATE_CODE], state[COUNTRY_CODE])] = state
+    cache.load()
 
 
-@needs_cache
 def add_state(country_code: str, state_code: str, name: str, **extra_fields) -> None:
     """
     Upsert a state using (state_code, country_code) as the identity.
@@ -73,19 +105,44 @@ def add_state(country_code: str, state_code: str, name: str, **extra_fields) ->
         **extra_fields,
     }
 
-    # update first. if no match, create
-    result = dbc.update(
-        STATE_COLLECTION,
-        {STATE_CODE: sc, COUNTRY_CODE: cc},
-        doc
-    )
-    if result.matched_count == 0:
-        dbc.create(STATE_COLLECTION, doc)
+    # one atomic upsert; the doc it returns has every field, so it can
+    # go straight into the cache
+    cache.put(dbc.upsert(STATE_COLLECTION, {STATE_CODE: sc, COUNTRY_CODE: cc}, doc, no_id=True))
 
-    load_cache()
+
+def state_doc(row: dict) -> dict:
+    """
+    Check an uploaded row and turn it into a state doc, with its codes
+    cleaned up the way add_state() does.
+    """
+    if not isinstance(row, dict):
+        raise ValueError("Row must be a JSON object")
+    for fld in (COUNTRY_CODE, STATE_CODE, NAME):
+        val = row.get(fld)
+        if not isinstance(val, str) or not val.strip():
+            raise ValueError(f"Bad value for {fld}")
+    doc = {fld: val for fld, val in row.items() if fld != dbc.MONGO_ID}
+    doc[STATE_CODE] = row[STATE_CODE].strip().upper()
+    doc[COUNTRY_CODE] = row[COUNTRY_CODE].strip().upper()
+    return doc
+
+
+def add_states(docs: list) -> list:
+    """
+    Upsert a batch of state docs in one round trip per chunk.
+    Later docs for the same state win.
+    If a doc fails, the ones written before it are still cached, and
+    the BulkWriteError is raised.
+    """
+    try:
+        results = dbc.upsert_many(STATE_COLLECTION, docs, KEY_FLDS, ordered=True)
+    except BulkWriteError as e:
+        cache.merge(dbc.written(docs, e, ordered=True))
+        raise
+    cache.merge(docs)
+    return results
 
 
-@needs_cache
 def create(flds: dict, reload=True) -> str:
     if not isinstance(flds, dict):
         raise ValueError(f'Bad type for {type(flds)=}')
@@ -102,7 +159,7 @@ def create(flds: dict, reload=True) -> str:
     new_id = dbc.create(STATE_COLLECTION, flds)
     print(f'{new_id=}')
     if reload:
-        load_cache()
+        cache.put(flds)
     return str(new_id.inserted_id)
 
 
@@ -110,7 +167,7 @@ def delete(code: str, cntry_code: str) -> bool:
     ret = dbc.delete(STATE_COLLECTION, {STATE_CODE: code, COUNTRY_CODE: cntry_code})
     if ret < 1:
         raise ValueError(f'State not found: {code}, {cntry_code}')
-    load_cache()
+    cache.evict((code, cntry_code))
     return ret
 
 
@@ -127,33 +184,55 @@ def update(code: str, country_code: str, updates: dict) -> bool:
     if result.modified_count < 1:
         raise ValueError(f"state not found: {code}, {country_code}")
 
-    load_cache()
+    key = (code, country_code)
+    if cache.is_loaded():
+        cached = cache.get(key)
+        if cached is not None:
+            # one snapshot for the whole change
+            cache.write(evicts=[key], puts=[{**cached, **updates}])
+        else:
+            # someone else wrote this state since we loaded
+            cache.refresh(key, {STATE_CODE: code, COUNTRY_CODE: country_code})
     return result.modified_count
 
 
-@needs_cache
-def read_one(code: str, country_code: str) -> dict:
+def read_one(code: str, country_code: str, fields=None) -> dict:
     """
-    Get a single state by code and country code
+    Get a single state by code and country code, optionally trimmed to fields
     """
-    key = (code, country_code)
-    if key not in cache:
+    state = cache.get((code, country_code))
+    if state is None:
         raise ValueError(f'State not found: {code}, {country_code}')
-    return cache[key]
+    return dbc.trim_doc(state, fields)
+
+
+def read_many(keys: list) -> dict:
+    """
+    Look up many states by (state_code, country_code) key at once:
+    hits come from one pass over the cache, misses from a single DB query.
+    Returns {key: state} for the keys that exist.
+    """
+    found, missing = cache.get_many(dict.fromkeys(keys))
+    if missing:
+        docs = list(dbc.read_by_keys(STATE_COLLECTION, KEY_FLDS, missing))
+        cache.write(puts=docs)
+        found.update((state_key(doc), doc) for doc in docs)
+    return found
 
 
-@needs_cache
 def get_states_by_country(country_code):
     if not isinstance(country_code, str) or not country_code.strip():
         raise ValueError("Bad value for country_code")
 
     cc = country_code.strip().upper()
-    states_list = []
-    for key, state in cache.items():
-        if state.get(COUNTRY_CODE) == cc:
-            state_copy = state.copy()
-            states_list.append(state_copy)
-    return states_list
+    return [state.copy() for state in cache.lookup(BY_COUNTRY, cc).values()]
+
+
+def get_states_by_country_page(country_code: str, limit: int, after: tuple = None) -> tuple:
+    if not isinstance(country_code, str) or not country_code.strip():
+        raise ValueError("Bad value for country_code")
+    cc = country_code.strip().upper()
+    return cache.snapshot().page(limit, after, BY_COUNTRY, cc)
 
 
 def main():
@@ -7,14 +7,14 @@ import states.states_queries as qry
 @pytest.fixture(autouse=True)
 def reset_cache_and_cleanup():
     """Reset cache before each test and clean up NY state if it exists"""
-    qry.cache = None
+    qry.cache.clear()
     # Clean up any leftover NY state from previous test runs
     try:
         qry.delete(qry.SAMPLE_CODE, qry.SAMPLE_COUNTRY)
     except (ValueError, KeyError):
         pass  # State doesn't exist, that's fine
     yield
-    qry.cache = None
+    qry.cache.clear()
 
 @pytest.fixture(scope='function')
 def temp_state_no_del():
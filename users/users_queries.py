@@ -1,5 +1,7 @@
-from functools import wraps
+from pymongo.errors import DuplicateKeyError
+
 import data.db_connect as dbc
+from data.collection_cache import CollectionCache
 from werkzeug.security import generate_password_hash, check_password_hash
 
 USERS_COLLECTION = "users"
@@ -9,8 +11,6 @@ PASSWORD = "password"
 IS_DEVELOPER = "is_developer"
 MIN_PASSWORD_LENGTH = 8
 
-cache = None
-
 SAMPLE_USER = {
     EMAIL: "foodie@example.com",
     PASSWORD: "password123",
@@ -24,43 +24,26 @@ SAMPLE_DEVELOPER = {
 }
 
 
-def needs_cache(fn):
-    @wraps(fn)
-    def wrapper(*args, **kwargs):
-        if cache is None:
-            load_cache()
-        return fn(*args, **kwargs)
-    return wrapper
+INDEXES = [dbc.Index([EMAIL], unique=True)]
+dbc.register_indexes(USERS_COLLECTION, INDEXES, [[EMAIL]])
+
+cache = CollectionCache(USERS_COLLECTION, lambda doc: doc.get(EMAIL) or None)
 
 
 def load_cache():
     """Load the in-memory cache from the DB."""
-    global cache
-    cache = {}
-
-    try:
-        users = dbc.read(USERS_COLLECTION)
-    except Exception:
-        print(f"Error loading users from DB: {Exception}")
-        users = []
-
-    for user_doc in users:
-        email = user_doc.get(EMAIL)
-        if email:
-            cache[email] = user_doc
+    cache.load()
 
 
-@needs_cache
 def count() -> int:
     """Return number of users."""
     return len(cache)
 
 
-@needs_cache
 def read() -> dict:
     """Return all users (without passwords)."""
     result = {}
-    for email, user_doc in cache.items():
+    for email, user_doc in cache.as_dict().items():
         safe_doc = {k: v for k, v in user_doc.items() if k != PASSWORD}
         result[email] = safe_doc
     return result
@@ -81,10 +64,14 @@ def create_user(email: str, password: str, is_developer: bool = False) -> str:
     if '@' not in email:
         raise ValueError("Invalid email format")
 
-    # Check if user already exists
-    existing = dbc.read_one(USERS_COLLECTION, {EMAIL: email})
-    if existing:
-        raise ValueError(f"Email '{email}' already exists")
+    # Check if user already exists, unless the users cache rules the
+    # email out; if another worker has registered it since, the unique
+    # email index stops the insert below
+    if cache.might_contain(email) and not cache.is_known_missing(email):
+        existing = dbc.read_one(USERS_COLLECTION, {EMAIL: email},
+                                projection=[EMAIL], no_id=True)
+        if existing:
+            raise ValueError(f"Email '{email}' already exists")
 
     # Create user document
     user_doc = {
@@ -93,8 +80,12 @@ def create_user(email: str, password: str, is_developer: bool = False) -> str:
         IS_DEVELOPER: is_developer,
     }
 
-    result = dbc.create(USERS_COLLECTION, user_doc)
-    load_cache()
+    try:
+        result = dbc.create(USERS_COLLECTION, user_doc)
+    except DuplicateKeyError:
+        # registered concurrently; the unique email index caught it
+        raise ValueError(f"Email '{email}' already exists")
+    cache.put(user_doc)
     return str(result.inserted_id)
 
 
@@ -118,12 +109,10 @@ def authenticate(email: str, password: str) -> dict:
     return safe_user
 
 
-@needs_cache
 def user_exists(email: str) -> bool:
     return email in cache
 
 
-@needs_cache
 def is_user_developer(email: str) -> bool:
     user = cache.get(email)
     if not user:
@@ -135,19 +124,25 @@ def delete_user(email: str) -> bool:
     ret = dbc.delete(USERS_COLLECTION, {EMAIL: email})
     if ret < 1:
         raise ValueError(f"User not found: {email}")
-    load_cache()
+    cache.evict(email)
     return True
 
 
 def update_password(email: str, new_password: str) -> bool:
     if len(new_password) < MIN_PASSWORD_LENGTH:
         raise ValueError(f"Password must be at least {MIN_PASSWORD_LENGTH} characters")
-    ret = dbc.update(USERS_COLLECTION, {EMAIL: email}, {PASSWORD: generate_password_hash(new_password)})
+    new_hash = generate_password_hash(new_password)
+    ret = dbc.update(USERS_COLLECTION, {EMAIL: email}, {PASSWORD: new_hash})
 
     if ret.modified_count < 1:
         raise ValueError(f"User not found: {email}")
 
-    load_cache()
+    if cache.is_loaded():
+        cached = cache.get(email)
+        if cached is not None:
+            cache.put({**cached, PASSWORD: new_hash})
+        else:
+            cache.load()
     return True
 
 
@@ -171,4 +166,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()